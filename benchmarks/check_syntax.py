@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Regression check for the in-process Mermaid syntax pre-check.
+
+The pre-check must never reject a diagram that Mermaid CLI accepts, so
+every entry of ACCEPTED (plus the benchmark corpus) has to pass, and every
+entry of REJECTED has to fail with a diagnostic. Exits non-zero otherwise.
+
+    python benchmarks/check_syntax.py
+"""
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from corpus import CORPUS  # noqa: E402
+from mermaid_diagram import MermaidSyntaxError, validate_mermaid  # noqa: E402
+
+ACCEPTED = {
+    "edge text with >": "flowchart LR\n    A -- a>b --> B",
+    "edge text with HTML": "flowchart LR\n    A -- <b>bold</b> --> B",
+    "dotted and thick edge text": "flowchart LR\n    A -. maybe (x .-> B\n    C == big ==> D\n    E <-- back --> F",
+    "asymmetric nodes": "flowchart LR\n    A>flag] --> B>other] & C>x]\n    D -->|t| E>y]\n    F -.- G>z]",
+    "multi-line markdown string": 'flowchart LR\n    a("`The **cat**\n    in the hat`") --> b',
+    "flowchart accDescr block": "flowchart LR\n    accDescr {\n        A long (description\n    }\n    A --> B",
+    "flowchart accDescr line": "flowchart LR\n    accDescr: A (long description\n    A --> B",
+    "sequence accDescr block": "sequenceDiagram\n    accDescr {\n        Alice talks\n        end\n    }\n"
+                               "    Alice->>Bob: hi",
+    "class accDescr block": "classDiagram\n    accDescr {\n        Classes { and more\n    }\n    class A",
+    "par_over": "sequenceDiagram\n    par_over Alice to Bob\n    Alice->>Bob: hi\n    and Bob to Carl\n"
+                "    Bob->>Carl: hi\n    end",
+    "state description with }": "stateDiagram-v2\n    s2 : A description with } brace\n"
+                                "    note right of s2 : a { note",
+    "; in a node label": "flowchart LR\n    A[a;b] --> B",
+    "; in link text": "flowchart LR\n    A -->|a;b| B",
+    "half-arrow -|\\": "sequenceDiagram\n    A-|\\B: hi",
+    "half-arrow --|/": "sequenceDiagram\n    A--|/B: hi",
+    "half-arrow /|-": "sequenceDiagram\n    A/|-B: hi",
+}
+
+REJECTED = {
+    "unclosed asymmetric node": "flowchart LR\n    A>flag --> B",
+    "unterminated string": 'flowchart LR\n    A["x] --> B',
+    "unclosed round node": "flowchart LR\n    A(x --> B",
+    "single-dash link": "flowchart LR\n    A -> B",
+    "stray sequence end": "sequenceDiagram\n    end",
+    "unclosed par_over": "sequenceDiagram\n    par_over Alice to Bob\n    Alice->>Bob: x",
+    "unclosed class body": "classDiagram\n    class A {\n        +int x",
+}
+
+
+def main():
+    failures = 0
+    for name, code in list(ACCEPTED.items()) + list(CORPUS.items()):
+        try:
+            validate_mermaid(code)
+        except MermaidSyntaxError as e:
+            failures += 1
+            print(f"FAIL {name}: rejected valid input\n{e}")
+    for name, code in REJECTED.items():
+        try:
+            validate_mermaid(code)
+        except MermaidSyntaxError:
+            continue
+        failures += 1
+        print(f"FAIL {name}: not rejected")
+    total = len(ACCEPTED) + len(CORPUS) + len(REJECTED)
+    print(f"{total - failures}/{total} syntax checks passed")
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
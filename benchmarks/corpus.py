@@ -0,0 +1,83 @@
+"""
+Deterministic Mermaid corpus for the benchmarks.
+
+Every entry is generated from a fixed pattern so runs are comparable across
+machines and revisions without storing large fixture files.
+"""
+
+
+def flowchart(nodes):
+    lines = ["flowchart TD"]
+    for i in range(nodes):
+        shape = ("[Step {0}]", "(Round {0})", "{{Check {0}}}", "([Stadium {0}])")[i % 4]
+        lines.append(f"    N{i}" + shape.format(i))
+    for i in range(1, nodes):
+        # Mostly a tree with a few cross links, like real process diagrams
+        lines.append(f"    N{(i - 1) // 2} --> N{i}")
+        if i % 7 == 0:
+            lines.append(f"    N{i} -.->|retry| N{i // 3}")
+    return "\n".join(lines)
+
+
+def sequence(messages, participants=6):
+    lines = ["sequenceDiagram"]
+    for p in range(participants):
+        lines.append(f"    participant P{p} as Service {p}")
+    for i in range(messages):
+        a, b = i % participants, (i * 3 + 1) % participants
+        arrow = "->>" if i % 2 == 0 else "-->>"
+        lines.append(f"    P{a}{arrow}P{b}: message {i}")
+        if i % 10 == 0:
+            lines.append(f"    Note over P{a},P{b}: checkpoint {i}")
+    return "\n".join(lines)
+
+
+def gantt(tasks):
+    lines = ["gantt", "    title Release plan", "    dateFormat YYYY-MM-DD"]
+    for i in range(tasks):
+        if i % 10 == 0:
+            lines.append(f"    section Phase {i // 10 + 1}")
+        if i == 0:
+            lines.append("    Task 0 :t0, 2024-01-01, 3d")
+        else:
+            lines.append(f"    Task {i} :t{i}, after t{i - 1}, {i % 5 + 1}d")
+    return "\n".join(lines)
+
+
+def class_diagram(classes):
+    lines = ["classDiagram"]
+    for i in range(classes):
+        lines.append(f"    class C{i} {{")
+        lines.append(f"        +int field{i}")
+        lines.append("        +String name")
+        lines.append(f"        +method{i}() bool")
+        lines.append("    }")
+    for i in range(1, classes):
+        relation = ("<|--", "*--", "o--", "-->")[i % 4]
+        lines.append(f"    C{(i - 1) // 3} {relation} C{i}")
+    return "\n".join(lines)
+
+
+def mindmap(children, depth=3):
+    lines = ["mindmap", "  root((Topics))"]
+
+    def branch(prefix, level):
+        if level > depth:
+            return
+        for i in range(children):
+            lines.append("  " * (level + 1) + f"{prefix}{i}")
+            branch(f"{prefix}{i}.", level + 1)
+
+    branch("T", 1)
+    return "\n".join(lines)
+
+
+CORPUS = {
+    "flowchart-10": flowchart(10),
+    "flowchart-100": flowchart(100),
+    "flowchart-1000": flowchart(1000),
+    "sequence-200": sequence(200),
+    "gantt-60": gantt(60),
+    "class-40": class_diagram(40),
+    "mindmap-4x3": mindmap(4),
+}
@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+End-to-end benchmarks for the Mermaid extension.
+
+Runs the full extension (render, convert, parse, insert) on a generated
+corpus and reports per-stage latency percentiles and output size. The real
+``mmdc``/``inkscape`` are used when installed; otherwise (or with
+``--stubs``) the deterministic stand-ins in ``benchmarks/stubs`` are used,
+which isolates the Python-side costs.
+
+    python benchmarks/run_benchmarks.py --repeat 5 --formats svg svg_native png png_native
+    python benchmarks/run_benchmarks.py --stubs --json results.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+from corpus import CORPUS  # noqa: E402
+from mermaid_diagram import MermaidGenerator, process_peak_rss_kb  # noqa: E402
+
+STUB_DIR = os.path.join(HERE, 'stubs')
+BLANK_DOCUMENT = (b'<svg xmlns="http://www.w3.org/2000/svg" width="210mm" height="297mm" '
+                  b'viewBox="0 0 210 297"><g id="layer1"/></svg>')
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def resolve_tools(args):
+    """Pick real tools when installed unless stubs are forced."""
+    mmdc = None if args.stubs else shutil.which(args.mmdc)
+    inkscape = None if args.stubs else shutil.which(args.inkscape)
+    return (mmdc or os.path.join(STUB_DIR, 'mmdc'),
+            inkscape or os.path.join(STUB_DIR, 'inkscape'),
+            mmdc is None, inkscape is None)
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak-RSS counter for this process (Linux only)."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def run_once(document, code_file, output_format, mmdc, inkscape, extra, trace_memory=False):
+    """Run the extension once and return (stage times, output bytes).
+    
+    With ``trace_memory`` the Python heap peak and the process peak RSS
+    (which includes lxml's C allocations) are recorded as the pseudo-stages
+    ``py_peak_mb`` and ``rss_peak_mb``. tracemalloc slows the run down, so
+    those timings are not comparable with untraced runs.
+    """
+    generator = MermaidGenerator()
+    argv = [
+        f'--mermaid_file={code_file}',
+        '--use_file=true',
+        f'--output_format={output_format}',
+        f'--mermaid_cli_path={mmdc}',
+        f'--inkscape_path={inkscape}',
+        '--use_cache=false',
+    ] + extra + [document]
+    output = io.BytesIO()
+    if trace_memory:
+        rss_reset = reset_peak_rss()
+        tracemalloc.start()
+    start = time.perf_counter()
+    generator.run(argv, output=output)
+    wall = time.perf_counter() - start
+    stages = {}
+    if trace_memory:
+        stages['py_peak_mb'] = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+        peak_kb = process_peak_rss_kb(os.getpid()) if rss_reset else None
+        if peak_kb:
+            stages['rss_peak_mb'] = peak_kb / 1024
+    for name, seconds in getattr(generator, 'stage_times', []):
+        stages[name] = stages.get(name, 0.0) + seconds
+    stages['total'] = wall
+    return stages, len(output.getvalue()) - len(BLANK_DOCUMENT)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per diagram and format")
+    parser.add_argument('--formats', nargs='+', default=['svg', 'svg_native', 'png', 'png_native'])
+    parser.add_argument('--only', nargs='+', default=None, help="Corpus entries to run")
+    parser.add_argument('--stubs', action='store_true', help="Always use the stub tools")
+    parser.add_argument('--mmdc', default='mmdc')
+    parser.add_argument('--inkscape', default='inkscape')
+    parser.add_argument('--json', default='', help="Write raw results to this file")
+    parser.add_argument('--memory', action='store_true', help="Record the Python heap peak (slower)")
+    parser.add_argument('extra', nargs='*', help="Extra extension arguments, after --")
+    args = parser.parse_args(argv)
+
+    mmdc, inkscape, stub_mmdc, stub_inkscape = resolve_tools(args)
+    print(f"mmdc: {mmdc}{' (stub)' if stub_mmdc else ''}")
+    print(f"inkscape: {inkscape}{' (stub)' if stub_inkscape else ''}")
+
+    names = args.only or list(CORPUS)
+    results = []
+    with tempfile.TemporaryDirectory(prefix='mermaid-bench-') as work:
+        document = os.path.join(work, 'blank.svg')
+        with open(document, 'wb') as f:
+            f.write(BLANK_DOCUMENT)
+
+        for name in names:
+            code_file = os.path.join(work, f'{name}.mmd')
+            with open(code_file, 'w', encoding='utf-8') as f:
+                f.write(CORPUS[name])
+            for output_format in args.formats:
+                samples = []
+                size = 0
+                for _ in range(args.repeat):
+                    stages, size = run_once(document, code_file, output_format,
+                                            mmdc, inkscape, args.extra, args.memory)
+                    samples.append(stages)
+                stage_names = [s for s in samples[0] if s not in ('total', 'py_peak_mb', 'rss_peak_mb')] + ['total']
+                summary = {
+                    stage: {
+                        'p50': percentile([s.get(stage, 0.0) for s in samples], 50),
+                        'p90': percentile([s.get(stage, 0.0) for s in samples], 90),
+                        'p99': percentile([s.get(stage, 0.0) for s in samples], 99),
+                    }
+                    for stage in stage_names
+                }
+                results.append({'diagram': name, 'format': output_format,
+                                'runs': args.repeat, 'output_bytes': size, 'stages': summary})
+                print(f"\n{name} [{output_format}] output {size / 1024:.1f} KiB")
+                print(f"  {'stage':<12}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+                for stage, values in summary.items():
+                    print(f"  {stage:<12}{values['p50'] * 1000:>10.1f}"
+                          f"{values['p90'] * 1000:>10.1f}{values['p99'] * 1000:>10.1f}")
+                if args.memory:
+                    peak = max(s['py_peak_mb'] for s in samples)
+                    results[-1]['py_peak_mb'] = round(peak, 2)
+                    line = f"  Python heap peak {peak:.1f} MB"
+                    if all('rss_peak_mb' in s for s in samples):
+                        rss = max(s['rss_peak_mb'] for s in samples)
+                        results[-1]['rss_peak_mb'] = round(rss, 1)
+                        line += f", process peak RSS {rss:.1f} MB"
+                    print(line)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'mmdc': 'stub' if stub_mmdc else mmdc,
+                'inkscape': 'stub' if stub_inkscape else inkscape,
+                'results': results,
+            }, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+# MIT License
+
+# Copyright (c) 2026 Rachid, Youven ZEGHLACHE
+
+"""
+Headless command-line builder for Mermaid diagrams.
+
+Renders .mmd files (or ```mermaid blocks in Markdown) to SVG/PNG files using
+the same pipeline as the Inkscape extension, without an input document:
+
+    python mermaid_build.py docs/diagrams -o build/diagrams -j 4 --summary -
+
+Unchanged sources are skipped on rebuilds; the state lives in
+``.mermaid-build.json`` inside the output directory.
+"""
+import argparse
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import time
+
+from mermaid_diagram import (MermaidGenerator, STAGE_SINK, collect_diagram_sources, parse_variants,
+                             svg_root_size, variant_slug)
+
+MANIFEST_NAME = '.mermaid-build.json'
+# Options applied to the written file after rendering (see scale_svg)
+OUTPUT_OPTIONS = ('auto_scale', 'max_width', 'max_height', 'maintain_aspect_ratio')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Render Mermaid diagrams to SVG/PNG files.")
+    parser.add_argument('sources', nargs='+', help="Files, directories, globs or Markdown files")
+    parser.add_argument('-o', '--output-dir', default='.', help="Directory for rendered files")
+    parser.add_argument('-f', '--format', default='svg', choices=['svg', 'svg_native', 'png', 'png_native'],
+                        help="Output format (svg/png = via PDF, svg_native/png_native = straight from Mermaid)")
+    parser.add_argument('--variants', default='',
+                        help="Also render each diagram as these ';'-separated theme:format:quality:background "
+                             "variants, to NAME-VARIANT.EXT (e.g. 'default; dark; neutral:png:3')")
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count() or 1, help="Parallel renders")
+    parser.add_argument('--force', action='store_true', help="Rebuild even if unchanged")
+    parser.add_argument('--summary', default='', help="Write a JSON timing summary to FILE ('-' for stdout)")
+    parser.add_argument('--trace', default='', help="Write a Chrome trace-event JSON file of all stages")
+    parser.add_argument('-v', '--verbose', action='store_true', help="Print tool commands")
+
+    # Rendering options shared with the extension
+    parser.add_argument('--theme', default='default')
+    parser.add_argument('--background', default='white')
+    parser.add_argument('--scale-factor', type=float, default=1.0)
+    parser.add_argument('--quality', type=int, default=2)
+    parser.add_argument('--width', type=int, default=800)
+    parser.add_argument('--height', type=int, default=600)
+    parser.add_argument('--no-fit', action='store_true', help="Use --width/--height instead of fitting to content")
+    parser.add_argument('--max-width', type=int, default=0, help="Auto-scale SVG output to this width")
+    parser.add_argument('--max-height', type=int, default=0, help="Auto-scale SVG output to this height")
+    parser.add_argument('--config-file', default='')
+    parser.add_argument('--css-file', default='')
+    parser.add_argument('--mermaid-cli-path', default='mmdc')
+    parser.add_argument('--inkscape-path', default='inkscape')
+    parser.add_argument('--timeout', type=int, default=30)
+    parser.add_argument('--io-mode', default='pipe', choices=['pipe', 'files'],
+                        help="Stream through tool stdin/stdout or use scratch files")
+    parser.add_argument('--temp-dir', default='', help="Parent directory for scratch files")
+    parser.add_argument('--tmpfs', action='store_true', help="Keep scratch files in /dev/shm")
+    parser.add_argument('--keep-temp', action='store_true', help="Keep scratch files for debugging")
+    parser.add_argument('--no-cache', action='store_true', help="Bypass the shared render cache")
+    parser.add_argument('--memory-budget-mb', type=int, default=0,
+                        help="Memory for concurrent mmdc/Inkscape processes (default: half of available)")
+    parser.add_argument('--no-validate', action='store_true', help="Skip the syntax pre-check before mmdc")
+    parser.add_argument('--use-worker', action='store_true', help="Render through the warm Puppeteer worker")
+    parser.add_argument('--renderer', default='mmdc', choices=['mmdc', 'auto'],
+                        help="auto renders simple flowcharts, pie and sequence diagrams in-process")
+    parser.add_argument('--render-url', default='',
+                        help="Render through a Kroki-style HTTP service instead of local mmdc")
+    parser.add_argument('--render-retries', type=int, default=3, help="Retries for transient service errors")
+    return parser.parse_args(argv)
+
+
+def make_generator(args):
+    """Build a MermaidGenerator whose options mirror the CLI arguments."""
+    generator = MermaidGenerator()
+    options = generator.arg_parser.parse_args([])
+    options.output_format = args.format
+    options.theme = args.theme
+    options.background = args.background
+    options.scale_factor = args.scale_factor
+    options.quality = args.quality
+    options.width = args.width
+    options.height = args.height
+    options.fit_to_content = not args.no_fit
+    options.auto_scale = bool(args.max_width or args.max_height)
+    options.max_width = args.max_width
+    options.max_height = args.max_height
+    options.config_file = args.config_file
+    options.css_file = args.css_file
+    options.mermaid_cli_path = args.mermaid_cli_path
+    options.inkscape_path = args.inkscape_path
+    options.timeout = args.timeout
+    options.io_mode = args.io_mode
+    options.temp_dir = args.temp_dir
+    options.scratch_tmpfs = args.tmpfs
+    options.keep_temp_files = args.keep_temp
+    options.use_cache = not args.no_cache
+    options.validate_syntax = not args.no_validate
+    options.batch_jobs = args.jobs
+    options.memory_budget_mb = args.memory_budget_mb
+    options.use_puppeteer = args.use_worker
+    options.renderer = args.renderer
+    if args.render_url:
+        options.render_backend = 'http'
+        options.render_url = args.render_url
+    options.render_retries = args.render_retries
+    options.quiet_mode = not args.verbose
+    options.trace_file = args.trace
+    generator.options = options
+    return generator
+
+
+def plan_outputs(sources, output_dir, suffixes):
+    """Map every diagram to output paths mirroring the source layout.
+    
+    ``suffixes`` holds one (file name suffix, extension) pair per output
+    wanted for each diagram.
+    """
+    diagrams = []
+    for source in sources:
+        diagrams.extend(collect_diagram_sources(source))
+    if not diagrams:
+        return []
+
+    paths = sorted({os.path.abspath(path) for path, _, _ in diagrams})
+    base = os.path.dirname(paths[0]) if len(paths) == 1 else os.path.commonpath(paths)
+    planned = []
+    seen = set()
+    for path, index, code in diagrams:
+        stem = os.path.splitext(os.path.relpath(os.path.abspath(path), base))[0]
+        if index is not None:
+            stem = f"{stem}-{index}"
+        outputs = [os.path.join(output_dir, f"{stem}{suffix}.{ext}") for suffix, ext in suffixes]
+        for output in outputs:
+            if output in seen:
+                raise SystemExit(f"Two diagrams map to the same output file: {output}")
+            seen.add(output)
+        planned.append((path, index, code, outputs))
+    return planned
+
+
+def scale_svg(generator, artifact):
+    """Apply --max-width/--max-height by rewriting the SVG's width/height."""
+    if not generator.options.auto_scale:
+        return artifact
+    from lxml import etree
+    root = etree.fromstring(artifact, etree.XMLParser(huge_tree=True))
+    width, height, viewbox = svg_root_size(root)
+    if width is None:
+        return artifact
+    scale = generator.apply_auto_scale(width, height)
+    if scale == 1.0:
+        return artifact
+    if viewbox is None:
+        root.set('viewBox', f"0 0 {width:g} {height:g}")
+    root.set('width', f"{width * scale:g}")
+    root.set('height', f"{height * scale:g}")
+    return etree.tostring(root, xml_declaration=True, encoding='utf-8')
+
+
+def output_signature(generator, code):
+    """Manifest entry for one output: the render signature plus OUTPUT_OPTIONS."""
+    h = hashlib.sha256()
+    h.update(generator.render_signature(code).encode('ascii'))
+    h.update(generator.options_digest(OUTPUT_OPTIONS).encode('ascii'))
+    return h.hexdigest()
+
+
+def write_output(output, data):
+    """Write atomically so an interrupted build never leaves a torn file."""
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    tmp_path = f"{output}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, output)
+
+
+def build_one(generator, code, output):
+    """Render one diagram to ``output``; returns (ok, stage timings)."""
+    STAGE_SINK.times = []
+    try:
+        artifact = generator.render_diagram(code)
+        if not artifact:
+            return False, STAGE_SINK.times
+        if output.endswith('.svg'):
+            artifact = scale_svg(generator, artifact)
+        write_output(output, artifact)
+        return True, STAGE_SINK.times
+    finally:
+        STAGE_SINK.times = None
+
+
+def load_manifest(output_dir):
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(output_dir, manifest):
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    generator = make_generator(args)
+    started = time.perf_counter()
+
+    if args.renderer == 'mmdc' and not generator.require_mermaid_cli():
+        return 2
+
+    try:
+        variants = parse_variants(args.variants) if args.variants.strip() else [(None, {})]
+    except ValueError as e:
+        print(f"Invalid --variants: {e}", file=sys.stderr)
+        return 2
+    suffixes = []
+    for name, overrides in variants:
+        output_format = overrides.get('output_format', args.format)
+        suffixes.append((f"-{variant_slug(name)}" if name else '',
+                         'png' if output_format in ('png', 'png_native') else 'svg'))
+    planned = plan_outputs(args.sources, args.output_dir, suffixes)
+    if not planned:
+        print("No Mermaid diagrams found", file=sys.stderr)
+        return 1
+
+    manifest = {} if args.force else load_manifest(args.output_dir)
+    # Resolve shared state once instead of racing for it in every worker
+    generator.get_cache()
+    generator.get_render_worker()
+
+    results = []
+    jobs = []
+    for path, index, code, outputs in planned:
+        pending = []
+        for (name, overrides), output in zip(variants, outputs):
+            with generator.variant_options(overrides):
+                signature = output_signature(generator, code)
+            key = os.path.relpath(output, args.output_dir)
+            entry = {'source': path, 'output': output}
+            if index is not None:
+                entry['block'] = index
+            if name:
+                entry['variant'] = name
+            results.append(entry)
+            if manifest.get(key) == signature and os.path.exists(output):
+                entry.update(status='skipped', seconds=0.0)
+                continue
+            pending.append((entry, key, signature, overrides, output))
+        if pending:
+            jobs.append((code, pending))
+
+    def run(job):
+        # A diagram's variants render on one worker so they can share PDFs
+        code, pending = job
+        memo = {}
+        done = []
+        for entry, key, signature, overrides, output in pending:
+            job_start = time.perf_counter()
+            with generator.variant_options(overrides, memo):
+                ok, stages = build_one(generator, code, output)
+            entry['seconds'] = round(time.perf_counter() - job_start, 4)
+            entry['stages'] = {}
+            for name, seconds in stages:
+                entry['stages'][name] = round(entry['stages'].get(name, 0.0) + seconds, 4)
+            entry['status'] = 'rendered' if ok else 'failed'
+            if ok:
+                entry['bytes'] = os.path.getsize(output)
+            done.append((key, signature, ok))
+        return done
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+            try:
+                for done in pool.map(run, jobs):
+                    for key, signature, ok in done:
+                        if ok:
+                            manifest[key] = signature
+                        else:
+                            manifest.pop(key, None)
+            except BaseException:
+                # Kill renders in flight (and their browsers) instead of waiting them out
+                generator.get_scheduler().cancel()
+                raise
+    finally:
+        generator.close_inkscape_shells()
+        generator.close_scheduler()
+        generator.close_render_backend()
+        generator.close_cache()
+        generator.cleanup_scratch()
+        generator.write_trace()
+
+    save_manifest(args.output_dir, manifest)
+
+    counts = {}
+    for entry in results:
+        counts[entry['status']] = counts.get(entry['status'], 0) + 1
+    summary = {
+        'format': args.format,
+        'variants': [name for name, _ in variants if name],
+        'jobs': args.jobs,
+        'total_seconds': round(time.perf_counter() - started, 4),
+        'counts': counts,
+        'files': results,
+    }
+    if args.summary == '-':
+        json.dump(summary, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    elif args.summary:
+        with open(args.summary, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
+
+    print(", ".join(f"{count} {status}" for status, count in sorted(counts.items())), file=sys.stderr)
+    return 1 if counts.get('failed') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -8,15 +8,2183 @@
 Inkscape extension to generate and insert Mermaid diagrams.
 """
 import inkex
+import argparse
+import binascii
+import io
 import os
+import queue
 import subprocess
 import tempfile
 import shutil
+import signal
+import sys
 import re
+import concurrent.futures
+import contextlib
+import glob
+import gzip
+import hashlib
+import heapq
+import http.client
+import json
+import socket
+import struct
+import threading
+import urllib.parse
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+import time
+
+import mermaid_lite
+
+
+SVG_NS = 'http://www.w3.org/2000/svg'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+CSS_COMPOUND_RE = re.compile(r'([a-zA-Z][\w-]*|\*)?((?:[#.][\w-]+)*)$')
+CSS_DECL_SPLIT_RE = re.compile(r';(?![^(]*\))')
+CSS_VAR_RE = re.compile(r'var\(\s*(--[\w-]+)\s*(?:,\s*([^)]*))?\)')
+
+NON_RENDERED_TAGS = ('defs', 'marker', 'clipPath', 'mask', 'symbol', 'pattern',
+                     'linearGradient', 'radialGradient', 'filter', 'style', 'metadata')
+
+# Properties inherited by SVG text; used when flattening HTML labels
+TEXT_STYLE_PROPERTIES = ('font-family', 'font-size', 'font-weight', 'font-style', 'fill')
+
+
+def _local_name(element):
+    tag = element.tag
+    if not isinstance(tag, str):
+        return None
+    return tag.rsplit('}', 1)[-1]
+
+
+def _strip_css_blocks(css):
+    """Remove comments and nested at-rule blocks (@keyframes, @media)."""
+    css = re.sub(r'/\*.*?\*/', '', css, flags=re.S)
+    out = []
+    i = 0
+    while i < len(css):
+        if css[i] == '@':
+            brace = css.find('{', i)
+            semi = css.find(';', i)
+            if semi != -1 and (brace == -1 or semi < brace):
+                i = semi + 1
+                continue
+            if brace == -1:
+                break
+            depth = 0
+            j = brace
+            while j < len(css):
+                if css[j] == '{':
+                    depth += 1
+                elif css[j] == '}':
+                    depth -= 1
+                    if depth == 0:
+                        break
+                j += 1
+            i = j + 1
+            continue
+        out.append(css[i])
+        i += 1
+    return ''.join(out)
+
+
+def parse_css_declarations(text):
+    """Parse ``a:b;c:d`` into an ordered dict, flagging !important values."""
+    decls = {}
+    for part in CSS_DECL_SPLIT_RE.split(text):
+        if ':' not in part:
+            continue
+        name, value = part.split(':', 1)
+        name = name.strip().lower()
+        value = value.strip()
+        important = value.lower().endswith('!important')
+        if important:
+            value = value[:-len('!important')].strip()
+        if name and value:
+            decls[name] = (value, important)
+    return decls
+
+
+def _parse_compound(text):
+    """Split a compound selector like ``g.node#a`` into (tag, ids, classes)."""
+    match = CSS_COMPOUND_RE.match(text)
+    if not match:
+        return None
+    tag = match.group(1)
+    if tag == '*':
+        tag = None
+    ids = re.findall(r'#([\w-]+)', match.group(2))
+    classes = re.findall(r'\.([\w-]+)', match.group(2))
+    return tag, ids, classes
+
+
+def _compound_matches(element, compound):
+    tag, ids, classes = compound
+    if tag and _local_name(element) != tag:
+        return False
+    if ids and element.attrib.get('id') not in ids:
+        return False
+    if classes:
+        element_classes = (element.attrib.get('class') or '').split()
+        if not all(c in element_classes for c in classes):
+            return False
+    return True
+
+
+def inline_svg_styles(root):
+    """Resolve the CSS in ``<style>`` blocks into ``style`` attributes.
+    
+    Supports the selector subset Mermaid emits: type, class and ID
+    compounds joined by descendant/child combinators. Rules with pseudo
+    classes or attribute selectors are skipped. Returns the declarations
+    that matched the root element so the caller can carry them over to the
+    group that replaces it.
+    
+    Attributes are read and written through ``attrib``: inkex's ``get``
+    and ``set`` re-parse every ``style`` value, which dominates on large
+    diagrams.
+    """
+    css = []
+    for style in list(root.iter('{%s}style' % SVG_NS)):
+        css.append(style.text or '')
+        style.getparent().remove(style)
+    css = _strip_css_blocks('\n'.join(css))
+    
+    rules = []
+    custom_props = {}
+    for order, match in enumerate(re.finditer(r'([^{}]+)\{([^{}]*)\}', css)):
+        decls = parse_css_declarations(match.group(2))
+        for selector in match.group(1).split(','):
+            selector = selector.strip()
+            if selector == ':root':
+                custom_props.update({k: v for k, (v, _) in decls.items() if k.startswith('--')})
+                continue
+            if not selector or ':' in selector or '[' in selector:
+                continue
+            parts = [_parse_compound(p) for p in selector.replace('>', ' ').split()]
+            if not parts or None in parts:
+                continue
+            specificity = (sum(len(p[1]) for p in parts),
+                           sum(len(p[2]) for p in parts),
+                           sum(1 for p in parts if p[0]))
+            rules.append((specificity, order, parts, decls))
+    
+    if not rules:
+        return None
+    
+    # Index elements once so each rule only visits plausible candidates
+    by_id, by_class, by_tag, everything = {}, {}, {}, []
+    for element in root.iter():
+        name = _local_name(element)
+        if name is None:
+            continue
+        everything.append(element)
+        by_tag.setdefault(name, []).append(element)
+        attrib = element.attrib
+        if attrib.get('id'):
+            by_id.setdefault(attrib['id'], []).append(element)
+        for cls in (attrib.get('class') or '').split():
+            by_class.setdefault(cls, []).append(element)
+    
+    computed = {}
+    rules.sort(key=lambda r: (r[0], r[1]))
+    for _, _, parts, decls in rules:
+        tag, ids, classes = parts[-1]
+        if ids:
+            candidates = by_id.get(ids[0], [])
+        elif classes:
+            candidates = by_class.get(classes[0], [])
+        elif tag:
+            candidates = by_tag.get(tag, [])
+        else:
+            candidates = everything
+        for element in candidates:
+            if not _compound_matches(element, parts[-1]):
+                continue
+            # Match remaining compounds against ancestors, right to left
+            ancestor = element.getparent()
+            remaining = len(parts) - 2
+            while remaining >= 0 and ancestor is not None:
+                if _local_name(ancestor) is not None and _compound_matches(ancestor, parts[remaining]):
+                    remaining -= 1
+                ancestor = ancestor.getparent()
+            if remaining >= 0:
+                continue
+            target = computed.setdefault(element, {})
+            for name, (value, important) in decls.items():
+                if name.startswith('--'):
+                    continue
+                if name in target and target[name][1] and not important:
+                    continue
+                target[name] = (value, important)
+    
+    def resolve(value):
+        def repl(m):
+            return custom_props.get(m.group(1), m.group(2) or '')
+        return CSS_VAR_RE.sub(repl, value)
+    
+    root_style = None
+    for element, decls in computed.items():
+        inline = parse_css_declarations(element.attrib.get('style') or '')
+        merged = {}
+        for name, (value, important) in decls.items():
+            merged[name] = (resolve(value), important)
+        for name, (value, important) in inline.items():
+            if name in merged and merged[name][1] and not important:
+                continue
+            merged[name] = (resolve(value), important)
+        style = ';'.join(f'{k}:{v}' for k, (v, _) in merged.items() if v)
+        if element is root:
+            root_style = ';'.join(f'{k}:{v}' for k, (v, _) in merged.items()
+                                  if v and k in TEXT_STYLE_PROPERTIES)
+            continue
+        if style:
+            element.attrib['style'] = style
+    return root_style
+
+
+def _html_label_lines(element):
+    """Collect text lines from an HTML label, breaking at <br> and blocks."""
+    lines = ['']
+    
+    def walk(node):
+        name = _local_name(node)
+        if name == 'br':
+            lines.append('')
+        elif name in ('div', 'p') and lines[-1].strip():
+            lines.append('')
+        if node.text and name is not None:
+            lines[-1] += node.text
+        for child in node:
+            walk(child)
+            if child.tail:
+                lines[-1] += child.tail
+        if name in ('div', 'p') and lines[-1].strip():
+            lines.append('')
+    
+    walk(element)
+    return [' '.join(line.split()) for line in lines if line.strip()]
+
+
+def _label_text_style(foreign_object):
+    """Pick up font/colour from the innermost HTML element that sets them."""
+    found = {}
+    # Mermaid colours labels through CSS ``color`` on the enclosing group
+    for node in reversed(list(foreign_object.iterancestors())):
+        decls = parse_css_declarations(node.attrib.get('style') or '')
+        if 'color' in decls:
+            found['fill'] = decls['color'][0]
+    for node in foreign_object.iter():
+        decls = parse_css_declarations(node.attrib.get('style') or '') if _local_name(node) else {}
+        for name, (value, _) in decls.items():
+            if name == 'color':
+                name = 'fill'
+            if name in TEXT_STYLE_PROPERTIES:
+                found[name] = value
+    return ';'.join(f'{k}:{v}' for k, v in found.items())
+
+
+def foreign_objects_to_text(root):
+    """Replace HTML labels in ``<foreignObject>`` with centred SVG text."""
+    from lxml import etree
+    for foreign_object in list(root.iter('{%s}foreignObject' % SVG_NS)):
+        parent = foreign_object.getparent()
+        lines = _html_label_lines(foreign_object)
+        if not lines:
+            parent.remove(foreign_object)
+            continue
+        
+        x = float(foreign_object.get('x') or 0)
+        y = float(foreign_object.get('y') or 0)
+        width = float(foreign_object.get('width') or 0)
+        height = float(foreign_object.get('height') or 0)
+        
+        # Built through lxml directly: inkex's per-call tree bookkeeping
+        # dominates on diagrams with thousands of labels
+        cx = x + width / 2
+        style = _label_text_style(foreign_object)
+        text = inkex.TextElement()
+        text.attrib.update({
+            'x': str(cx), 'y': str(y + height / 2),
+            'style': 'text-anchor:middle;dominant-baseline:central' + (';' + style if style else ''),
+        })
+        if foreign_object.attrib.get('transform'):
+            text.attrib['transform'] = foreign_object.attrib['transform']
+        
+        first_dy = -(len(lines) - 1) * 0.6
+        for index, line in enumerate(lines):
+            tspan = inkex.Tspan()
+            tspan.attrib.update({'x': str(cx), 'dy': f'{first_dy if index == 0 else 1.2}em'})
+            tspan.text = line
+            etree._Element.append(text, tspan)
+        
+        etree._Element.replace(parent, foreign_object, text)
+
+
+def svg_root_size(root):
+    """Return ``(width, height, viewbox)`` of a parsed SVG root, sizes in px.
+    
+    Lengths with units (``pt`` from Poppler, ``mm``, ``in``...) go through
+    inkex's unit conversion. A missing or percentage size falls back to the
+    viewBox, taken as px. Sizes are None when neither is usable.
+    """
+    from inkex.units import convert_unit
+    viewbox = None
+    parts = (root.get('viewBox') or '').replace(',', ' ').split()
+    if len(parts) == 4:
+        try:
+            viewbox = tuple(float(p) for p in parts)
+        except ValueError:
+            pass
+    
+    def length(value, fallback):
+        if value and not value.strip().endswith('%'):
+            return convert_unit(value, 'px') or fallback
+        return fallback
+    
+    width = length(root.get('width'), viewbox[2] if viewbox else None)
+    height = length(root.get('height'), viewbox[3] if viewbox else None)
+    return width, height, viewbox
+
+
+def _rect_bbox(rect, transform):
+    """Bounding box of a ``<rect>`` under ``transform``, from its corners.
+    
+    Much cheaper than building the rect's path. Returns None for lengths
+    with units, which are left to inkex.
+    """
+    attrib = rect.attrib
+    try:
+        x, y, width, height = (float(attrib.get(name) or 0) for name in ('x', 'y', 'width', 'height'))
+    except ValueError:
+        return None
+    (a, c, e), (b, d, f) = transform.matrix
+    xs = [a * px + c * py + e for px in (x, x + width) for py in (y, y + height)]
+    ys = [b * px + d * py + f for px in (x, x + width) for py in (y, y + height)]
+    return inkex.BoundingBox((min(xs), max(xs)), (min(ys), max(ys)))
+
+
+def svg_content_bbox(root):
+    """Union of the rendered shapes' bounding boxes, ignoring defs/markers.
+    
+    One top-down walk hands each element its parent's composed transform,
+    rather than recomposing it from the root for every shape.
+    """
+    bbox = None
+    stack = [(root, inkex.Transform())]
+    while stack:
+        element, parent_transform = stack.pop()
+        name = _local_name(element)
+        if name is None or name in NON_RENDERED_TAGS:
+            continue
+        transform = parent_transform
+        if element.attrib.get('transform'):
+            try:
+                transform = parent_transform @ inkex.Transform(element.attrib['transform'])
+            except ValueError:
+                continue
+        stack.extend((child, transform) for child in element)
+        if (isinstance(element, inkex.Group) or not isinstance(element, inkex.ShapeElement)
+                or isinstance(element, inkex.Tspan)):
+            continue
+        try:
+            if 'clip-path' in element.attrib or 'clip-path' in element.attrib.get('style', ''):
+                element_bbox = element.bounding_box(parent_transform)
+            elif name == 'rect':
+                element_bbox = _rect_bbox(element, transform) or element.shape_box(parent_transform)
+            else:
+                element_bbox = element.shape_box(parent_transform)
+        except Exception:
+            continue
+        if element_bbox is not None:
+            bbox = element_bbox if bbox is None else bbox + element_bbox
+    return bbox
+
+
+URL_REF_RE = re.compile(r'url\(\s*["\']?#([^)"\']+)["\']?\s*\)')
+HREF_ATTRS = ('href', '{%s}href' % XLINK_NS)
+
+
+def rewrite_svg_references(root, ids):
+    """Point url(#..)/href references under ``root`` at ``ids[old]``."""
+    def fix_urls(value):
+        return URL_REF_RE.sub(lambda m: f'url(#{ids.get(m.group(1), m.group(1))})', value)
+    
+    for element in root.iter():
+        if _local_name(element) is None:
+            continue
+        attrib = element.attrib
+        for name, value in attrib.items():
+            if name in HREF_ATTRS and value.startswith('#'):
+                attrib[name] = '#' + ids.get(value[1:], value[1:])
+            elif 'url(' in value:
+                attrib[name] = fix_urls(value)
+
+
+def prefix_svg_ids(root, prefix):
+    """Prefix every ID and rewrite url(#..)/href references to match."""
+    ids = {}
+    for element in root.iter():
+        old = element.attrib.get('id') if _local_name(element) else None
+        if old:
+            ids[old] = prefix + old
+            element.attrib['id'] = prefix + old
+    if ids:
+        rewrite_svg_references(root, ids)
+
+
+# Referenceable, never-rendered elements that diagrams can share
+DEFINITION_TAGS = ('marker', 'clipPath', 'mask', 'symbol', 'pattern',
+                   'linearGradient', 'radialGradient', 'filter')
+
+
+def svg_definitions(root):
+    """Return the outermost definitions in ``root`` as an ``{id: element}`` dict.
+    
+    A definition is a ``DEFINITION_TAGS`` element anywhere, or any element
+    with an ID directly inside ``<defs>`` (Poppler's glyph paths).
+    """
+    found = {}
+    
+    def walk(element):
+        for child in element:
+            name = _local_name(child)
+            if name is None:
+                continue
+            child_id = child.get('id')
+            if child_id and (name in DEFINITION_TAGS or _local_name(element) == 'defs'):
+                found[child_id] = child
+            else:
+                walk(child)
+    
+    walk(root)
+    return found
+
+
+def definition_digest(element, definitions, memo, active=None):
+    """Hash a definition's structure, ignoring its IDs.
+    
+    References to other entries of ``definitions`` hash as the referenced
+    definition's own digest, so two gradients pointing at identical stops
+    match even when the stops have different IDs. ``memo`` caches digests
+    by ID across calls.
+    """
+    element_id = element.get('id')
+    if element_id in memo:
+        return memo[element_id]
+    active = active or set()
+    active.add(element_id)
+    
+    def resolve(ref):
+        target = definitions.get(ref)
+        if target is None or ref in active:
+            return '#' + ref
+        return definition_digest(target, definitions, memo, active)
+    
+    h = hashlib.sha256()
+    
+    def feed(node):
+        h.update(b'<' + _local_name(node).encode('utf-8'))
+        for key, value in sorted(node.attrib.items()):
+            if key == 'id':
+                continue
+            if key in HREF_ATTRS and value.startswith('#'):
+                value = resolve(value[1:])
+            elif 'url(' in value:
+                value = URL_REF_RE.sub(lambda m: f'url({resolve(m.group(1))})', value)
+            h.update(f' {key}={value}'.encode('utf-8'))
+        h.update(b'>' + (node.text or '').strip().encode('utf-8'))
+        for child in node:
+            if _local_name(child) is not None:
+                feed(child)
+            h.update((child.tail or '').strip().encode('utf-8'))
+        h.update(b'</>')
+    
+    feed(element)
+    active.discard(element_id)
+    memo[element_id] = h.hexdigest()
+    return memo[element_id]
+
+
+# IDs Inkscape/cairo invent for plain SVG export; safe to drop when unreferenced
+AUTO_ID_RE = re.compile(r'(g|path|use|text|tspan|rect|image|defs|surface|clipPath|clip|mask|symbol|glyph)\d+(-\d+)?$')
+NUMBER_RE = re.compile(r'-?(?:\d+\.\d*|\.\d+|\d+)(?:[eE][-+]?\d+)?')
+GEOMETRY_ATTRS = ('d', 'points', 'x', 'y', 'x1', 'y1', 'x2', 'y2', 'cx', 'cy', 'r', 'rx', 'ry',
+                  'width', 'height', 'dx', 'dy')
+# Presentation properties that do not inherit; a group carrying them is not a no-op
+GROUP_ONLY_PROPERTIES = ('opacity', 'filter', 'mask', 'clip-path', 'isolation', 'mix-blend-mode')
+# Elements that draw nothing once they have no children, text or path data
+STRUCTURAL_TAGS = ('defs', 'g', 'path', 'text', 'tspan', 'symbol', 'clipPath', 'mask', 'marker')
+
+
+def _round_numbers(value, precision):
+    if '.' not in value and 'e' not in value and 'E' not in value:
+        return value
+    
+    def fmt(match):
+        text = match.group(0)
+        if '.' not in text and 'e' not in text.lower():
+            return text
+        rounded = f"{round(float(text), precision):.{precision}f}".rstrip('0').rstrip('.')
+        return '0' if rounded in ('', '-0') else rounded
+    return NUMBER_RE.sub(fmt, value)
+
+
+def _referenced_ids(root):
+    ids = set()
+    url_re = re.compile(r'url\(\s*["\']?#([^)"\']+)')
+    for element in root.iter():
+        if _local_name(element) is None:
+            continue
+        for name, value in element.attrib.items():
+            if name.endswith('href') and value.startswith('#'):
+                ids.add(value[1:])
+            elif 'url(' in value:
+                ids.update(url_re.findall(value))
+    return ids
+
+
+def optimize_svg(root, precision=3, class_prefix='mermaid-style-'):
+    """Shrink verbose converter output in place before it is inserted.
+    
+    Drops empty elements and unreferenced auto-generated IDs, unwraps
+    no-op groups (folding a transform-only group into its children and a
+    single-child style group into its child), folds pure translations into
+    path data and ``<use>`` x/y, rounds coordinates to ``precision``
+    decimals, and replaces repeated ``style`` attributes with classes.
+    Returns the element counts before and after.
+    """
+    from lxml import etree
+    raw = etree._Element  # bypass inkex's per-call bookkeeping on large trees
+    before = sum(1 for _ in root.iter())
+    referenced = _referenced_ids(root)
+    skip = NON_RENDERED_TAGS[1:] + ('foreignObject', 'script', 'title', 'desc')
+    
+    def children(element):
+        return [c for c in element if isinstance(c.tag, str)]
+    
+    def walk(element, in_defs):
+        """Post-order pass; returns False when ``element`` was removed."""
+        name = _local_name(element)
+        if name in skip:
+            return True
+        inside_defs = in_defs or name == 'defs'
+        for child in children(element):
+            walk(child, inside_defs)
+        
+        attrib = element.attrib
+        element_id = attrib.get('id')
+        if element_id and element_id not in referenced and AUTO_ID_RE.match(element_id):
+            del attrib['id']
+            element_id = None
+        
+        parent = element.getparent()
+        if parent is None:
+            return True
+        
+        # Empty containers and shapes draw nothing
+        empty = (name in STRUCTURAL_TAGS and not len(element) and not (element.text or '').strip()
+                 and (name != 'path' or not attrib.get('d', '').strip()))
+        if name == 'rect':
+            empty = any(_round_numbers(attrib.get(side, '0'), precision) in ('0', '')
+                        for side in ('width', 'height'))
+        if empty and not element_id:
+            raw.remove(parent, element)
+            return False
+        
+        if name == 'g' and not element_id and not inside_defs:
+            keys = attrib.keys()
+            kids = children(element)
+            if not keys or (keys == ['transform'] and kids):
+                if keys:
+                    transform = inkex.Transform(attrib['transform'])
+                    for kid in kids:
+                        kid_transform = kid.attrib.get('transform')
+                        kid.attrib['transform'] = str(transform @ inkex.Transform(kid_transform) if kid_transform
+                                                      else transform)
+                for kid in list(element):
+                    raw.addprevious(element, kid)
+                raw.remove(parent, element)
+                return False
+            if keys == ['style'] and len(kids) == 1 and len(element) == 1:
+                outer = parse_css_declarations(attrib['style'])
+                inner = parse_css_declarations(kids[0].attrib.get('style', ''))
+                if not set(outer) & set(inner) and not set(outer) & set(GROUP_ONLY_PROPERTIES):
+                    kids[0].attrib['style'] = ';'.join(
+                        f"{k}:{v}{' !important' if imp else ''}" for k, (v, imp) in {**outer, **inner}.items())
+                    raw.addprevious(element, kids[0])
+                    raw.remove(parent, element)
+                    return False
+        
+        # Fold translations into the geometry itself, unless a clip path or
+        # userSpaceOnUse paint server would have moved along with it
+        transform = attrib.get('transform')
+        if transform and name in ('path', 'use') and not any('url(' in v for v in attrib.values()):
+            matrix = inkex.Transform(transform)
+            if (matrix.a, matrix.b, matrix.c, matrix.d) == (1, 0, 0, 1):
+                if name == 'path' and attrib.get('d'):
+                    attrib['d'] = str(inkex.Path(attrib['d']).translate(matrix.e, matrix.f))
+                    del attrib['transform']
+                elif name == 'use':
+                    attrib['x'] = str(float(attrib.get('x', 0)) + matrix.e)
+                    attrib['y'] = str(float(attrib.get('y', 0)) + matrix.f)
+                    del attrib['transform']
+        
+        for geometry in GEOMETRY_ATTRS:
+            value = attrib.get(geometry)
+            if value:
+                attrib[geometry] = _round_numbers(value, precision)
+        return True
+    
+    for child in children(root):
+        walk(child, False)
+    
+    # Repeated inline styles become one CSS class each
+    counts = {}
+    for element in root.iter():
+        if _local_name(element) not in (None,) + NON_RENDERED_TAGS:
+            style = element.attrib.get('style')
+            if style:
+                counts[style] = counts.get(style, 0) + 1
+    classes = {}
+    for style, count in counts.items():
+        if count > 1:
+            classes[style] = f"{class_prefix}{len(classes) + 1}"
+    if classes:
+        for element in root.iter():
+            if _local_name(element) in (None,) + NON_RENDERED_TAGS:
+                continue
+            name = classes.get(element.attrib.get('style'))
+            if name:
+                del element.attrib['style']
+                existing = element.attrib.get('class')
+                element.attrib['class'] = f"{existing} {name}" if existing else name
+        style_element = etree.Element(f'{{{SVG_NS}}}style')
+        style_element.text = '\n'.join(f".{name}{{{style}}}" for style, name in classes.items())
+        root.insert(0, style_element)
+    
+    return before, sum(1 for _ in root.iter())
+
+
+# Chromium lays PDFs out at 96 CSS px per inch, i.e. 0.75 pt per px
+PT_PER_CSS_PX = 0.75
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def png_size(data):
+    """Read ``(width, height)`` from a PNG's IHDR chunk, or None."""
+    if len(data) < 24 or data[:8] != PNG_SIGNATURE or data[12:16] != b'IHDR':
+        return None
+    return struct.unpack('>II', data[16:24])
+
+
+def png_data_uri(data):
+    """Return PNG bytes as a ``data:`` URI in ASCII bytes, ready for lxml.
+    
+    lxml copies attribute values into libxml2 anyway, so the fewest
+    full-size copies come from one C-level encode plus the prefix, kept as
+    bytes: building a str would add a decode and lxml's UTF-8 re-encode.
+    """
+    return b'data:image/png;base64,' + binascii.b2a_base64(data, newline=False)
+
+
+PDF_MEDIABOX_RE = re.compile(rb'/MediaBox\s*\[\s*([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s+([-\d.]+)\s*\]')
+
+
+def pdf_page_size(pdf_data):
+    """Return the first page's MediaBox ``(width, height)`` in pt, or None."""
+    match = PDF_MEDIABOX_RE.search(pdf_data)
+    if not match:
+        return None
+    x0, y0, x1, y1 = (float(v) for v in match.groups())
+    return x1 - x0, y1 - y0
+
+
+def tile_grid(width, height, tile_size):
+    """Split a ``width`` x ``height`` px raster into ``(x0, y0, x1, y1)`` tiles, row by row."""
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height))
+            for y in range(0, height, tile_size) for x in range(0, width, tile_size)]
+
+
+def mosaic_svg(width, height, tiles):
+    """Pack PNG tiles ``[(x, y, data)]`` into a small SVG artifact.
+    
+    The whole raster never exists as one bitmap; the mosaic is cached and
+    inserted like a PNG, one ``<image>`` per tile.
+    """
+    parts = [f'<svg xmlns="{SVG_NS}" xmlns:xlink="{XLINK_NS}" class="mermaid-mosaic" '
+             f'width="{width}" height="{height}">'.encode('utf-8')]
+    for x, y, data in tiles:
+        tile_width, tile_height = png_size(data)
+        parts.append(f'<image x="{x}" y="{y}" width="{tile_width}" height="{tile_height}" '
+                     f'xlink:href="'.encode('utf-8') + png_data_uri(data) + b'"/>')
+    parts.append(b'</svg>')
+    return b'\n'.join(parts)
+
+
+# Linked rasters are named by content, so identical renders share one file
+ASSET_NAME_RE = re.compile(r'mermaid-[0-9a-f]{16}\.png$')
+
+
+def store_asset(asset_dir, data):
+    """Write PNG bytes to ``asset_dir`` under a content-hash name; returns the path.
+    
+    An existing file with the same name already holds the same bytes and
+    is reused as is.
+    """
+    os.makedirs(asset_dir, exist_ok=True)
+    path = os.path.join(asset_dir, f"mermaid-{hashlib.sha256(data).hexdigest()[:16]}.png")
+    if not os.path.exists(path):
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return path
+
+
+MERMAID_EXTENSIONS = ('.mmd', '.mermaid')
+MARKDOWN_EXTENSIONS = ('.md', '.markdown')
+MARKDOWN_FENCE_RE = re.compile(r'^(?P<indent>[ \t]*)(?P<fence>`{3,}|~{3,})[ \t]*mermaid[ \t]*\n(?P<code>.*?)^(?P=indent)(?P=fence)[ \t]*$',
+                               re.M | re.S)
+
+
+def extract_markdown_diagrams(text):
+    """Return the code of every ```mermaid fenced block in Markdown text."""
+    return [m.group('code').strip() for m in MARKDOWN_FENCE_RE.finditer(text) if m.group('code').strip()]
+
+
+DIAGRAM_KEYWORDS = (
+    'graph', 'flowchart', 'sequenceDiagram', 'classDiagram', 'classDiagram-v2', 'stateDiagram',
+    'stateDiagram-v2', 'erDiagram', 'journey', 'gantt', 'pie', 'quadrantChart', 'requirementDiagram',
+    'gitGraph', 'C4Context', 'C4Container', 'C4Component', 'C4Dynamic', 'C4Deployment', 'mindmap',
+    'timeline', 'zenuml', 'sankey-beta', 'xychart-beta', 'block-beta', 'packet-beta', 'kanban',
+    'architecture-beta', 'radar-beta', 'treemap-beta', 'info')
+FLOWCHART_DIRECTIONS = ('TB', 'TD', 'BT', 'RL', 'LR')
+FLOWCHART_SKIP_STATEMENTS = ('click', 'style', 'classDef', 'class', 'linkStyle', 'accTitle', 'accDescr')
+SEQUENCE_BLOCKS = {'loop': (), 'alt': ('else',), 'opt': (), 'par': ('and',), 'par_over': ('and',),
+                   'critical': ('option',), 'break': (), 'rect': (), 'box': ()}
+BRACKET_PAIRS = {'[': ']', '(': ')', '{': '}'}
+# "A -- text --> B": an open link followed by text, and the link that ends the text
+EDGE_TEXT_OPEN_RE = re.compile(r'<?(?:--|==|-\.)(?![-=.>]|[xo](?!\w))')
+EDGE_TEXT_CLOSE_RE = re.compile(r'(?:-{2,}|={2,})(?:[->=]|[xo](?!\w))|\.-+>?')
+# Text that can stand right before a node ID: nothing, '&', a closed '|label|' or a link
+NODE_PREFIX_RE = re.compile(r'(?:^|&|\||[-=.~]{2,}[>xo]?|[-=.]>)$')
+ACC_DESCR_BLOCK_RE = re.compile(r'accDescr\s*\{')
+
+
+class MermaidSyntaxError(ValueError):
+    """Raised by validate_mermaid; ``diagnostics`` holds (line, column, message)."""
+    
+    def __init__(self, diagnostics, lines):
+        self.diagnostics = diagnostics
+        parts = []
+        for line, column, message in diagnostics:
+            parts.append(f"line {line}, column {column}: {message}")
+            if 0 < line <= len(lines):
+                parts.append("    " + lines[line - 1].expandtabs(4))
+                parts.append("    " + " " * (column - 1) + "^")
+        super().__init__("\n".join(parts))
+
+
+def _edit_distance(a, b):
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        previous = current
+    return previous[-1]
+
+
+def _statements(line, number):
+    """Yield (line, column, text) for each ``;``-separated statement (see mermaid_lite.statement_spans)."""
+    for start, end in mermaid_lite.statement_spans(line):
+        yield number, start + 1, line[start:end]
+
+
+def _logical_lines(lines, first, join_quotes=False):
+    """Yield (line number, text) for the lines after the header.
+    
+    Comments and multi-line ``accDescr { ... }`` blocks are dropped. With
+    ``join_quotes``, a string left open at the end of a line (e.g. a
+    markdown string) continues on the next ones, which are joined to it.
+    """
+    index = first + 1
+    while index < len(lines):
+        number, text = index + 1, lines[index]
+        index += 1
+        stripped = text.strip()
+        if stripped.startswith('%%'):
+            continue
+        if ACC_DESCR_BLOCK_RE.match(stripped) and '}' not in stripped:
+            while index < len(lines) and '}' not in lines[index]:
+                index += 1
+            index += 1
+            continue
+        while join_quotes and text.count('"') % 2 and index < len(lines):
+            text += ' ' + lines[index]
+            index += 1
+        yield number, text
+
+
+def _check_flowchart_statement(number, column, text, errors):
+    """Bracket, quote and link-text balance for one flowchart statement.
+    
+    Inside a node label only the label's own bracket kind nests (so
+    ``A([x])`` and ``A[(x)]`` are fine); everything in quotes, and the
+    text of ``A -- text --> B`` links, is text.
+    """
+    stack = []  # (closer, column)
+    index = 0
+    pipe_column = None
+    edge_text = False
+    while index < len(text):
+        char = text[index]
+        if edge_text:
+            match = EDGE_TEXT_CLOSE_RE.match(text, index)
+            edge_text = match is None
+            index = match.end() if match else index + 1
+            continue
+        if char == '"':
+            end = text.find('"', index + 1)
+            if end < 0:
+                errors.append((number, column + index, "unterminated string"))
+                return
+            index = end + 1
+            continue
+        if pipe_column is not None:
+            if char == '|':
+                pipe_column = None
+        elif stack:
+            closer = stack[-1][0]
+            if char == closer:
+                stack.pop()
+            elif char in BRACKET_PAIRS and BRACKET_PAIRS[char] == closer:
+                stack.append((closer, column + index))
+        elif char in BRACKET_PAIRS:
+            stack.append((BRACKET_PAIRS[char], column + index))
+        elif (char in '<-=' and (not index or text[index - 1] not in '<-=.')
+              and EDGE_TEXT_OPEN_RE.match(text, index)):
+            edge_text = True
+            index = EDGE_TEXT_OPEN_RE.match(text, index).end()
+            continue
+        elif char == '>' and re.search(r'\w$', text[:index]):
+            # Asymmetric node (id>label]), only where a node ID can start
+            node_id = re.search(r'\w+$', text[:index])
+            if NODE_PREFIX_RE.search(text[:node_id.start()].rstrip()):
+                stack.append((']', column + index))
+        elif char in ')]}':
+            errors.append((number, column + index, f"unexpected '{char}' with no matching opening bracket"))
+            return
+        elif char == '|':
+            pipe_column = column + index
+        index += 1
+    if stack:
+        closer, opened = stack[0]
+        errors.append((number, opened, f"node shape opened here is never closed (expected '{closer}')"))
+    elif pipe_column is not None:
+        errors.append((number, pipe_column, "link text opened with '|' is never closed"))
+    else:
+        outside = re.sub(r'"[^"]*"|\|[^|]*\||\[[^\]]*\]|\([^)]*\)|\{[^}]*\}', lambda m: ' ' * len(m.group()), text)
+        links = re.findall(r'[-=.<>~]{2,}', outside)
+        if links and all(link in ('->', '=>') for link in links):
+            offset = re.search(r'(?<![-=.])[-=]>', outside).start()
+            errors.append((number, column + offset, "flowchart links need two dashes or equals signs "
+                                                    "('-->' or '==>')"))
+
+
+def _check_flowchart(lines, first, errors):
+    header = lines[first].split()
+    if len(header) > 1 and re.fullmatch(r'[A-Z]{2}', header[1]) and header[1] not in FLOWCHART_DIRECTIONS:
+        errors.append((first + 1, lines[first].index(header[1]) + 1,
+                       f"unknown direction '{header[1]}' (use TB, TD, BT, LR or RL)"))
+    subgraphs = []
+    for line_number, raw in _logical_lines(lines, first, join_quotes=True):
+        for number, column, text in _statements(raw, line_number):
+            stripped = text.strip()
+            if not stripped:
+                continue
+            column += len(text) - len(text.lstrip())
+            word = re.split(r'[\s:{]', stripped, maxsplit=1)[0]
+            if word == 'subgraph':
+                subgraphs.append((number, column))
+                continue
+            if word == 'end' and stripped == 'end':
+                if not subgraphs:
+                    errors.append((number, column, "'end' without a matching 'subgraph'"))
+                else:
+                    subgraphs.pop()
+                continue
+            if word in FLOWCHART_SKIP_STATEMENTS or word.startswith('direction'):
+                continue
+            _check_flowchart_statement(number, column, text.lstrip(), errors)
+    for number, column in subgraphs:
+        errors.append((number, column, "'subgraph' is never closed with 'end'"))
+
+
+def _check_sequence(lines, first, errors):
+    blocks = []  # (keyword, line, column)
+    for number, raw in _logical_lines(lines, first):
+        index = number - 1
+        stripped = raw.strip()
+        if not stripped:
+            continue
+        column = len(raw) - len(raw.lstrip()) + 1
+        word = re.split(r'[\s:]', stripped, maxsplit=1)[0]
+        if word in SEQUENCE_BLOCKS:
+            blocks.append((word, index + 1, column))
+            continue
+        if word == 'end' and stripped == 'end':
+            if not blocks:
+                errors.append((index + 1, column, "'end' without an open loop/alt/opt/par/critical/break/rect/box"))
+            else:
+                blocks.pop()
+            continue
+        if word in ('else', 'and', 'option'):
+            if not blocks or word not in SEQUENCE_BLOCKS[blocks[-1][0]]:
+                errors.append((index + 1, column, f"'{word}' outside of "
+                               + {'else': "an 'alt'", 'and': "a 'par'", 'option': "a 'critical'"}[word] + " block"))
+            continue
+    for word, number, column in blocks:
+        errors.append((number, column, f"'{word}' is never closed with 'end'"))
+
+
+def _check_braces(lines, first, errors, skip_blocks=()):
+    """Match ``{``/``}`` across lines (class bodies, composite states).
+    
+    Free text after a ``:`` (descriptions, members, one-line notes) is not
+    structure, so braces there are ignored.
+    """
+    stack = []
+    skipping = None
+    for number, raw in _logical_lines(lines, first):
+        index = number - 1
+        stripped = raw.strip()
+        if skipping:
+            if stripped == skipping:
+                skipping = None
+            continue
+        for start, end in skip_blocks:
+            if re.match(start, stripped) and ':' not in stripped:
+                skipping = end
+                break
+        if skipping:
+            continue
+        quoted = False
+        for offset, char in enumerate(raw):
+            if char == '"':
+                quoted = not quoted
+            elif quoted:
+                continue
+            elif char == ':':
+                break
+            elif char == '{':
+                stack.append((index + 1, offset + 1))
+            elif char == '}':
+                if not stack:
+                    errors.append((index + 1, offset + 1, "unexpected '}' with no matching '{'"))
+                    return
+                stack.pop()
+    for number, column in stack:
+        errors.append((number, column, "'{' is never closed"))
+
+
+def validate_mermaid(code):
+    """Check Mermaid source for errors Mermaid itself would reject.
+    
+    Only definite mistakes are reported (unknown or misspelt diagram type,
+    unbalanced brackets, quotes and link text, unmatched ``subgraph``/``end``
+    and block ``end``s, malformed arrows), so valid input never fails here.
+    Raises MermaidSyntaxError listing every problem found.
+    """
+    lines = code.splitlines()
+    errors = []
+    index = 0
+    # Skip front matter, directives and comments before the header
+    if index < len(lines) and lines[index].strip() == '---':
+        index += 1
+        while index < len(lines) and lines[index].strip() != '---':
+            index += 1
+        index += 1
+    while index < len(lines):
+        stripped = lines[index].strip()
+        if stripped.startswith('%%{'):
+            while index < len(lines) and '}%%' not in lines[index]:
+                index += 1
+            index += 1
+            continue
+        if not stripped or stripped.startswith('%%'):
+            index += 1
+            continue
+        break
+    if index >= len(lines):
+        raise MermaidSyntaxError([(1, 1, "no diagram found")], lines)
+    
+    raw = lines[index]
+    column = len(raw) - len(raw.lstrip()) + 1
+    keyword = re.split(r'[\s;:{]', raw.strip(), maxsplit=1)[0]
+    if keyword not in DIAGRAM_KEYWORDS:
+        # Unknown words may be diagram types newer than this list; only flag likely typos
+        close = [known for known in DIAGRAM_KEYWORDS
+                 if _edit_distance(keyword.lower(), known.lower()) <= max(1, min(2, len(known) // 4))]
+        if close:
+            raise MermaidSyntaxError([(index + 1, column, f"unknown diagram type '{keyword}' "
+                                                          f"(did you mean '{close[0]}'?)")], lines)
+        return
+    
+    if keyword in ('graph', 'flowchart'):
+        _check_flowchart(lines, index, errors)
+    elif keyword == 'sequenceDiagram':
+        _check_sequence(lines, index, errors)
+    elif keyword in ('classDiagram', 'classDiagram-v2'):
+        _check_braces(lines, index, errors)
+    elif keyword in ('stateDiagram', 'stateDiagram-v2'):
+        _check_braces(lines, index, errors, skip_blocks=((r'note\s', 'end note'),))
+    if errors:
+        errors.sort()
+        raise MermaidSyntaxError(errors, lines)
+
+
+# Stages that do not nest others, so their child CPU can be summed safely
+LEAF_STAGES = ('check_cli', 'scan', 'cache', 'validate', 'render', 'convert', 'dimensions', 'parse',
+               'postprocess', 'optimize', 'defs', 'insert', 'assets')
+
+# Thread-local list that timed_stage also appends to, for per-job timings,
+# plus the stack of open stages that annotate_stage writes into
+STAGE_SINK = threading.local()
+
+# Thread-local options of the fan-out variant being rendered, and the memo
+# of work its sibling variants share
+VARIANT_STATE = threading.local()
+
+OUTPUT_FORMATS = ('svg', 'svg_native', 'png', 'png_native')
+# Options a variant sets, in the order of its ``theme:format:quality:background`` fields
+VARIANT_FIELDS = ('theme', 'output_format', 'quality', 'background')
+# Options the Mermaid CLI PDF depends on; variants that agree share one PDF
+PDF_OPTIONS = ('theme', 'background', 'fit_to_content', 'width', 'height', 'scale_factor')
+
+
+def parse_variant(entry):
+    """Parse ``theme[:format[:quality[:background]]]`` into (name, overrides).
+    
+    Empty fields keep the current option, so ``dark``, ``:png:3`` and
+    ``neutral:svg::transparent`` are all valid. Raises ValueError.
+    """
+    fields = [field.strip() for field in entry.strip().split(':', len(VARIANT_FIELDS) - 1)]
+    overrides = {}
+    for name, value in zip(VARIANT_FIELDS, fields):
+        if not value:
+            continue
+        if name == 'theme' and value not in mermaid_lite.THEMES:
+            raise ValueError(f"unknown theme '{value}' in variant '{entry.strip()}'")
+        if name == 'output_format' and value not in OUTPUT_FORMATS:
+            raise ValueError(f"unknown format '{value}' in variant '{entry.strip()}' "
+                             f"(use {', '.join(OUTPUT_FORMATS)})")
+        if name == 'quality':
+            if not value.isdigit() or not 1 <= int(value) <= 4:
+                raise ValueError(f"quality must be 1-4 in variant '{entry.strip()}'")
+            value = int(value)
+        overrides[name] = value
+    if not overrides:
+        raise ValueError("empty variant")
+    return ':'.join(fields).rstrip(':'), overrides
+
+
+def parse_variants(spec):
+    """Parse variants separated by ';' or newlines into (name, overrides) pairs."""
+    variants = []
+    for entry in re.split(r'[;\n]', spec):
+        if not entry.strip():
+            continue
+        name, overrides = parse_variant(entry)
+        if any(name == seen for seen, _ in variants):
+            raise ValueError(f"variant '{name}' given twice")
+        variants.append((name, overrides))
+    return variants
+
+
+def variant_slug(name):
+    """File-name-safe form of a variant name (``dark:png:3`` -> ``dark-png-3``)."""
+    return re.sub(r'[^A-Za-z0-9._]+', '-', name).strip('-')
+
+
+def child_resource_usage():
+    """Return (cpu seconds, peak RSS in KB) of reaped child processes.
+    
+    The peak is a high-water mark over every child waited for so far, so a
+    stage only raises it when one of its own children used more memory.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak = usage.ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024  # bytes on macOS, KB elsewhere
+    return usage.ru_utime + usage.ru_stime, peak
+
+
+def process_peak_rss_kb(pid):
+    """Peak RSS of a still-running process (Linux only), else None."""
+    try:
+        with open(f'/proc/{pid}/status', 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _proc_table():
+    """Return {pid: (ppid, pgid)} for every process (Linux /proc), else {}."""
+    table = {}
+    try:
+        entries = os.listdir('/proc')
+    except OSError:
+        return table
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'rb') as f:
+                stat = f.read()
+            # The command name may contain spaces and parentheses
+            fields = stat[stat.rindex(b')') + 2:].split()
+            table[int(entry)] = (int(fields[1]), int(fields[2]))
+        except (OSError, ValueError, IndexError):
+            continue
+    return table
+
+
+def process_tree_pids(root_pid):
+    """PIDs of ``root_pid``, its descendants and its process group (Linux).
+    
+    The process group catches helpers that were re-parented to init after
+    their parent died, such as Chromium's renderer and GPU processes.
+    """
+    table = _proc_table()
+    tree = {root_pid} if root_pid in table else set()
+    changed = True
+    while changed:
+        changed = False
+        for pid, (ppid, pgid) in table.items():
+            if pid not in tree and (ppid in tree or pgid == root_pid):
+                tree.add(pid)
+                changed = True
+    return tree
+
+
+def process_tree_rss_kb(root_pid):
+    """Current total RSS of a process tree in KB, or None where unsupported."""
+    pids = process_tree_pids(root_pid)
+    if not pids:
+        return None
+    page_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+    total = 0
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/statm', 'rb') as f:
+                total += int(f.read().split()[1]) * page_kb
+        except (OSError, ValueError, IndexError):
+            continue
+    return total
+
+
+def kill_process_tree(process):
+    """Kill a process started by run_tool together with everything it spawned."""
+    if os.name == 'nt':
+        subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        pids = process_tree_pids(process.pid)
+        try:
+            # run_tool starts every tool in its own session, so pgid == pid
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+    try:
+        process.kill()
+        process.wait(timeout=5)
+    except (OSError, subprocess.TimeoutExpired):
+        pass
+
+
+def tool_popen_args():
+    """Popen arguments that put a tool and its children in their own group."""
+    if os.name == 'nt':
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+
+class TreeRssSampler:
+    """Track the peak RSS of a process tree while the block runs (Linux)."""
+    
+    INTERVAL = 0.1
+    
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_kb = None
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def sample(self):
+        rss = process_tree_rss_kb(self.pid)
+        if rss is not None and (self.peak_kb is None or rss > self.peak_kb):
+            self.peak_kb = rss
+    
+    def __enter__(self):
+        if sys.platform.startswith('linux'):
+            def run():
+                while not self._stop.wait(self.INTERVAL):
+                    self.sample()
+            self.sample()
+            self._thread = threading.Thread(target=run, daemon=True)
+            self._thread.start()
+        return self
+    
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return False
+
+
+def run_tool(cmd, input=None, timeout=None, shell=False, job=None):
+    """Run a tool like ``subprocess.run(capture_output=True)``.
+    
+    On timeout the whole process tree is killed, not just the direct child,
+    before TimeoutExpired is raised. With a scheduler ``job`` the process is
+    registered for cancellation and its tree's peak RSS is recorded in
+    ``job['peak_rss_kb']``.
+    """
+    process = subprocess.Popen(cmd,
+                               stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE,
+                               shell=shell,
+                               **tool_popen_args())
+    if job is not None:
+        job['process'] = process
+    try:
+        with TreeRssSampler(process.pid) as sampler:
+            try:
+                stdout, stderr = process.communicate(input, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                kill_process_tree(process)
+                process.communicate()
+                raise
+            except BaseException:
+                kill_process_tree(process)
+                raise
+    finally:
+        if job is not None:
+            job['process'] = None
+            job['peak_rss_kb'] = sampler.peak_kb
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+def available_memory_kb():
+    """Memory available to new processes in KB, or None if unknown."""
+    try:
+        with open('/proc/meminfo', 'r', encoding='ascii') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.sysconf('SC_PHYS_PAGES') * os.sysconf('SC_PAGE_SIZE') // 1024
+    except (AttributeError, OSError, ValueError):
+        return None
+
+
+def diagram_type(mermaid_code):
+    """First keyword of the diagram header ('flowchart', 'gantt', ...)."""
+    for line in mermaid_code.splitlines():
+        line = line.strip()
+        if line and not line.startswith('%%') and line != '---':
+            word = re.split(r'[\s;:{]', line, maxsplit=1)[0]
+            return 'flowchart' if word == 'graph' else word
+    return ''
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobScheduler:
+    """Admit tool processes by worker count and an estimated memory budget.
+    
+    A job's cost is a learned base for its kind and diagram type plus a
+    per-byte term for its input size. The base is refined from the peak
+    RSS of each finished job's process tree and kept in ``state_path``
+    between runs. Waiting jobs start by priority (higher first), then in
+    arrival order. A job always starts when nothing else is running, so a
+    job estimated above the whole budget still runs, just alone.
+    """
+    
+    # Fresh Chromium via mmdc, fresh or warm Inkscape; KB
+    DEFAULT_BASE_KB = {'render': 300 * 1024, 'convert': 150 * 1024}
+    # Growth with input size: Mermaid source bytes for renders, PDF bytes for conversions
+    PER_BYTE_KB = {'render': 4.0, 'convert': 0.5}
+    MIN_BASE_KB = 20 * 1024
+    LEARNING_RATE = 0.5
+    
+    def __init__(self, max_jobs, budget_kb=None, state_path=None):
+        self.max_jobs = max(1, max_jobs)
+        self.budget_kb = budget_kb
+        self.state_path = state_path
+        self.condition = threading.Condition()
+        self.waiting = []  # heap of (-priority, sequence)
+        self.sequence = 0
+        self.running = {}
+        self.in_use_kb = 0
+        self.cancelled = False
+        self.learned = {}
+        self.dirty = False
+        if state_path:
+            try:
+                with open(state_path, 'r', encoding='utf-8') as f:
+                    self.learned = {k: float(v) for k, v in json.load(f).items()}
+            except (OSError, ValueError, AttributeError, TypeError):
+                self.learned = {}
+    
+    def estimate_kb(self, kind, size, label=''):
+        base = self.learned.get(f"{kind}:{label}", self.DEFAULT_BASE_KB[kind])
+        return int(base + self.PER_BYTE_KB[kind] * size)
+    
+    def admits(self, cost_kb):
+        if not self.running:
+            return True
+        if len(self.running) >= self.max_jobs:
+            return False
+        return self.budget_kb is None or self.in_use_kb + cost_kb <= self.budget_kb
+    
+    @contextlib.contextmanager
+    def job(self, kind, size, label='', priority=0):
+        """Wait for a slot, then yield the job record for run_tool."""
+        cost = self.estimate_kb(kind, size, label)
+        job = {'kind': kind, 'cost_kb': cost, 'process': None, 'peak_rss_kb': None}
+        queued = time.monotonic()
+        with self.condition:
+            self.sequence += 1
+            ticket = (-priority, self.sequence)
+            heapq.heappush(self.waiting, ticket)
+            try:
+                while self.cancelled or self.waiting[0] != ticket or not self.admits(cost):
+                    if self.cancelled:
+                        raise JobCancelled(f"{kind} job cancelled")
+                    self.condition.wait()
+            except BaseException:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+                raise
+            heapq.heappop(self.waiting)
+            self.running[ticket] = job
+            self.in_use_kb += cost
+            # The next job in line may fit as well
+            self.condition.notify_all()
+        job['queued_s'] = time.monotonic() - queued
+        try:
+            yield job
+        finally:
+            with self.condition:
+                del self.running[ticket]
+                self.in_use_kb -= cost
+                if job['peak_rss_kb']:
+                    self.learn(kind, size, label, job['peak_rss_kb'])
+                self.condition.notify_all()
+    
+    def learn(self, kind, size, label, peak_kb):
+        key = f"{kind}:{label}"
+        observed = max(self.MIN_BASE_KB, peak_kb - self.PER_BYTE_KB[kind] * size)
+        base = self.learned.get(key, self.DEFAULT_BASE_KB[kind])
+        self.learned[key] = round(base + self.LEARNING_RATE * (observed - base))
+        self.dirty = True
+    
+    def cancel(self):
+        """Fail waiting jobs and kill the process trees of running ones."""
+        with self.condition:
+            self.cancelled = True
+            processes = [job['process'] for job in self.running.values() if job['process'] is not None]
+            self.condition.notify_all()
+        for process in processes:
+            kill_process_tree(process)
+    
+    def save(self):
+        if not self.state_path or not self.dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.learned, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.state_path)
+            self.dirty = False
+        except OSError:
+            pass
+
+
+def collect_diagram_sources(source):
+    """Expand a directory, glob or file into ordered (path, index, code) tuples.
+    
+    ``index`` numbers the ```mermaid fences of Markdown files (from 1) and
+    is None for plain Mermaid files.
+    """
+    source = os.path.expanduser(source)
+    if os.path.isdir(source):
+        paths = sorted(p for p in glob.glob(os.path.join(source, '*'))
+                       if os.path.splitext(p)[1].lower() in MERMAID_EXTENSIONS)
+    elif os.path.isfile(source):
+        paths = [source]
+    else:
+        paths = sorted(p for p in glob.glob(source, recursive=True) if os.path.isfile(p))
+    
+    diagrams = []
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            text = f.read()
+        if os.path.splitext(path)[1].lower() in MARKDOWN_EXTENSIONS:
+            for index, code in enumerate(extract_markdown_diagrams(text), 1):
+                diagrams.append((path, index, code))
+        elif text.strip():
+            diagrams.append((path, None, text.strip()))
+    return diagrams
+
+
+def read_diagram_source(path, block=None):
+    """Re-read one diagram: a whole Mermaid file or Markdown block ``block``."""
+    with open(path, 'r', encoding='utf-8') as f:
+        text = f.read()
+    if block is None:
+        return text.strip()
+    blocks = extract_markdown_diagrams(text)
+    return blocks[block - 1] if 0 < block <= len(blocks) else None
+
+
+# Every inserted diagram carries its source and render options in these
+# namespaced attributes, so "update" runs can find and refresh it later
+MERMAID_NS = 'https://github.com/YouvenZ/mermaid_ink'
+
+# Options that change the rendered artifact (part of the cache key) ...
+RENDER_OPTIONS = ('output_format', 'theme', 'background', 'fit_to_content',
+                  'width', 'height', 'scale_factor', 'quality', 'pdf_poppler', 'tile_size', 'renderer')
+# ... and those that only change how it is placed in the document
+PLACEMENT_OPTIONS = ('auto_scale', 'max_width', 'max_height', 'maintain_aspect_ratio', 'embed_image',
+                     'optimize_svg', 'svg_precision')
+
+
+# Point of the diagram's box that each position mode pins, as fractions of
+# its width and height; a finalized draft keeps this point where it was
+POSITION_ANCHORS = {
+    'top_left': (0, 0), 'top_center': (0.5, 0), 'top_right': (1, 0),
+    'middle_left': (0, 0.5), 'center': (0.5, 0.5), 'middle_right': (1, 0.5),
+    'bottom_left': (0, 1), 'bottom_center': (0.5, 1), 'bottom_right': (1, 1),
+    'cursor': (0, 0),
+}
+DRAFT_LABEL = "Mermaid Diagram (draft)"
+
+
+def mermaid_attr(name):
+    return f"{{{MERMAID_NS}}}{name}"
+
+
+def default_cache_dir():
+    """Return the per-user cache directory for rendered diagrams."""
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'inkscape-mermaid')
+
+
+class RenderCache:
+    """Content-addressed on-disk store of converted diagram artifacts.
+    
+    Entries are named ``<key>.<ext>`` where ``key`` is a SHA-256 over the
+    Mermaid source and every option that affects the output. The file
+    modification time doubles as the last-used stamp so eviction is plain
+    LRU without a separate index. Render threads share one instance:
+    hit/miss counts accumulate in memory until ``flush``, and the
+    directory is only scanned for eviction when the running size
+    estimate exceeds the cap.
+    """
+    
+    STATS_FILE = 'stats.json'
+    
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.counts = {}
+        self.size = None  # bytes on disk, from the last scan plus our own puts
+        os.makedirs(cache_dir, exist_ok=True)
+    
+    def path_for(self, key, ext):
+        return os.path.join(self.cache_dir, f"{key}.{ext}")
+    
+    def get(self, key, ext):
+        """Return the cached artifact bytes, or None on a miss."""
+        path = self.path_for(key, ext)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except OSError:
+            data = b''
+        if data:
+            try:
+                os.utime(path, None)
+            except OSError:
+                pass
+            self.record('hits')
+            return data
+        self.record('misses')
+        return None
+    
+    def put(self, key, ext, data):
+        """Store artifact bytes in the cache and enforce the size cap."""
+        path = self.path_for(key, ext)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if self.size is None:
+                self.evict()
+            else:
+                self.size += len(data)
+                if self.size > self.max_bytes:
+                    self.evict()
+        return path
+    
+    def evict(self):
+        """Remove least recently used entries until under ``max_bytes``.
+        
+        Rescans the directory, which also picks up other processes'
+        entries, and resets the size estimate. Called with ``lock`` held.
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cache_dir):
+            if name == self.STATS_FILE or name.endswith('.tmp'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+        
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.size = total
+    
+    def load_stats(self):
+        try:
+            with open(os.path.join(self.cache_dir, self.STATS_FILE), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'hits': 0, 'misses': 0}
+    
+    def stats(self):
+        """Counters on disk plus this run's, not yet flushed."""
+        stats = self.load_stats()
+        with self.lock:
+            for counter, count in self.counts.items():
+                stats[counter] = stats.get(counter, 0) + count
+        return stats
+    
+    def record(self, counter):
+        with self.lock:
+            self.counts[counter] = self.counts.get(counter, 0) + 1
+    
+    def flush(self):
+        """Add this run's counters to ``stats.json`` (once per run)."""
+        with self.lock:
+            counts, self.counts = self.counts, {}
+        if not counts:
+            return
+        stats = self.load_stats()
+        for counter, count in counts.items():
+            stats[counter] = stats.get(counter, 0) + count
+        path = os.path.join(self.cache_dir, self.STATS_FILE)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, path)
+        except OSError:
+            pass
+
+
+def tmpfs_dir():
+    """Return a writable RAM-backed directory (``/dev/shm``), or None."""
+    for path in ('/dev/shm', os.environ.get('XDG_RUNTIME_DIR', '')):
+        if path and os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+            return path
+    return None
+
+
+class ScratchSpace:
+    """One scratch directory per run, with a unique subdirectory per job.
+    
+    Concurrent renders (batch mode, the build CLI, or two Inkscape
+    instances sharing ``--temp_dir``) never see each other's
+    ``diagram.pdf``. Everything is removed by ``cleanup`` unless the
+    files are being kept for debugging.
+    """
+    
+    def __init__(self, parent=None, keep=False):
+        self.parent = parent
+        self.keep = keep
+        self.root = None
+        self.lock = threading.Lock()
+    
+    def job_dir(self):
+        with self.lock:
+            if self.root is None:
+                self.root = tempfile.mkdtemp(prefix=f'mermaid-{os.getpid()}-', dir=self.parent)
+        return tempfile.mkdtemp(prefix='job-', dir=self.root)
+    
+    def release(self, job_dir):
+        """Remove one job's files as soon as the job is done."""
+        if not self.keep:
+            shutil.rmtree(job_dir, ignore_errors=True)
+    
+    def cleanup(self):
+        with self.lock:
+            root, self.root = self.root, None
+        if root and not self.keep:
+            shutil.rmtree(root, ignore_errors=True)
+        return root
+
+
+def find_mermaid_cli_package(mermaid_cli_path):
+    """Locate the @mermaid-js/mermaid-cli package directory behind ``mmdc``."""
+    exe = shutil.which(mermaid_cli_path)
+    if not exe:
+        return None
+    current = os.path.dirname(os.path.realpath(exe))
+    while True:
+        package_json = os.path.join(current, 'package.json')
+        if os.path.exists(package_json):
+            try:
+                with open(package_json, 'r', encoding='utf-8') as f:
+                    if json.load(f).get('name') == '@mermaid-js/mermaid-cli':
+                        return current
+            except (OSError, ValueError):
+                pass
+        # Global npm installs link bin/mmdc -> lib/node_modules/@mermaid-js/mermaid-cli/src/cli.js,
+        # but some prefixes keep a plain wrapper script next to lib/
+        candidate = os.path.join(current, 'lib', 'node_modules', '@mermaid-js', 'mermaid-cli')
+        if os.path.exists(os.path.join(candidate, 'package.json')):
+            return candidate
+        parent = os.path.dirname(current)
+        if parent == current:
+            return None
+        current = parent
+
+
+class RenderWorkerClient:
+    """Client for the warm Puppeteer worker in ``mermaid_render_worker.mjs``.
+    
+    The worker listens on a Unix socket and accepts one JSON job per line.
+    It shuts itself down after an idle period, so the client starts it on
+    demand and simply reconnects on the next run.
+    """
+    
+    WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mermaid_render_worker.mjs')
+    
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._next_id = 0
+    
+    @staticmethod
+    def supported():
+        return hasattr(socket, 'AF_UNIX') and os.path.exists(RenderWorkerClient.WORKER_SCRIPT)
+    
+    def request(self, payload, timeout):
+        """Send one job and wait for its response."""
+        self._next_id += 1
+        payload = dict(payload, id=self._next_id)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(self.socket_path)
+            sock.sendall(json.dumps(payload).encode('utf-8') + b'\n')
+            buffer = b''
+            while b'\n' not in buffer:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    raise ConnectionError("Render worker closed the connection")
+                buffer += chunk
+        return json.loads(buffer.split(b'\n', 1)[0].decode('utf-8'))
+    
+    def ping(self):
+        try:
+            return self.request({'cmd': 'ping'}, timeout=2).get('ok', False)
+        except (OSError, ValueError):
+            return False
+    
+    def start(self, node_path, cli_dir, idle_timeout, max_jobs, wait=20.0):
+        """Launch a detached worker and wait until it accepts connections."""
+        cmd = [node_path, self.WORKER_SCRIPT,
+               '--socket', self.socket_path,
+               '--cli-dir', cli_dir,
+               '--idle-timeout', str(idle_timeout),
+               '--max-jobs', str(max_jobs)]
+        subprocess.Popen(cmd,
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL,
+                         start_new_session=True)
+        deadline = time.monotonic() + wait
+        while time.monotonic() < deadline:
+            if self.ping():
+                return True
+            time.sleep(0.1)
+        return False
+    
+    def render(self, job, timeout):
+        """Render a job; raises on transport errors, returns the response dict."""
+        return self.request(job, timeout=timeout + 5)
+
+
+class RenderServiceError(Exception):
+    """The render service answered, but could not render the diagram."""
+    
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class RenderServiceUnavailable(RenderServiceError):
+    """The render service could not be reached, or kept failing transiently."""
+
+
+class HttpRenderClient:
+    """Client for a Kroki-style HTTP render service, shared by all render threads.
+    
+    Each render is one ``POST`` of a JSON body (``diagram_source``,
+    ``diagram_type``, ``output_format``, ``diagram_options``) to the
+    service URL; the response body is the rendered file. Keep-alive
+    connections are pooled, one per concurrent request, so a batch pays
+    the TCP (and TLS) handshake once per worker instead of once per
+    diagram. Bodies are gzip-compressed until the service answers 415, or
+    a 4xx for a compressed body that the same body sent plain avoids.
+    Connection errors and 429/502/503/504 are retried with exponential
+    backoff capped at ``max_backoff`` seconds.
+    """
+    
+    TRANSIENT_STATUS = (429, 502, 503, 504)
+    
+    def __init__(self, url, timeout, retries=3, max_backoff=2.0):
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ValueError(f"not an http(s) URL: {url}")
+        self.url = url
+        self.https = parts.scheme == 'https'
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = (parts.path or '/') + (f"?{parts.query}" if parts.query else '')
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self.max_backoff = max_backoff
+        self.compress = True
+        self.pool = queue.LifoQueue()
+    
+    def connect(self):
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+    
+    def post(self, body, headers):
+        """One request on a pooled connection; returns (status, headers, body)."""
+        try:
+            connection, reused = self.pool.get_nowait(), True
+        except queue.Empty:
+            connection, reused = self.connect(), False
+        try:
+            connection.request('POST', self.path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = response.read()
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            connection.close()
+            if not reused:
+                raise
+            # The server closed an idle keep-alive connection; not a failure
+            return self.post(body, headers)
+        except BaseException:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            self.pool.put(connection)
+        return response.status, response, data
+    
+    def render(self, payload):
+        """Return the rendered bytes; raises RenderServiceError or RenderServiceUnavailable."""
+        body = json.dumps(payload).encode('utf-8')
+        attempt = 0
+        plain = False  # this request is being retried uncompressed
+        while True:
+            headers = {'Content-Type': 'application/json', 'Accept': '*/*'}
+            data, compressed = body, self.compress and not plain
+            if compressed:
+                data = gzip.compress(body, 6)
+                headers['Content-Encoding'] = 'gzip'
+            delay = min(self.max_backoff, 0.2 * 2 ** attempt)
+            try:
+                status, response, content = self.post(data, headers)
+            except (OSError, http.client.HTTPException) as e:
+                error = f"{type(e).__name__}: {e}"
+            else:
+                if status == 200:
+                    if plain:
+                        # Only the plain body worked: the service ignores Content-Encoding
+                        self.compress = False
+                    return content
+                message = content.decode('utf-8', 'replace').strip()[:2000] or f"HTTP {status}"
+                if status == 415 and compressed:
+                    # The service does not take compressed bodies; send them plain from now on
+                    self.compress = False
+                    continue
+                if compressed and 400 <= status < 500 and status not in self.TRANSIENT_STATUS:
+                    # A service that does not decode gzip fails to parse the body;
+                    # only an error for the plain body is the diagram's own
+                    plain = True
+                    continue
+                if status not in self.TRANSIENT_STATUS:
+                    raise RenderServiceError(message, status)
+                error = f"HTTP {status}: {message}"
+                try:
+                    delay = min(self.max_backoff, max(delay, float(response.getheader('Retry-After') or 0)))
+                except ValueError:
+                    pass
+            if attempt >= self.retries:
+                raise RenderServiceUnavailable(error)
+            time.sleep(delay)
+            attempt += 1
+    
+    def close(self):
+        while True:
+            try:
+                self.pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class MmdcBackend:
+    """Render with Mermaid CLI (or its warm worker) on this machine."""
+    
+    name = 'mmdc'
+    
+    def __init__(self, generator):
+        self.generator = generator
+    
+    def render(self, mermaid_code, output_type, work_dir, scale):
+        return self.generator.run_mermaid_cli(mermaid_code, output_type, work_dir, scale)
+    
+    def close(self):
+        pass
+
+
+class HttpBackend:
+    """Render on an HTTP service, falling back to local Mermaid CLI.
+    
+    The fallback is taken for the rest of the run once the service is
+    unreachable (after the client's retries), for diagrams that use config
+    or CSS files, which only exist on this machine, and for output types
+    the service does not offer for Mermaid (PDF). A service that answers
+    with an error, e.g. for a syntax error, is not retried locally.
+    """
+    
+    name = 'http'
+    output_types = ('svg', 'png')
+    
+    def __init__(self, generator, client):
+        self.generator = generator
+        self.client = client
+        self.fallback = MmdcBackend(generator)
+        self.down = False
+    
+    def render(self, mermaid_code, output_type, work_dir, scale):
+        generator = self.generator
+        opts = generator.options
+        if self.down or opts.config_file or opts.css_file or output_type not in self.output_types:
+            return self.render_locally(mermaid_code, output_type, work_dir, scale)
+        
+        diagram_options = {'theme': opts.theme, 'background-color': opts.background, 'scale': f'{scale:g}'}
+        if not opts.fit_to_content:
+            diagram_options.update(width=str(opts.width), height=str(opts.height))
+        payload = {
+            'diagram_source': mermaid_code,
+            'diagram_type': 'mermaid',
+            'output_format': output_type,
+            'diagram_options': diagram_options,
+        }
+        start = time.perf_counter()
+        try:
+            data = self.client.render(payload)
+        except RenderServiceUnavailable as e:
+            if not self.down:
+                self.down = True
+                inkex.errormsg(f"Render service {self.client.url} unreachable ({str(e)}), using local mmdc")
+            return self.render_locally(mermaid_code, output_type, work_dir, scale)
+        except RenderServiceError as e:
+            inkex.errormsg(f"Render service error (HTTP {e.status}):\n{str(e)}")
+            return None
+        generator.annotate_stage(backend='http', service_ms=round((time.perf_counter() - start) * 1000, 1))
+        return data or None
+    
+    def render_locally(self, mermaid_code, output_type, work_dir, scale):
+        if not self.generator.require_mermaid_cli(local=True):
+            return None
+        return self.fallback.render(mermaid_code, output_type, work_dir, scale)
+    
+    def close(self):
+        self.client.close()
+
+
+class Toolchain:
+    """Resolved ``mmdc``/``inkscape`` binaries with versions and capabilities.
+    
+    Probing means running ``--version`` and ``--help`` (a full Node or GTK
+    start each), so results are kept in a small JSON state file keyed by
+    the binary's resolved path, mtime and size. A tool is only re-probed
+    after it is upgraded, moved or replaced.
+    """
+    
+    STATE_FILE = 'toolchain.json'
+    
+    # Capability name -> text that must appear in the tool's --help output
+    MMDC_FEATURES = {
+        'pdf_fit': '--pdfFit',
+        'stdin_input': 'read from stdin',
+        'stdout_output': '--outputFormat',
+    }
+    INKSCAPE_FEATURES = {
+        'pdf_poppler': '--pdf-poppler',
+        'shell': '--shell',
+        'stdout_export': 'write to stdout',
+    }
+    
+    def __init__(self, state_dir):
+        self.state_path = os.path.join(state_dir, self.STATE_FILE) if state_dir else None
+        self.lock = threading.Lock()
+        self.state = self.load()
+        self.probed = {}
+    
+    def load(self):
+        if not self.state_path:
+            return {}
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+    
+    def save(self):
+        if not self.state_path:
+            return
+        tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, indent=1, sort_keys=True)
+            os.replace(tmp_path, self.state_path)
+        except OSError:
+            pass
+    
+    @staticmethod
+    def fingerprint(path):
+        """Resolve ``path`` on PATH; return (real path, identity) or (None, None)."""
+        exe = shutil.which(path)
+        if not exe:
+            return None, None
+        real = os.path.realpath(exe)
+        try:
+            st = os.stat(real)
+        except OSError:
+            return None, None
+        return exe, f"{real}|{st.st_mtime_ns}|{st.st_size}"
+    
+    def probe(self, kind, path, features, timeout, shell=False):
+        """Return the tool record ``{path, version, capabilities}`` or None."""
+        with self.lock:
+            exe, identity = self.fingerprint(path)
+            if exe is None:
+                return None
+            key = f"{kind}:{path}"
+            if key in self.probed:
+                return self.probed[key]
+            record = self.state.get(key)
+            if record and record.get('identity') == identity:
+                self.probed[key] = record
+                return record
+            
+            def run(flag):
+                result = subprocess.run([exe, flag],
+                                      capture_output=True,
+                                      text=True,
+                                      timeout=timeout,
+                                      shell=shell)
+                return result.returncode, (result.stdout or '') + (result.stderr or '')
+            
+            try:
+                code, version = run('--version')
+                if code != 0:
+                    return None
+                _, help_text = run('--help')
+            except (OSError, subprocess.TimeoutExpired):
+                return None
+            
+            record = {
+                'identity': identity,
+                'path': exe,
+                'version': version.strip().splitlines()[0] if version.strip() else '',
+                'capabilities': {name: needle in help_text for name, needle in features.items()},
+            }
+            self.state[key] = record
+            self.probed[key] = record
+            self.save()
+            return record
+    
+    def mermaid_cli(self, path):
+        return self.probe('mmdc', path, self.MMDC_FEATURES, timeout=30, shell=(os.name == 'nt'))
+    
+    def inkscape(self, path):
+        return self.probe('inkscape', path, self.INKSCAPE_FEATURES, timeout=60)
+
+
+class InkscapeShellError(Exception):
+    """The Inkscape shell session crashed, hung or rejected a command."""
+
+
+class InkscapeShell:
+    """One persistent ``inkscape --shell`` session driven with action lines.
+    
+    Inkscape prints no completion marker after an action line, so every
+    command is followed by ``inkscape-version`` and the reply is read up to
+    the version banner. A session that dies or times out is killed and
+    transparently restarted on the next command.
+    """
+    
+    # Reply of ``inkscape-version``; the startup banner must not match
+    MARKER_RE = re.compile(r'Inkscape \d+\.\d+')
+    
+    def __init__(self, inkscape_path, extra_args=()):
+        self.inkscape_path = inkscape_path
+        self.extra_args = list(extra_args)
+        self.process = None
+        self.output = None
+        self.restarts = -1
+    
+    def start(self):
+        self.process = subprocess.Popen([self.inkscape_path] + self.extra_args + ['--shell'],
+                                        stdin=subprocess.PIPE,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL,
+                                        text=True,
+                                        bufsize=1,
+                                        **tool_popen_args())
+        self.output = queue.Queue()
+        self.restarts += 1
+        
+        def pump(stream, sink):
+            for line in iter(stream.readline, ''):
+                sink.put(line)
+            sink.put(None)
+        
+        threading.Thread(target=pump, args=(self.process.stdout, self.output), daemon=True).start()
+    
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+    
+    def run(self, actions, timeout):
+        """Execute ``actions`` (a list of ``name:value`` strings) and wait."""
+        if not self.alive():
+            self.start()
+        try:
+            self.process.stdin.write('; '.join(actions) + '\n')
+            self.process.stdin.write('inkscape-version\n')
+            self.process.stdin.flush()
+        except OSError as e:
+            self.kill()
+            raise InkscapeShellError(f"Inkscape shell not accepting commands: {str(e)}")
+        
+        deadline = time.monotonic() + timeout
+        transcript = []
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.kill()
+                raise InkscapeShellError(f"Inkscape shell timeout ({timeout}s)")
+            try:
+                line = self.output.get(timeout=remaining)
+            except queue.Empty:
+                continue
+            if line is None:
+                self.kill()
+                raise InkscapeShellError("Inkscape shell exited:\n" + ''.join(transcript))
+            if self.MARKER_RE.search(line):
+                return ''.join(transcript)
+            transcript.append(line)
+    
+    def kill(self):
+        if self.process is not None:
+            kill_process_tree(self.process)
+            for stream in (self.process.stdin, self.process.stdout):
+                try:
+                    stream.close()
+                except OSError:
+                    pass
+        self.process = None
+    
+    def close(self):
+        if self.alive():
+            try:
+                self.process.stdin.write('quit\n')
+                self.process.stdin.flush()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                pass
+        self.kill()
+
 
 class MermaidGenerator(inkex.EffectExtension):
     """Extension to generate Mermaid diagrams."""
     
+    _init_lock = threading.Lock()
+    _cli_lock = threading.Lock()
+    
+    @property
+    def options(self):
+        """The run's options, or those of the variant this thread renders."""
+        return getattr(VARIANT_STATE, 'options', None) or self._options
+    
+    @options.setter
+    def options(self, value):
+        self._options = value
+    
     def add_arguments(self, pars):
         pars.add_argument("--tab", type=str, default="diagram", help="Active tab")
         
@@ -24,156 +2192,1291 @@ class MermaidGenerator(inkex.EffectExtension):
         pars.add_argument("--mermaid_code", type=str, default="", help="Mermaid code")
         pars.add_argument("--mermaid_file", type=str, default="", help="Mermaid file path")
         pars.add_argument("--use_file", type=inkex.Boolean, default=False, help="Use external file")
+        pars.add_argument("--draft", type=inkex.Boolean, default=False, help="Insert a quick proxy now, finalize later")
+        
+        # Style parameters
+        pars.add_argument("--theme", type=str, default="default", help="Mermaid theme")
+        pars.add_argument("--background", type=str, default="white", help="Background color")
+        pars.add_argument("--width", type=int, default=800, help="Width")
+        pars.add_argument("--height", type=int, default=600, help="Height")
+        
+        # Format parameters
+        pars.add_argument("--output_format", type=str, default="svg", help="Output format")
+        pars.add_argument("--scale_factor", type=float, default=1.0, help="Scale factor")
+        pars.add_argument("--quality", type=int, default=2, help="Quality level")
+        pars.add_argument("--variants", type=str, default="", help="Also render these theme:format:quality:background variants, ';'-separated")
+        pars.add_argument("--embed_image", type=inkex.Boolean, default=True, help="Embed image")
+        pars.add_argument("--asset_dir", type=str, default="", help="Directory for linked PNGs (default: <document>_assets)")
+        pars.add_argument("--asset_action", type=str, default="none", help="Convert existing PNG diagrams (none, pack or unpack)")
+        
+        # Enhanced positioning parameters
+        pars.add_argument("--position_mode", type=str, default="center", help="Position mode")
+        pars.add_argument("--offset_x", type=float, default=0.0, help="X offset")
+        pars.add_argument("--offset_y", type=float, default=0.0, help="Y offset")
+        pars.add_argument("--use_selection_bbox", type=inkex.Boolean, default=False, help="Position relative to selection")
+        pars.add_argument("--align_to_page", type=inkex.Boolean, default=True, help="Align to page or viewport")
+        
+        # Enhanced scaling parameters
+        pars.add_argument("--auto_scale", type=inkex.Boolean, default=False, help="Auto-scale to fit")
+        pars.add_argument("--max_width", type=int, default=0, help="Maximum width (0=no limit)")
+        pars.add_argument("--max_height", type=int, default=0, help="Maximum height (0=no limit)")
+        pars.add_argument("--maintain_aspect_ratio", type=inkex.Boolean, default=True, help="Maintain aspect ratio")
+        pars.add_argument("--lock_scale", type=inkex.Boolean, default=False, help="Lock object after insertion")
+        
+        # Config parameters
+        pars.add_argument("--mermaid_cli_path", type=str, default="mmdc", help="Mermaid CLI path")
+        pars.add_argument("--renderer", type=str, default="mmdc", help="Renderer (mmdc, or auto for built-in when supported)")
+        pars.add_argument("--render_backend", type=str, default="mmdc", help="Render backend (mmdc, or http for a render service)")
+        pars.add_argument("--render_url", type=str, default="http://localhost:8000", help="Kroki-style render service URL")
+        pars.add_argument("--render_retries", type=int, default=3, help="Retries for transient render service errors")
+        pars.add_argument("--use_puppeteer", type=inkex.Boolean, default=False, help="Use warm Puppeteer render worker")
+        pars.add_argument("--worker_socket", type=str, default="", help="Render worker socket path")
+        pars.add_argument("--worker_idle_timeout", type=int, default=300, help="Worker idle shutdown (seconds)")
+        pars.add_argument("--worker_max_jobs", type=int, default=100, help="Jobs before the worker recycles Chromium")
+        pars.add_argument("--config_file", type=str, default="", help="Config file")
+        pars.add_argument("--css_file", type=str, default="", help="CSS file")
+        
+        # Advanced parameters
+        pars.add_argument("--timeout", type=int, default=30, help="Timeout")
+        pars.add_argument("--validate_syntax", type=inkex.Boolean, default=True, help="Check Mermaid syntax before starting mmdc")
+        pars.add_argument("--viewport_width", type=int, default=1920, help="Viewport width")
+        pars.add_argument("--viewport_height", type=int, default=1080, help="Viewport height")
+        pars.add_argument("--keep_temp_files", type=inkex.Boolean, default=False, help="Keep temp files")
+        pars.add_argument("--temp_dir", type=str, default="", help="Temp directory")
+        pars.add_argument("--io_mode", type=str, default="pipe", help="Tool I/O (pipe or files)")
+        pars.add_argument("--scratch_tmpfs", type=inkex.Boolean, default=False, help="Keep scratch files in RAM (/dev/shm)")
+        pars.add_argument("--quiet_mode", type=inkex.Boolean, default=True, help="Quiet mode")
+        pars.add_argument("--trace_file", type=str, default="", help="Write a Chrome trace-event JSON file")
+        
+        # Render cache
+        pars.add_argument("--use_cache", type=inkex.Boolean, default=True, help="Reuse cached renders")
+        pars.add_argument("--cache_dir", type=str, default="", help="Cache directory")
+        pars.add_argument("--cache_size_mb", type=int, default=200, help="Cache size limit (MB)")
+        
+        # Inkscape options
+        pars.add_argument("--inkscape_path", type=str, default="inkscape", help="Inkscape executable path")
+        pars.add_argument("--pdf_poppler", type=inkex.Boolean, default=True, help="Use PDF poppler for import")
+        pars.add_argument("--fit_to_content", type=inkex.Boolean, default=True, help="Fit to content (no empty space)")
+        pars.add_argument("--optimize_svg", type=inkex.Boolean, default=False, help="Simplify imported SVG before insertion")
+        pars.add_argument("--svg_precision", type=int, default=3, help="Decimals kept in optimized coordinates")
+        pars.add_argument("--share_defs", type=inkex.Boolean, default=True, help="Share identical markers, gradients and glyphs between diagrams")
+        pars.add_argument("--converter", type=str, default="shell", help="Inkscape converter (shell or oneshot)")
+        pars.add_argument("--convert_timeout", type=int, default=60, help="Inkscape conversion timeout (seconds)")
+        pars.add_argument("--tile_size", type=int, default=0, help="Rasterize PNGs larger than this many px per side in tiles (0=off)")
+        
+        # Re-render diagrams already in the document
+        pars.add_argument("--update_mode", type=str, default="off", help="Update existing diagrams (off, all, selection or drafts)")
+        
+        # Batch rendering
+        pars.add_argument("--batch_source", type=str, default="", help="Directory, glob or Markdown file of diagrams")
+        pars.add_argument("--batch_jobs", type=int, default=4, help="Parallel renders in batch mode")
+        pars.add_argument("--memory_budget_mb", type=int, default=0, help="Memory for concurrent mmdc/Inkscape processes (0=half of available)")
+        pars.add_argument("--batch_layout", type=str, default="grid", help="Batch layout (grid or flow)")
+        pars.add_argument("--batch_columns", type=int, default=3, help="Columns in grid layout")
+        pars.add_argument("--batch_spacing", type=float, default=20.0, help="Gap between batch diagrams")
+        
+        # New: Layer management
+        pars.add_argument("--create_layer", type=inkex.Boolean, default=False, help="Create new layer for diagram")
+        pars.add_argument("--layer_name", type=str, default="Mermaid Diagrams", help="Layer name")
+        
+        # New: Object properties
+        pars.add_argument("--object_id", type=str, default="", help="Custom object ID")
+        pars.add_argument("--add_title", type=inkex.Boolean, default=False, help="Add title element")
+        pars.add_argument("--add_desc", type=inkex.Boolean, default=False, help="Add description element")
+    
+    def effect(self):
+        """Main effect function."""
+        try:
+            if self.options.asset_action != "none":
+                self.convert_assets()
+                return
+            
+            if self.options.update_mode != "off":
+                if self.options.renderer == "mmdc":
+                    with self.timed_stage('check_cli'):
+                        if not self.require_mermaid_cli():
+                            return
+                self.update_diagrams()
+                return
+            
+            if self.options.batch_source:
+                if self.options.renderer == "mmdc":
+                    with self.timed_stage('check_cli'):
+                        if not self.require_mermaid_cli():
+                            return
+                self.run_batch()
+                return
+            
+            # Get Mermaid code
+            if self.options.use_file and self.options.mermaid_file:
+                if not os.path.exists(self.options.mermaid_file):
+                    inkex.errormsg(f"File not found: {self.options.mermaid_file}")
+                    return
+                with open(self.options.mermaid_file, 'r', encoding='utf-8') as f:
+                    mermaid_code = f.read()
+            else:
+                mermaid_code = self.options.mermaid_code
+            
+            # Clean up the code
+            mermaid_code = mermaid_code.strip()
+            
+            if not mermaid_code:
+                inkex.errormsg("No Mermaid code provided!")
+                return
+            
+            if self.options.draft and not self.options.variants.strip() and not self.renders_in_process(mermaid_code):
+                self.diagram_code = mermaid_code
+                self.insert_draft(mermaid_code)
+                if not self.options.quiet_mode:
+                    inkex.errormsg("Stage timings: " + self.format_stage_times())
+                return
+            
+            # Check if mmdc is installed (not needed for built-in renders)
+            if not self.renders_in_process(mermaid_code):
+                with self.timed_stage('check_cli'):
+                    if not self.require_mermaid_cli():
+                        return
+            
+            # Store mermaid code for later use
+            self.diagram_code = mermaid_code
+            
+            if self.options.variants.strip():
+                self.run_variants(mermaid_code)
+                return
+            
+            artifact = self.render_diagram(mermaid_code)
+            if not artifact:
+                return
+            
+            with self.timed_stage('import', bytes_in=len(artifact)):
+                element = self.insert_artifact(artifact)
+            if element is not None:
+                source_file = self.options.mermaid_file if self.options.use_file else None
+                self.tag_diagram(element, mermaid_code, source_file)
+            
+            if not self.options.quiet_mode:
+                inkex.errormsg("Stage timings: " + self.format_stage_times())
+            
+        except Exception as e:
+            inkex.errormsg(f"Error: {str(e)}")
+            import traceback
+            inkex.errormsg(traceback.format_exc())
+        finally:
+            self.close_inkscape_shells()
+            self.close_scheduler()
+            self.close_render_backend()
+            self.close_cache()
+            self.cleanup_scratch()
+            self.write_trace()
+    
+    def load_batch_sources(self):
+        """Expand ``--batch_source`` into ordered (name, code, path, block) tuples.
+        
+        Accepts a directory of .mmd/.mermaid files, a glob pattern, or a
+        Markdown file whose ```mermaid fences each become one diagram.
+        """
+        diagrams = []
+        for path, index, code in collect_diagram_sources(self.options.batch_source):
+            name = os.path.basename(path)
+            if index is not None:
+                name = f"{name}#{index}"
+            diagrams.append((name, code, path, index))
+        return diagrams
+    
+    def run_batch(self):
+        """Render many diagrams concurrently and insert them as they complete."""
+        diagrams = self.load_batch_sources()
+        if not diagrams:
+            inkex.errormsg(f"No Mermaid diagrams found in: {self.options.batch_source}")
+            return
+        
+        # Start shared resources before threads race to create them
+        self.get_cache()
+        self.get_render_worker()
+        
+        base_id = self.options.object_id
+        failures = []
+        placed = []
+        
+        def insert(index, artifact):
+            # Runs on this thread in source order, so the layout never depends
+            # on which render finishes first
+            name, code, path, block = diagrams[index]
+            if not artifact:
+                failures.append(name)
+                return
+            self.diagram_code = code
+            if base_id:
+                self.options.object_id = f"{base_id}-{index + 1}"
+            with self.timed_stage('import', bytes_in=len(artifact)):
+                element = self.insert_artifact(artifact, position=(0, 0))
+            if element is not None:
+                self.tag_diagram(element, code, path, block)
+                placed.append((element, self.last_inserted_size))
+            else:
+                failures.append(name)
+        
+        try:
+            with self.timed_stage('pipeline', diagrams=len(diagrams)):
+                self.render_pipeline([(code, {}) for _, code, _, _ in diagrams], insert)
+        finally:
+            self.options.object_id = base_id
+        
+        self.layout_batch(placed)
+        
+        if failures:
+            inkex.errormsg(f"{len(failures)} of {len(diagrams)} diagrams failed: " + ", ".join(failures))
+        if not self.options.quiet_mode:
+            inkex.errormsg(f"Inserted {len(placed)} diagrams. Stage timings: " + self.format_stage_times())
+    
+    def layout_batch(self, placed):
+        """Move diagrams inserted at (0, 0) into a grid or flow arrangement."""
+        if not placed:
+            return
+        ref_x, ref_y, ref_width, _ = self.get_reference_bounds()
+        start_x = ref_x + self.options.offset_x
+        start_y = ref_y + self.options.offset_y
+        gap = self.options.batch_spacing
+        
+        positions = []
+        if self.options.batch_layout == "flow":
+            # Left to right, wrapping at the reference width
+            x, y, row_height = start_x, start_y, 0
+            for _, (width, height) in placed:
+                if x > start_x and x + width > ref_x + ref_width:
+                    x, y, row_height = start_x, y + row_height + gap, 0
+                positions.append((x, y))
+                x += width + gap
+                row_height = max(row_height, height)
+        else:
+            columns = max(1, self.options.batch_columns)
+            col_widths = [0] * columns
+            row_heights = [0] * ((len(placed) + columns - 1) // columns)
+            for index, (_, (width, height)) in enumerate(placed):
+                col_widths[index % columns] = max(col_widths[index % columns], width)
+                row_heights[index // columns] = max(row_heights[index // columns], height)
+            for index in range(len(placed)):
+                col, row = index % columns, index // columns
+                positions.append((start_x + sum(col_widths[:col]) + gap * col,
+                                  start_y + sum(row_heights[:row]) + gap * row))
+        
+        for (element, _), (x, y) in zip(placed, positions):
+            element.set('transform', f"translate({x},{y}) {element.get('transform') or ''}".strip())
+    
+    @contextlib.contextmanager
+    def variant_options(self, overrides, memo=None):
+        """Render on this thread with ``overrides`` applied to a copy of the options.
+        
+        Variants rendered with the same ``memo`` dict share their syntax
+        check and every PDF that does not depend on what they override.
+        """
+        previous = getattr(VARIANT_STATE, 'options', None), getattr(VARIANT_STATE, 'memo', None)
+        options = argparse.Namespace(**vars(self._options))
+        vars(options).update(overrides)
+        VARIANT_STATE.options = options
+        if memo is not None:
+            VARIANT_STATE.memo = memo
+        try:
+            yield options
+        finally:
+            VARIANT_STATE.options, VARIANT_STATE.memo = previous
+    
+    def shared_work(self, key, compute):
+        """Return ``compute()``, run once per ``key`` among a fan-out's variants."""
+        memo = getattr(VARIANT_STATE, 'memo', None)
+        if memo is None:
+            return compute()
+        with self._init_lock:
+            future = memo.get(key)
+            owner = future is None
+            if owner:
+                future = memo[key] = concurrent.futures.Future()
+        if not owner:
+            self.annotate_stage(shared=key[0])
+            return future.result()
+        try:
+            result = compute()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        return result
+    
+    def render_variants(self, mermaid_code, variants):
+        """Render one diagram in every variant; returns artifacts in variant order.
+        
+        Variants render concurrently. Those that differ only in output
+        format or PNG quality convert the same Mermaid CLI PDF, and the
+        source is checked once.
+        """
+        self.get_cache()
+        self.get_render_worker()
+        memo = {}
+        
+        def render(overrides):
+            with self.variant_options(overrides, memo):
+                return self.render_diagram(mermaid_code)
+        
+        artifacts = [None] * len(variants)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.options.batch_jobs)) as pool:
+            futures = {pool.submit(render, overrides): index
+                       for index, (_, overrides) in enumerate(variants)}
+            for future in concurrent.futures.as_completed(futures):
+                index = futures[future]
+                try:
+                    artifacts[index] = future.result()
+                except Exception as e:
+                    inkex.errormsg(f"{variants[index][0]}: {str(e)}")
+        return artifacts
+    
+    def run_variants(self, mermaid_code):
+        """Insert one diagram per variant, each in a layer named after it."""
+        try:
+            variants = parse_variants(self.options.variants)
+        except ValueError as e:
+            inkex.errormsg(f"Invalid variants: {str(e)}")
+            return
+        
+        with self.timed_stage('render', variants=len(variants)):
+            artifacts = self.render_variants(mermaid_code, variants)
+        
+        source_file = self.options.mermaid_file if self.options.use_file else None
+        base_id = self.options.object_id
+        failures = []
+        inserted = 0
+        with self.timed_stage('import'):
+            for index, ((name, overrides), artifact) in enumerate(zip(variants, artifacts)):
+                if not artifact:
+                    failures.append(name)
+                    continue
+                layer = dict(overrides, create_layer=True, layer_name=f"{self.options.layer_name}: {name}",
+                             object_id=f"{base_id}-{index + 1}" if base_id else '')
+                with self.variant_options(layer):
+                    element = self.insert_artifact(artifact)
+                    if element is None:
+                        failures.append(name)
+                        continue
+                    self.tag_diagram(element, mermaid_code, source_file, variant=name)
+                    inserted += 1
+        
+        if failures:
+            inkex.errormsg(f"{len(failures)} of {len(variants)} variants failed: " + ", ".join(failures))
+        if not self.options.quiet_mode:
+            inkex.errormsg(f"Inserted {inserted} variants. Stage timings: " + self.format_stage_times())
+    
+    def insert_draft(self, mermaid_code):
+        """Insert a quick stand-in now; "Finalize drafts" renders the real diagram.
+        
+        A full render already in the cache is inserted as is. Otherwise the
+        proxy is the built-in renderer's SVG when it handles the diagram,
+        else a 1x PNG straight from Mermaid CLI (no Inkscape), sized like
+        the final diagram will be. The proxy is tagged with the full render
+        options, so finalizing produces what a normal run would have.
+        """
+        source_file = self.options.mermaid_file if self.options.use_file else None
+        final = self.render_diagram(mermaid_code, cached_only=True)
+        if final:
+            with self.timed_stage('import', bytes_in=len(final)):
+                element = self.insert_artifact(final)
+            if element is not None:
+                self.tag_diagram(element, mermaid_code, source_file)
+            return element
+        
+        if mermaid_lite.supports(mermaid_code, self.options.theme):
+            proxy_options = {'renderer': 'auto', 'output_format': 'svg', 'fit_to_content': True,
+                             'config_file': '', 'css_file': ''}
+        else:
+            with self.timed_stage('check_cli'):
+                if not self.require_mermaid_cli():
+                    return None
+            proxy_options = {'output_format': 'png_native', 'quality': 1, 'tile_size': 0}
+        
+        final_format, quality = self.options.output_format, self.options.quality
+        with self.variant_options(dict(proxy_options, embed_image=True)):
+            proxy = self.render_diagram(mermaid_code)
+            if not proxy:
+                return None
+            with self.timed_stage('import', bytes_in=len(proxy), draft=True):
+                size = png_size(proxy)
+                if size:
+                    # The proxy has 0.75 px per CSS px (times the scale factor)
+                    if final_format in ("png", "png_native"):
+                        factor = quality
+                    else:
+                        factor = self.svg.unittouu('1px') / PT_PER_CSS_PX
+                    element = self.import_image(proxy, size=(size[0] * factor, size[1] * factor))
+                else:
+                    element = self.insert_artifact(proxy)
+        if element is None:
+            return None
+        element.label = DRAFT_LABEL
+        anchor = POSITION_ANCHORS.get(self.options.position_mode, (0.5, 0.5))
+        self.tag_diagram(element, mermaid_code, source_file, draft=anchor + tuple(self.last_inserted_size))
+        if not self.options.quiet_mode:
+            inkex.errormsg("Inserted a draft; run Update existing > Finalize drafts for the full render")
+        return element
+    
+    def options_digest(self, names=RENDER_OPTIONS):
+        """Hash the given option values and the config/CSS file contents."""
+        opts = self.options
+        h = hashlib.sha256()
+        
+        def feed(label, value):
+            h.update(label.encode('utf-8') + b'\0')
+            if not isinstance(value, bytes):
+                value = str(value).encode('utf-8')
+            h.update(value + b'\0')
+        
+        for name in names:
+            feed(name, getattr(opts, name))
+        
+        for name in ('config_file', 'css_file'):
+            path = getattr(opts, name)
+            if path and os.path.exists(path):
+                with open(path, 'rb') as f:
+                    feed(name, f.read())
+            else:
+                feed(name, '')
+        return h.hexdigest()
+    
+    def tag_diagram(self, element, code, source_file=None, block=None, variant=None, draft=None):
+        """Record source and options on an inserted diagram for later updates.
+        
+        ``variant`` names the fan-out variant the diagram was rendered as;
+        updates re-render it with that variant's options. ``draft`` marks
+        a proxy as ``(anchor x, anchor y, width, height)`` and stores the
+        options it should be finalized with.
+        """
+        if not getattr(self, '_registry_ns', False):
+            try:
+                self.svg.add_namespace('mermaid', MERMAID_NS)
+            except (AttributeError, KeyError, ValueError):
+                # Older inkex, or the prefix is taken: lxml picks a prefix itself
+                pass
+            self._registry_ns = True
+        
+        element.set(mermaid_attr('source'), code)
+        element.set(mermaid_attr('digest'), hashlib.sha256(code.encode('utf-8')).hexdigest())
+        element.set(mermaid_attr('options'), self.options_digest(RENDER_OPTIONS + PLACEMENT_OPTIONS))
+        element.set(mermaid_attr('placement'), getattr(self, 'last_inner_transform', ''))
+        for name in ('file', 'block', 'mtime', 'variant', 'draft', 'draft-options'):
+            element.attrib.pop(mermaid_attr(name), None)
+        if variant:
+            element.set(mermaid_attr('variant'), variant)
+        if draft:
+            element.set(mermaid_attr('draft'), " ".join(f"{value:.6g}" for value in draft))
+            names = RENDER_OPTIONS + PLACEMENT_OPTIONS + ('config_file', 'css_file')
+            element.set(mermaid_attr('draft-options'),
+                        json.dumps({name: getattr(self.options, name) for name in names}, sort_keys=True))
+        if source_file:
+            source_file = os.path.abspath(os.path.expanduser(source_file))
+            element.set(mermaid_attr('file'), source_file)
+            if block is not None:
+                element.set(mermaid_attr('block'), str(block))
+            try:
+                element.set(mermaid_attr('mtime'), str(os.stat(source_file).st_mtime_ns))
+            except OSError:
+                pass
+    
+    def find_registered_diagrams(self):
+        """Return registered diagrams in the document or the selection."""
+        query = './/*[@mermaid:source]'
+        namespaces = {'mermaid': MERMAID_NS}
+        if self.options.update_mode != "selection":
+            return self.svg.xpath(query, namespaces=namespaces)
+        found = []
+        for element in self.svg.selection.values():
+            if element.get(mermaid_attr('source')) is not None:
+                found.append(element)
+            found.extend(element.xpath(query, namespaces=namespaces))
+        return found
+    
+    def update_diagrams(self):
+        """Re-render registered diagrams whose source, options or file changed.
+        
+        Unchanged diagrams are skipped without running any tool; stale ones
+        are rendered concurrently and swapped in place. Drafts are always
+        rendered, with the options stored when they were inserted, and are
+        the only diagrams touched in "drafts" mode.
+        """
+        diagrams = self.find_registered_diagrams()
+        if not diagrams:
+            inkex.errormsg("No Mermaid diagrams to update in "
+                           + ("the selection" if self.options.update_mode == "selection" else "this document"))
+            return
+        if self.options.update_mode == "drafts":
+            diagrams = [element for element in diagrams if element.get(mermaid_attr('draft'))]
+            if not diagrams:
+                inkex.errormsg("No draft diagrams to finalize in this document")
+                return
+        
+        options_digests = {}
+        stale = []
+        failures = []
+        with self.timed_stage('scan', diagrams=len(diagrams)):
+            for element in diagrams:
+                # Fan-out variants keep their own theme/format/quality/background
+                variant = element.get(mermaid_attr('variant'))
+                draft = element.get(mermaid_attr('draft'))
+                try:
+                    overrides = parse_variant(variant)[1] if variant else {}
+                    if draft:
+                        overrides.update(json.loads(element.get(mermaid_attr('draft-options')) or '{}'))
+                except ValueError:
+                    failures.append(element.get('id'))
+                    continue
+                if not draft and variant not in options_digests:
+                    with self.variant_options(overrides):
+                        options_digests[variant] = self.options_digest(RENDER_OPTIONS + PLACEMENT_OPTIONS)
+                code = element.get(mermaid_attr('source'))
+                path = element.get(mermaid_attr('file'))
+                block = element.get(mermaid_attr('block'))
+                block = int(block) if block else None
+                if path:
+                    try:
+                        mtime = str(os.stat(path).st_mtime_ns)
+                    except OSError:
+                        mtime = None
+                        if not self.options.quiet_mode:
+                            inkex.errormsg(f"{element.get('id')}: source file missing, using stored code: {path}")
+                    if mtime and mtime != element.get(mermaid_attr('mtime')):
+                        code = read_diagram_source(path, block)
+                        if code is None:
+                            failures.append(element.get('id'))
+                            continue
+                digest = hashlib.sha256(code.encode('utf-8')).hexdigest()
+                if (not draft and digest == element.get(mermaid_attr('digest'))
+                        and element.get(mermaid_attr('options')) == options_digests[variant]
+                        and element.get(mermaid_attr('source')) == code):
+                    continue
+                stale.append((element, code, path, block, variant, overrides))
+        
+        if stale:
+            self.get_cache()
+            self.get_render_worker()
+            
+            def replace(index, artifact):
+                element, code, path, block, variant, overrides = stale[index]
+                if not artifact:
+                    failures.append(element.get('id'))
+                    return
+                with self.variant_options(overrides), self.timed_stage('import', bytes_in=len(artifact)):
+                    if not self.replace_diagram(element, artifact, code, path, block, variant):
+                        failures.append(element.get('id'))
+            
+            with self.timed_stage('pipeline', diagrams=len(stale)):
+                self.render_pipeline([(job[1], job[5]) for job in stale], replace)
+        
+        if failures:
+            inkex.errormsg(f"{len(failures)} of {len(diagrams)} diagrams could not be updated: " + ", ".join(failures))
+        if not self.options.quiet_mode:
+            inkex.errormsg(f"Updated {len(stale) - len(failures)} of {len(diagrams)} diagrams "
+                           f"({len(diagrams) - len(stale)} unchanged). Stage timings: " + self.format_stage_times())
+    
+    def replace_diagram(self, old, artifact, code, source_file, block, variant=None):
+        """Swap a freshly rendered diagram in for ``old``, keeping its placement.
+        
+        The user's transform is kept by composing it with the inverse of the
+        old diagram's own placement (scale/crop, or image x/y) and the new
+        diagram's placement, so the top-left corner stays where it was. A
+        draft keeps the point its position mode pinned instead (its centre
+        for "center"), so the final diagram lands where calculate_position
+        would have put it.
+        """
+        is_image = old.tag == inkex.addNS('image', 'svg')
+        anchor = inkex.Transform(old.get('transform'))
+        if is_image:
+            anchor = anchor @ inkex.Transform(translate=(float(old.get('x') or 0), float(old.get('y') or 0)))
+        else:
+            anchor = anchor @ -inkex.Transform(old.get(mermaid_attr('placement')) or '')
+        
+        self.diagram_code = code
+        old_id = old.get('id')
+        self.options.object_id = ''
+        # The new element is moved next to the old one; never create a layer for it
+        create_layer, self.options.create_layer = self.options.create_layer, False
+        try:
+            new = self.insert_artifact(artifact, position=(0, 0))
+        finally:
+            self.options.create_layer = create_layer
+        if new is None:
+            return False
+        
+        draft = old.get(mermaid_attr('draft'))
+        if draft:
+            try:
+                anchor_x, anchor_y, old_width, old_height = (float(v) for v in draft.split())
+            except ValueError:
+                pass
+            else:
+                new_width, new_height = self.last_inserted_size
+                anchor = anchor @ inkex.Transform(translate=((old_width - new_width) * anchor_x,
+                                                             (old_height - new_height) * anchor_y))
+        
+        if new.tag == inkex.addNS('image', 'svg'):
+            matrix = anchor.matrix
+            if matrix[0][0] == 1 and matrix[1][1] == 1 and matrix[0][1] == 0 and matrix[1][0] == 0:
+                new.set('x', str(matrix[0][2]))
+                new.set('y', str(matrix[1][2]))
+                new.set('transform', None)
+            else:
+                new.set('transform', str(anchor))
+        else:
+            new.set('transform', str(anchor @ inkex.Transform(self.last_inner_transform)))
+        
+        parent = old.getparent()
+        parent.insert(parent.index(old), new)
+        label = old.get(inkex.addNS('label', 'inkscape'))
+        parent.remove(old)
+        if old_id:
+            new.set('id', old_id)
+        if label and label != DRAFT_LABEL:
+            new.set(inkex.addNS('label', 'inkscape'), label)
+        self.tag_diagram(new, code, source_file, block, variant)
+        return True
+    
+    def require_mermaid_cli(self, local=False):
+        """Check for mmdc and explain how to install it when missing.
+        
+        The answer is kept for the run, so render threads that fall back to
+        mmdc one by one report a missing CLI only once. With the HTTP render
+        backend nothing is needed locally unless ``local`` (the backend's
+        fallback) asks.
+        """
+        if self.options.render_backend == "http" and not local:
+            return True
+        with self._cli_lock:
+            if getattr(self, '_cli_found', None) is None:
+                self._cli_found = self.check_mermaid_cli()
+                if not self._cli_found:
+                    inkex.errormsg(f"Mermaid CLI not found at: {self.options.mermaid_cli_path}\n\n"
+                                 "Install with: npm install -g @mermaid-js/mermaid-cli\n\n"
+                                 "On Windows, you may need to use full path like:\n"
+                                 "C:\\Users\\YourName\\AppData\\Roaming\\npm\\mmdc.cmd")
+            return self._cli_found
+    
+    def render_format(self):
+        """The output format as rendered.
+        
+        Render services do not produce PDF for Mermaid, so with the HTTP
+        backend SVG and PNG take the direct (native) routes.
+        """
+        output_format = self.options.output_format
+        if self.get_render_backend().name == "http":
+            return {'svg': 'svg_native', 'png': 'png_native'}.get(output_format, output_format)
+        return output_format
+    
+    def insert_artifact(self, artifact, position=None):
+        """Insert rendered artifact bytes according to the output format."""
+        output_format = self.render_format()
+        if output_format == "svg" or mermaid_lite.is_lite_svg(artifact):
+            return self.import_svg(artifact, position)
+        elif output_format == "svg_native":
+            return self.import_native_svg(artifact, position)
+        else:
+            return self.import_image(artifact, position)
+    
+    @contextlib.contextmanager
+    def timed_stage(self, name, **args):
+        """Record wall time, child CPU/RSS and byte sizes of a pipeline stage.
+        
+        Yields the event's ``args`` dict so the stage can add ``bytes_out``
+        or other details once it knows them. Stages may nest.
+        """
+        with self._init_lock:
+            if not hasattr(self, 'stage_times'):
+                self.stage_times = []
+                self.trace_events = []
+                self._trace_origin = time.perf_counter()
+        stack = getattr(STAGE_SINK, 'stack', None)
+        if stack is None:
+            stack = STAGE_SINK.stack = []
+        stack.append(args)
+        usage = child_resource_usage()
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            elapsed = time.perf_counter() - start
+            stack.pop()
+            end_usage = child_resource_usage()
+            if usage and end_usage:
+                args['child_cpu_s'] = round(end_usage[0] - usage[0], 4)
+                args['child_peak_rss_kb'] = end_usage[1]
+            entry = (name, elapsed)
+            self.stage_times.append(entry)
+            self.trace_events.append({
+                'name': name,
+                'cat': 'mermaid',
+                'ph': 'X',
+                'ts': round((start - self._trace_origin) * 1e6),
+                'dur': round(elapsed * 1e6),
+                'pid': os.getpid(),
+                'tid': threading.get_ident(),
+                'args': {k: v for k, v in args.items() if v is not None},
+            })
+            # Per-job collectors (e.g. the build CLI) register a thread-local list
+            sink = getattr(STAGE_SINK, 'times', None)
+            if sink is not None:
+                sink.append(entry)
+    
+    def annotate_stage(self, **args):
+        """Add details to the innermost open stage on this thread."""
+        stack = getattr(STAGE_SINK, 'stack', None)
+        if stack:
+            stack[-1].update(args)
+    
+    def format_stage_times(self):
+        """Summarise stages as ``name 1.23s`` totals plus child CPU/RSS."""
+        totals = {}
+        for name, seconds in getattr(self, 'stage_times', []):
+            totals[name] = totals.get(name, 0.0) + seconds
+        summary = ", ".join(f"{name} {seconds:.2f}s" for name, seconds in totals.items())
+        
+        events = getattr(self, 'trace_events', [])
+        cpu = sum(e['args'].get('child_cpu_s', 0) for e in events if e['name'] in LEAF_STAGES)
+        peaks = [e['args'].get(k) for e in events
+                 for k in ('child_peak_rss_kb', 'shell_peak_rss_kb') if e['args'].get(k)]
+        if cpu or peaks:
+            summary += f" | child CPU {cpu:.2f}s"
+            if peaks:
+                summary += f", child peak RSS {max(peaks) / 1024:.0f} MB"
+        return summary
+    
+    def write_trace(self):
+        """Write recorded stages as a Chrome trace-event JSON file."""
+        path = self.options.trace_file
+        if not path or not getattr(self, 'trace_events', None):
+            return
+        path = os.path.expanduser(path)
+        if os.path.isdir(path):
+            path = os.path.join(path, f"mermaid-trace-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.json")
+        trace = {
+            'traceEvents': self.trace_events,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'mmdc_version': getattr(self, 'mermaid_cli_version', ''),
+                'inkscape_version': getattr(self, '_inkscape_version', None) or '',
+                'output_format': self.options.output_format,
+                'use_puppeteer': self.options.use_puppeteer,
+                'converter': self.options.converter,
+                'use_cache': self.options.use_cache,
+            },
+        }
+        try:
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(trace, f, indent=1)
+        except OSError as e:
+            inkex.errormsg(f"Could not write trace file: {str(e)}")
+    
+    def get_toolchain(self):
+        """Return the memoized tool probe shared by every stage."""
+        with self._init_lock:
+            if getattr(self, '_toolchain', None) is None:
+                self._toolchain = Toolchain(self.options.cache_dir or default_cache_dir())
+        return self._toolchain
+    
+    def get_scheduler(self):
+        """Return the run's job scheduler for mmdc and Inkscape processes."""
+        with self._init_lock:
+            if getattr(self, '_scheduler', None) is None:
+                if self.options.memory_budget_mb > 0:
+                    budget = self.options.memory_budget_mb * 1024
+                else:
+                    available = available_memory_kb()
+                    budget = available // 2 if available else None
+                state_path = os.path.join(self.options.cache_dir or default_cache_dir(), 'scheduler.json')
+                self._scheduler = JobScheduler(max(1, self.options.batch_jobs), budget, state_path)
+        return self._scheduler
+    
+    def close_scheduler(self):
+        """Kill anything still running and keep the learned job costs."""
+        scheduler = getattr(self, '_scheduler', None)
+        if scheduler is not None:
+            scheduler.cancel()
+            scheduler.save()
+            self._scheduler = None
+    
+    def convert_job(self, input_file, output_file):
+        """Scheduler slot for one Inkscape run on ``input_file``.
+        
+        Conversions go ahead of waiting renders so diagrams in flight finish
+        and release their memory first.
+        """
+        try:
+            size = os.path.getsize(input_file)
+        except OSError:
+            size = 0
+        label = os.path.splitext(output_file)[1].lstrip('.') or output_file
+        return self.get_scheduler().job('convert', size, label, priority=1)
+    
+    def annotate_job(self, job):
+        self.annotate_stage(queued_s=round(job.get('queued_s', 0.0), 4),
+                            est_rss_kb=job['cost_kb'], peak_rss_kb=job['peak_rss_kb'])
+    
+    def check_mermaid_cli(self):
+        """Check if Mermaid CLI is installed."""
+        record = self.get_toolchain().mermaid_cli(self.options.mermaid_cli_path)
+        if record is None:
+            return False
+        self.mermaid_cli_version = record['version']
+        return True
+    
+    def mmdc_supports(self, capability):
+        record = self.get_toolchain().mermaid_cli(self.options.mermaid_cli_path)
+        return bool(record and record['capabilities'].get(capability))
+    
+    def inkscape_supports(self, capability):
+        record = self.get_toolchain().inkscape(self.options.inkscape_path)
+        # Unknown inkscape: assume a 1.x command line rather than refusing
+        return True if record is None else bool(record['capabilities'].get(capability))
+    
+    def get_inkscape_version(self):
+        """Return the Inkscape version string (empty if unavailable)."""
+        record = self.get_toolchain().inkscape(self.options.inkscape_path)
+        self._inkscape_version = record['version'] if record else ""
+        return self._inkscape_version
+    
+    def get_cache(self):
+        """Return the render cache, or None when caching is disabled."""
+        if not self.options.use_cache:
+            return None
+        if getattr(self, '_cache', None) is None:
+            cache_dir = self.options.cache_dir or default_cache_dir()
+            try:
+                self._cache = RenderCache(cache_dir, max(self.options.cache_size_mb, 1) * 1024 * 1024)
+            except OSError as e:
+                inkex.errormsg(f"Render cache disabled: {str(e)}")
+                self.options.use_cache = False
+                return None
+        return self._cache
+    
+    def close_cache(self):
+        cache = getattr(self, '_cache', None)
+        if cache is not None:
+            cache.flush()
+    
+    def render_signature(self, mermaid_code):
+        """Hash the source and every option that changes the rendered output."""
+        h = hashlib.sha256()
+        
+        def feed(label, value):
+            h.update(label.encode('utf-8') + b'\0')
+            if not isinstance(value, bytes):
+                value = str(value).encode('utf-8')
+            h.update(value + b'\0')
+        
+        feed('code', mermaid_code)
+        feed('options', self.options_digest())
+        if self.renders_in_process(mermaid_code):
+            feed('renderer', mermaid_lite.RENDERER_VERSION)
+        elif self.get_render_backend().name == "http":
+            feed('service', self.options.render_url)
+        else:
+            if getattr(self, 'mermaid_cli_version', None) is None:
+                self.check_mermaid_cli()
+            feed('mmdc', getattr(self, 'mermaid_cli_version', ''))
+            # The warm worker and one-shot mmdc do not lay out identically
+            worker = self.options.use_puppeteer and RenderWorkerClient.supported()
+            feed('backend', 'worker' if worker else 'mmdc')
+            if self.render_format() in ('svg', 'png'):
+                # Only the PDF route goes through Inkscape
+                feed('inkscape', self.get_inkscape_version())
+        return h.hexdigest()
+    
+    def get_scratch(self):
+        """Return the run's scratch space (created on first use)."""
+        with self._init_lock:
+            if getattr(self, '_scratch', None) is None:
+                parent = None
+                if self.options.temp_dir and os.path.exists(self.options.temp_dir):
+                    parent = self.options.temp_dir
+                elif self.options.scratch_tmpfs:
+                    parent = tmpfs_dir()
+                self._scratch = ScratchSpace(parent, keep=self.options.keep_temp_files)
+        return self._scratch
+    
+    def cleanup_scratch(self):
+        scratch = getattr(self, '_scratch', None)
+        if scratch is None:
+            return
+        root = scratch.cleanup()
+        if root and scratch.keep and not self.options.quiet_mode:
+            inkex.errormsg(f"Temp files kept in: {root}")
+    
+    def use_pipes(self):
+        return self.options.io_mode == "pipe"
+    
+    def render_diagram(self, mermaid_code, work_dir=None, cached_only=False):
+        """Render Mermaid code to converted SVG/PNG bytes, using the cache.
+        
+        Intermediate files (if the tools need any) go to ``work_dir`` or a
+        private job directory in the scratch space that is removed
+        afterwards. Returns the artifact bytes or None on failure (or, with
+        ``cached_only``, on a cache miss).
+        """
+        key, cached = self.cache_lookup(mermaid_code)
+        if cached or cached_only:
+            return cached
+        
+        scratch = None
+        if work_dir is None:
+            scratch = self.get_scratch()
+            work_dir = scratch.job_dir()
+        try:
+            artifact = self.render_uncached(mermaid_code, work_dir)
+        finally:
+            if scratch is not None:
+                scratch.release(work_dir)
+        
+        self.cache_store(key, artifact)
+        return artifact
+    
+    def cache_ext(self):
+        return 'png' if self.options.output_format in ("png", "png_native") else 'svg'
+    
+    def cache_lookup(self, mermaid_code):
+        """Return (cache key, cached artifact); both None when caching is off."""
+        cache = self.get_cache()
+        if not cache:
+            return None, None
+        key = self.render_signature(mermaid_code)
+        with self.timed_stage('cache') as stage:
+            cached = cache.get(key, self.cache_ext())
+            stage['bytes_out'] = len(cached) if cached else 0
+        if not self.options.quiet_mode:
+            stats = cache.stats()
+            inkex.errormsg(f"Render cache {'hit' if cached else 'miss'} {key[:12]} "
+                           f"(hits={stats.get('hits', 0)}, misses={stats.get('misses', 0)})")
+        return key, cached
+    
+    def cache_store(self, key, artifact):
+        cache = self.get_cache()
+        if not artifact or not cache or key is None:
+            return
+        try:
+            cache.put(key, self.cache_ext(), artifact)
+        except OSError as e:
+            if not self.options.quiet_mode:
+                inkex.errormsg(f"Could not store render in cache: {str(e)}")
+    
+    def renders_in_process(self, mermaid_code):
+        """True when the built-in renderer handles this diagram and these options.
         
-        # Style parameters
-        pars.add_argument("--theme", type=str, default="default", help="Mermaid theme")
-        pars.add_argument("--background", type=str, default="white", help="Background color")
-        pars.add_argument("--width", type=int, default=800, help="Width")
-        pars.add_argument("--height", type=int, default=600, help="Height")
+        Config and CSS files, fixed page sizes and PNG output need Mermaid
+        CLI, so they always take the mmdc route.
+        """
+        opts = self.options
+        return (opts.renderer == "auto"
+                and opts.output_format in ("svg", "svg_native")
+                and opts.fit_to_content
+                and not opts.config_file and not opts.css_file
+                and mermaid_lite.supports(mermaid_code, opts.theme))
+    
+    def render_uncached(self, mermaid_code, work_dir):
+        """Run Mermaid CLI (and Inkscape for svg/png); returns artifact bytes."""
+        artifact, pdf_file = self.start_render(mermaid_code, work_dir)
+        if pdf_file:
+            artifact = self.finish_render(pdf_file)
+        return artifact
+    
+    def start_render(self, mermaid_code, work_dir):
+        """Render up to (not including) the Inkscape conversion.
         
-        # Format parameters
-        pars.add_argument("--output_format", type=str, default="svg", help="Output format")
-        pars.add_argument("--scale_factor", type=float, default=1.0, help="Scale factor")
-        pars.add_argument("--quality", type=int, default=2, help="Quality level")
-        pars.add_argument("--embed_image", type=inkex.Boolean, default=True, help="Embed image")
+        Returns ``(artifact, None)`` when the result is final, ``(None,
+        pdf_file)`` when the PDF in ``work_dir`` still needs finish_render,
+        and ``(None, None)`` on failure.
+        """
+        if self.renders_in_process(mermaid_code):
+            try:
+                with self.timed_stage('render', bytes_in=len(mermaid_code.encode('utf-8')),
+                                      backend='python') as stage:
+                    artifact = mermaid_lite.render_svg(mermaid_code, self.options.theme, self.options.background)
+                    stage['bytes_out'] = len(artifact)
+                return artifact, None
+            except mermaid_lite.UnsupportedDiagram:
+                # supports() only parses; anything the layout refuses goes to mmdc
+                pass
         
-        # Enhanced positioning parameters
-        pars.add_argument("--position_mode", type=str, default="center", help="Position mode")
-        pars.add_argument("--offset_x", type=float, default=0.0, help="X offset")
-        pars.add_argument("--offset_y", type=float, default=0.0, help="Y offset")
-        pars.add_argument("--use_selection_bbox", type=inkex.Boolean, default=False, help="Position relative to selection")
-        pars.add_argument("--align_to_page", type=inkex.Boolean, default=True, help="Align to page or viewport")
+        if self.options.validate_syntax:
+            if not self.shared_work(('validate', mermaid_code), lambda: self.check_syntax(mermaid_code)):
+                return None, None
         
-        # Enhanced scaling parameters
-        pars.add_argument("--auto_scale", type=inkex.Boolean, default=False, help="Auto-scale to fit")
-        pars.add_argument("--max_width", type=int, default=0, help="Maximum width (0=no limit)")
-        pars.add_argument("--max_height", type=int, default=0, help="Maximum height (0=no limit)")
-        pars.add_argument("--maintain_aspect_ratio", type=inkex.Boolean, default=True, help="Maintain aspect ratio")
-        pars.add_argument("--lock_scale", type=inkex.Boolean, default=False, help="Lock object after insertion")
+        if self.options.renderer != "mmdc":
+            # Checked here, not up front, so built-in renders never need mmdc
+            with self.timed_stage('check_cli'):
+                if not self.require_mermaid_cli():
+                    return None, None
         
-        # Config parameters
-        pars.add_argument("--mermaid_cli_path", type=str, default="mmdc", help="Mermaid CLI path")
-        pars.add_argument("--use_puppeteer", type=inkex.Boolean, default=True, help="Use Puppeteer")
-        pars.add_argument("--config_file", type=str, default="", help="Config file")
-        pars.add_argument("--css_file", type=str, default="", help="CSS file")
+        output_format = self.render_format()
+        if output_format == "svg_native":
+            # Fast path: Mermaid's own SVG, post-processed in-process on import
+            with self.timed_stage('render', bytes_in=len(mermaid_code.encode('utf-8'))) as stage:
+                artifact = self.generate_diagram(mermaid_code, 'svg', work_dir)
+                stage['bytes_out'] = len(artifact) if artifact else 0
+            if not artifact:
+                inkex.errormsg("Failed to generate SVG diagram")
+            return artifact, None
         
-        # Advanced parameters
-        pars.add_argument("--timeout", type=int, default=30, help="Timeout")
-        pars.add_argument("--viewport_width", type=int, default=1920, help="Viewport width")
-        pars.add_argument("--viewport_height", type=int, default=1080, help="Viewport height")
-        pars.add_argument("--keep_temp_files", type=inkex.Boolean, default=False, help="Keep temp files")
-        pars.add_argument("--temp_dir", type=str, default="", help="Temp directory")
-        pars.add_argument("--quiet_mode", type=inkex.Boolean, default=True, help="Quiet mode")
+        if output_format == "png_native":
+            # Fast path: Chromium rasterizes at the pixel density the PDF route would
+            scale = PT_PER_CSS_PX * self.options.quality * self.options.scale_factor
+            with self.timed_stage('render', bytes_in=len(mermaid_code.encode('utf-8'))) as stage:
+                artifact = self.generate_diagram(mermaid_code, 'png', work_dir, scale=scale)
+                stage['bytes_out'] = len(artifact) if artifact else 0
+            if not artifact:
+                inkex.errormsg("Failed to generate PNG diagram")
+            return artifact, None
         
-        # Inkscape options
-        pars.add_argument("--inkscape_path", type=str, default="inkscape", help="Inkscape executable path")
-        pars.add_argument("--pdf_poppler", type=inkex.Boolean, default=True, help="Use PDF poppler for import")
-        pars.add_argument("--fit_to_content", type=inkex.Boolean, default=True, help="Fit to content (no empty space)")
+        # Always generate PDF first (best quality from Mermaid); variants of
+        # a fan-out that differ only in format or quality convert the same one
+        with self.timed_stage('render', bytes_in=len(mermaid_code.encode('utf-8'))) as stage:
+            pdf_data = self.shared_work(('pdf', mermaid_code, self.options_digest(PDF_OPTIONS)),
+                                        lambda: self.generate_diagram_pdf(mermaid_code, work_dir))
+            stage['bytes_out'] = len(pdf_data) if pdf_data else 0
         
-        # New: Layer management
-        pars.add_argument("--create_layer", type=inkex.Boolean, default=False, help="Create new layer for diagram")
-        pars.add_argument("--layer_name", type=str, default="Mermaid Diagrams", help="Layer name")
+        if not pdf_data:
+            inkex.errormsg("Failed to generate PDF diagram")
+            return None, None
         
-        # New: Object properties
-        pars.add_argument("--object_id", type=str, default="", help="Custom object ID")
-        pars.add_argument("--add_title", type=inkex.Boolean, default=False, help="Add title element")
-        pars.add_argument("--add_desc", type=inkex.Boolean, default=False, help="Add description element")
+        # Inkscape cannot read PDF from stdin, so this one file is unavoidable
+        pdf_file = os.path.join(work_dir, "diagram.pdf")
+        with open(pdf_file, 'wb') as f:
+            f.write(pdf_data)
+        return None, pdf_file
     
-    def effect(self):
-        """Main effect function."""
-        try:
-            # Get Mermaid code
-            if self.options.use_file and self.options.mermaid_file:
-                if not os.path.exists(self.options.mermaid_file):
-                    inkex.errormsg(f"File not found: {self.options.mermaid_file}")
-                    return
-                with open(self.options.mermaid_file, 'r', encoding='utf-8') as f:
-                    mermaid_code = f.read()
-            else:
-                mermaid_code = self.options.mermaid_code
-            
-            # Clean up the code
-            mermaid_code = mermaid_code.strip()
-            
-            if not mermaid_code:
-                inkex.errormsg("No Mermaid code provided!")
-                return
-            
-            # Check if mmdc is installed
-            if not self.check_mermaid_cli():
-                inkex.errormsg(f"Mermaid CLI not found at: {self.options.mermaid_cli_path}\n\n"
-                             "Install with: npm install -g @mermaid-js/mermaid-cli\n\n"
-                             "On Windows, you may need to use full path like:\n"
-                             "C:\\Users\\YourName\\AppData\\Roaming\\npm\\mmdc.cmd")
-                return
-            
-            # Always generate PDF first (best quality from Mermaid)
-            pdf_file = self.generate_diagram_pdf(mermaid_code)
-            
-            if not pdf_file or not os.path.exists(pdf_file):
-                inkex.errormsg("Failed to generate PDF diagram")
-                return
-            
-            # Store mermaid code for later use
-            self.diagram_code = mermaid_code
-            
-            # Convert PDF using Inkscape based on output format
+    def finish_render(self, pdf_file):
+        """Convert start_render's PDF with Inkscape; returns artifact bytes."""
+        with self.timed_stage('convert', bytes_in=os.path.getsize(pdf_file)) as stage:
             if self.options.output_format == "svg":
-                # Convert PDF to SVG using Inkscape and import
-                self.import_pdf_as_svg(pdf_file)
+                artifact = self.convert_pdf_to_svg(pdf_file)
             else:
-                # Convert PDF to PNG using Inkscape
-                png_file = self.convert_pdf_to_png(pdf_file)
-                if png_file:
-                    self.import_image(png_file)
-            
-            # Clean up temp files if needed
-            if not self.options.keep_temp_files:
-                try:
-                    if os.path.exists(pdf_file):
-                        os.remove(pdf_file)
-                    input_file = pdf_file.replace('.pdf', '.mmd')
-                    if os.path.exists(input_file):
-                        os.remove(input_file)
-                except:
-                    pass
-            
-        except Exception as e:
-            inkex.errormsg(f"Error: {str(e)}")
-            import traceback
-            inkex.errormsg(traceback.format_exc())
+                artifact = self.convert_pdf_to_png(pdf_file)
+            stage['bytes_out'] = len(artifact) if artifact else 0
+        return artifact
     
-    def check_mermaid_cli(self):
-        """Check if Mermaid CLI is installed."""
+    def render_pipeline(self, jobs, consume):
+        """Render many diagrams with the stages overlapping, consuming them in order.
+        
+        ``jobs`` are ``(code, option overrides)`` pairs. Mermaid CLI renders
+        and Inkscape conversions run on separate pools of ``batch_jobs``
+        workers, so diagram N+1 renders while diagram N converts, and
+        ``consume(index, artifact)`` runs on the calling thread, in job
+        order, as soon as a diagram and all the ones before it are ready.
+        Only the calling thread touches the document, so insertion order
+        and IDs do not depend on which render finishes first. At most
+        ``2 * batch_jobs + 1`` diagrams are in flight, which bounds the
+        finished artifacts held back for in-order consumption. A failed
+        diagram is consumed as None.
+        """
+        workers = max(1, self.options.batch_jobs)
+        window = 2 * workers + 1
+        scratch = self.get_scratch()
+        results = [concurrent.futures.Future() for _ in jobs]
+        
+        def convert(index, pdf_file, work_dir, key):
+            try:
+                with self.variant_options(jobs[index][1]):
+                    artifact = self.finish_render(pdf_file)
+                    self.cache_store(key, artifact)
+                results[index].set_result(artifact)
+            except BaseException as e:
+                results[index].set_exception(e)
+            finally:
+                scratch.release(work_dir)
+        
+        def render(index):
+            code, overrides = jobs[index]
+            work_dir = None
+            try:
+                with self.variant_options(overrides):
+                    key, artifact = self.cache_lookup(code)
+                    if artifact is None:
+                        work_dir = scratch.job_dir()
+                        artifact, pdf_file = self.start_render(code, work_dir)
+                        if pdf_file:
+                            # The conversion owns the job directory from here
+                            convert_pool.submit(convert, index, pdf_file, work_dir, key)
+                            work_dir = None
+                            return
+                        self.cache_store(key, artifact)
+                results[index].set_result(artifact)
+            except BaseException as e:
+                results[index].set_exception(e)
+            finally:
+                if work_dir is not None:
+                    scratch.release(work_dir)
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as convert_pool, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=workers) as render_pool:
+            try:
+                submitted = 0
+                for index in range(len(jobs)):
+                    while submitted < len(jobs) and submitted < index + window:
+                        render_pool.submit(render, submitted)
+                        submitted += 1
+                    try:
+                        artifact = results[index].result()
+                    except Exception as e:
+                        inkex.errormsg(f"Render failed: {str(e)}")
+                        artifact = None
+                    consume(index, artifact)
+            except BaseException:
+                # Do not wait for renders whose results nobody will insert
+                self.get_scheduler().cancel()
+                raise
+    
+    def check_syntax(self, mermaid_code):
+        """Run the syntax pre-check; reports the errors and returns False if any."""
+        with self.timed_stage('validate', bytes_in=len(mermaid_code.encode('utf-8'))):
+            try:
+                validate_mermaid(mermaid_code)
+            except MermaidSyntaxError as e:
+                inkex.errormsg(f"Mermaid syntax error (found before rendering):\n{str(e)}")
+                return False
+        return True
+    
+    def get_render_worker(self):
+        """Connect to (or start) the warm render worker; None means use mmdc."""
+        if not self.options.use_puppeteer or not RenderWorkerClient.supported():
+            return None
+        if getattr(self, '_worker', None) is not None:
+            return self._worker
+        
+        socket_path = self.options.worker_socket or os.path.join(default_cache_dir(), 'worker.sock')
+        os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+        worker = RenderWorkerClient(socket_path)
+        
+        if not worker.ping():
+            cli_dir = find_mermaid_cli_package(self.options.mermaid_cli_path)
+            node_path = shutil.which('node')
+            if not cli_dir or not node_path:
+                if not self.options.quiet_mode:
+                    inkex.errormsg("Render worker unavailable (node or mermaid-cli package not found), using mmdc")
+                self.options.use_puppeteer = False
+                return None
+            if not self.options.quiet_mode:
+                inkex.errormsg(f"Starting render worker on {socket_path}")
+            if not worker.start(node_path, cli_dir,
+                                self.options.worker_idle_timeout,
+                                self.options.worker_max_jobs):
+                if not self.options.quiet_mode:
+                    inkex.errormsg("Render worker did not start, using mmdc")
+                self.options.use_puppeteer = False
+                return None
+        
+        self._worker = worker
+        return worker
+    
+    def render_with_worker(self, worker, mermaid_code, output_file, output_type='pdf', scale=None):
+        """Render through the warm worker. Returns True on success."""
+        opts = self.options
+        job = {
+            'code': mermaid_code,
+            'output': output_file,
+            'format': output_type,
+            'theme': opts.theme,
+            'backgroundColor': opts.background,
+            'scale': opts.scale_factor if scale is None else scale,
+            'timeout': opts.timeout * 1000,
+            'pdfFit': bool(opts.fit_to_content and output_type == 'pdf'),
+        }
+        if not opts.fit_to_content:
+            job['width'] = opts.width
+            job['height'] = opts.height
+        if opts.config_file and os.path.exists(opts.config_file):
+            job['configFile'] = os.path.abspath(opts.config_file)
+        if opts.css_file and os.path.exists(opts.css_file):
+            job['cssFile'] = os.path.abspath(opts.css_file)
+        
         try:
-            cmd = [self.options.mermaid_cli_path, '--version']
-            result = subprocess.run(cmd, 
-                                  capture_output=True, 
-                                  text=True, 
-                                  timeout=5,
-                                  shell=True if os.name == 'nt' else False)
-            return result.returncode == 0
-        except:
+            response = worker.render(job, opts.timeout)
+        except (OSError, ValueError) as e:
+            if not opts.quiet_mode:
+                inkex.errormsg(f"Render worker failed ({str(e)}), falling back to mmdc")
+            self._worker = None
+            return False
+        
+        if not response.get('ok'):
+            if not opts.quiet_mode:
+                inkex.errormsg(f"Render worker error: {response.get('error')}, falling back to mmdc")
             return False
+        
+        self.annotate_stage(backend='worker', worker_ms=response.get('ms'))
+        if not opts.quiet_mode:
+            inkex.errormsg(f"Rendered by worker in {response.get('ms')} ms")
+        return os.path.exists(output_file)
+    
+    def mmdc_pipes(self):
+        """True when Mermaid CLI can take the source on stdin and write to stdout."""
+        return (self.use_pipes() and os.name != 'nt'
+                and self.mmdc_supports('stdin_input') and self.mmdc_supports('stdout_output'))
     
-    def generate_diagram_pdf(self, mermaid_code):
+    def generate_diagram_pdf(self, mermaid_code, work_dir):
         """Generate diagram as PDF using Mermaid CLI."""
-        # Create temp directory
-        if self.options.temp_dir and os.path.exists(self.options.temp_dir):
-            temp_dir = self.options.temp_dir
-        else:
-            temp_dir = tempfile.mkdtemp()
+        return self.generate_diagram(mermaid_code, 'pdf', work_dir)
+    
+    def get_render_backend(self):
+        """Return the run's render backend (Mermaid CLI or an HTTP service)."""
+        with self._init_lock:
+            if getattr(self, '_backend', None) is None:
+                self._backend = MmdcBackend(self)
+                if self.options.render_backend == "http":
+                    try:
+                        client = HttpRenderClient(self.options.render_url, self.options.timeout,
+                                                  self.options.render_retries)
+                        self._backend = HttpBackend(self, client)
+                    except ValueError as e:
+                        inkex.errormsg(f"Render service disabled ({str(e)}), using local mmdc")
+                        self.options.render_backend = "mmdc"
+        return self._backend
+    
+    def close_render_backend(self):
+        backend = getattr(self, '_backend', None)
+        if backend is not None:
+            backend.close()
+            self._backend = None
+    
+    def generate_diagram(self, mermaid_code, output_type, work_dir, scale=None):
+        """Generate diagram as PDF, SVG or PNG (``output_type``) with the render backend.
+        
+        Returns the rendered bytes. ``scale`` overrides the scale factor
+        (the device pixel ratio for PNG).
+        """
+        if scale is None:
+            scale = self.options.scale_factor
+        return self.get_render_backend().render(mermaid_code, output_type, work_dir, scale)
+    
+    def run_mermaid_cli(self, mermaid_code, output_type, work_dir, scale):
+        """Render with Mermaid CLI on this machine (the mmdc backend).
         
-        # Create input file
-        input_file = os.path.join(temp_dir, "diagram.mmd")
-        with open(input_file, 'w', encoding='utf-8') as f:
-            f.write(mermaid_code)
+        With pipe I/O the source goes in on stdin and the result comes back
+        on stdout, so nothing touches ``work_dir``.
+        """
+        output_file = os.path.join(work_dir, f"diagram.{output_type}")
         
-        # Create output PDF file path
-        pdf_file = os.path.join(temp_dir, "diagram.pdf")
+        def read_output():
+            try:
+                with open(output_file, 'rb') as f:
+                    return f.read() or None
+            except OSError:
+                return None
         
-        # Build command - generate PDF
-        cmd = [self.options.mermaid_cli_path, '-i', input_file, '-o', pdf_file]
+        # Prefer the warm render worker when enabled
+        worker = self.get_render_worker()
+        if worker and self.render_with_worker(worker, mermaid_code, output_file, output_type, scale):
+            return read_output()
+        
+        # Build command
+        pipes = self.mmdc_pipes()
+        if pipes:
+            cmd = [self.options.mermaid_cli_path, '-i', '-', '-o', '-', '-e', output_type]
+        else:
+            input_file = os.path.join(work_dir, "diagram.mmd")
+            with open(input_file, 'w', encoding='utf-8') as f:
+                f.write(mermaid_code)
+            # mmdc picks the format from the extension
+            cmd = [self.options.mermaid_cli_path, '-i', input_file, '-o', output_file]
         
         # Add theme
         if self.options.theme != "default":
@@ -186,7 +3489,10 @@ class MermaidGenerator(inkex.EffectExtension):
             cmd.extend(['-b', self.options.background])
         
         # Add dimensions (only if fit_to_content is false)
-        if not self.options.fit_to_content:
+        if self.options.fit_to_content:
+            if output_type == 'pdf' and self.mmdc_supports('pdf_fit'):
+                cmd.append('--pdfFit')
+        else:
             cmd.extend(['-w', str(self.options.width)])
             cmd.extend(['-H', str(self.options.height)])
         
@@ -199,36 +3505,61 @@ class MermaidGenerator(inkex.EffectExtension):
             cmd.extend(['--cssFile', self.options.css_file])
         
         # Add scale
-        if self.options.scale_factor != 1.0:
-            cmd.extend(['-s', str(self.options.scale_factor)])
+        if scale != 1.0:
+            cmd.extend(['-s', f'{scale:g}'])
         
         # Execute command
         try:
             if not self.options.quiet_mode:
                 inkex.errormsg(f"Running: {' '.join(cmd)}")
             
-            result = subprocess.run(cmd, 
-                                  capture_output=True, 
-                                  text=True, 
+            with self.get_scheduler().job('render', len(mermaid_code), diagram_type(mermaid_code)) as job:
+                result = run_tool(cmd,
+                                  input=mermaid_code.encode('utf-8') if pipes else None,
                                   timeout=self.options.timeout,
-                                  shell=True if os.name == 'nt' else False)
+                                  shell=True if os.name == 'nt' else False,
+                                  job=job)
+            self.annotate_job(job)
+            stderr = result.stderr.decode('utf-8', 'replace')
             
             if result.returncode != 0:
-                inkex.errormsg(f"Mermaid CLI error:\n{result.stderr}\n{result.stdout}")
+                stdout = '' if pipes else result.stdout.decode('utf-8', 'replace')
+                inkex.errormsg(f"Mermaid CLI error:\n{stderr}\n{stdout}")
                 return None
             
+            if pipes:
+                self.annotate_stage(io='pipe')
+                return result.stdout or None
+            
             if not self.options.quiet_mode and result.stdout:
-                inkex.errormsg(f"Output: {result.stdout}")
+                inkex.errormsg(f"Output: {result.stdout.decode('utf-8', 'replace')}")
             
-            return pdf_file
+            return read_output()
             
         except subprocess.TimeoutExpired:
-            inkex.errormsg(f"Mermaid CLI timeout ({self.options.timeout}s)")
+            inkex.errormsg(f"Mermaid CLI timeout ({self.options.timeout}s), killed it and its browser processes")
             return None
         except Exception as e:
             inkex.errormsg(f"Error running Mermaid CLI: {str(e)}")
             return None
     
+    def new_id(self, prefix):
+        """Return ``prefix`` plus a number above any the document already uses.
+        
+        inkex's get_unique_id picks random numbers; these count up, so the
+        same run on the same document gives the same IDs. ``prefix`` is also
+        used for the prefixes of a diagram's inner IDs, so ``mermaid-3-...``
+        reserves 3 as well (and likewise for optimize_svg's class prefixes).
+        """
+        counters = self.__dict__.setdefault('_id_counters', {})
+        if prefix not in counters:
+            pattern = re.compile(re.escape(prefix) + r'(\d+)(?:-|$)')
+            names = [name for value in self.svg.xpath('//@id | //@class') for name in value.split()]
+            used = [int(m.group(1)) for m in map(pattern.match, names) if m]
+            counters[prefix] = max(used, default=0)
+        counters[prefix] += 1
+        return f"{prefix}{counters[prefix]}"
+    
     def get_layer(self):
         """Get or create layer for diagram."""
         if not self.options.create_layer:
@@ -245,37 +3576,6 @@ class MermaidGenerator(inkex.EffectExtension):
         self.svg.append(layer)
         return layer
     
-    def get_actual_dimensions(self, svg_file):
-        """Extract actual dimensions from converted SVG."""
-        try:
-            from lxml import etree
-            with open(svg_file, 'r', encoding='utf-8') as f:
-                svg_content = f.read()
-            
-            svg_tree = etree.fromstring(svg_content.encode('utf-8'))
-            
-            # Try to get width and height attributes
-            width = svg_tree.get('width')
-            height = svg_tree.get('height')
-            
-            if width and height:
-                # Parse values (remove units)
-                width_val = float(re.sub(r'[^\d.]', '', width))
-                height_val = float(re.sub(r'[^\d.]', '', height))
-                return width_val, height_val
-            
-            # Try viewBox
-            viewbox = svg_tree.get('viewBox')
-            if viewbox:
-                parts = viewbox.split()
-                if len(parts) == 4:
-                    return float(parts[2]), float(parts[3])
-            
-        except:
-            pass
-        
-        return None, None
-    
     def apply_auto_scale(self, width, height):
         """Calculate scale factor to fit within max dimensions."""
         if not self.options.auto_scale:
@@ -295,10 +3595,116 @@ class MermaidGenerator(inkex.EffectExtension):
             # Non-proportional scaling (rarely used)
             return 1.0
     
+    def use_pdf_poppler(self):
+        return self.options.pdf_poppler and self.inkscape_supports('pdf_poppler')
+    
+    def inkscape_shell_args(self):
+        return ['--pdf-poppler'] if self.use_pdf_poppler() else []
+    
+    @contextlib.contextmanager
+    def inkscape_shell(self):
+        """Borrow a persistent Inkscape shell; one per concurrent conversion."""
+        with self._init_lock:
+            if getattr(self, '_shell_pool', None) is None:
+                self._shell_pool = queue.Queue()
+                self._shells = []
+        try:
+            shell = self._shell_pool.get_nowait()
+        except queue.Empty:
+            shell = InkscapeShell(self.options.inkscape_path, self.inkscape_shell_args())
+            with self._init_lock:
+                self._shells.append(shell)
+        try:
+            yield shell
+        finally:
+            self._shell_pool.put(shell)
+    
+    def close_inkscape_shells(self):
+        for shell in getattr(self, '_shells', []):
+            shell.close()
+        self._shells = []
+        self._shell_pool = None
+    
+    def run_inkscape_conversion(self, cmd, input_file, output_file, actions, area=None):
+        """Run one Inkscape export, through the shell session when enabled.
+        
+        ``cmd`` is the equivalent one-shot command line (without an export
+        filename), used when the shell is disabled, unusable for this path,
+        or fails. The one-shot export goes to stdout in pipe mode. ``area``
+        is an explicit ``x0:y0:x1:y1`` export area for the shell session.
+        Returns (output bytes or None, error text).
+        """
+        timeout = self.options.convert_timeout
+        
+        def read_output():
+            try:
+                with open(output_file, 'rb') as f:
+                    return f.read() or None
+            except OSError:
+                return None
+        
+        if (self.options.converter == "shell" and self.inkscape_supports('shell')
+                and not any(c in input_file + output_file for c in ';\n')):
+            if area:
+                # The drawing/page flags would override an explicit area
+                areas = ['export-area-drawing:false', 'export-area-page:false', f'export-area:{area}']
+            else:
+                areas = ['export-area-drawing' if self.options.fit_to_content else 'export-area-page']
+            # Export settings persist in a shell session, so always set them all
+            shell_actions = ([f'file-open:{input_file}'] + actions +
+                             areas + [f'export-filename:{output_file}', 'export-do', 'file-close'])
+            try:
+                if os.path.exists(output_file):
+                    os.remove(output_file)
+                with self.inkscape_shell() as shell, self.convert_job(input_file, output_file) as job:
+                    if not shell.alive():
+                        shell.start()
+                    job['process'] = shell.process
+                    with TreeRssSampler(shell.process.pid) as sampler:
+                        transcript = shell.run(shell_actions, timeout)
+                    job['process'] = None
+                    # The session's own footprint counts: it stays resident between jobs
+                    job['peak_rss_kb'] = sampler.peak_kb
+                    if shell.alive():
+                        self.annotate_stage(converter='shell', shell_peak_rss_kb=process_peak_rss_kb(shell.process.pid))
+                self.annotate_job(job)
+                data = read_output()
+                if data:
+                    return data, ''
+                if not self.options.quiet_mode:
+                    inkex.errormsg(f"Inkscape shell produced no output, retrying one-shot:\n{transcript}")
+            except (OSError, InkscapeShellError) as e:
+                if not self.options.quiet_mode:
+                    inkex.errormsg(f"Inkscape shell failed ({str(e)}), retrying one-shot")
+        
+        pipes = self.use_pipes() and self.inkscape_supports('stdout_export')
+        cmd = cmd + ['--export-filename=' + ('-' if pipes else output_file)]
+        if not self.options.quiet_mode:
+            inkex.errormsg(f"Running: {' '.join(cmd)}")
+        try:
+            with self.convert_job(input_file, output_file) as job:
+                result = run_tool(cmd, timeout=timeout, job=job)
+            self.annotate_job(job)
+        except subprocess.TimeoutExpired:
+            return None, f"Inkscape timeout ({timeout}s)"
+        errors = result.stderr.decode('utf-8', 'replace')
+        if result.returncode != 0:
+            return None, errors
+        if pipes:
+            self.annotate_stage(io='pipe')
+            return result.stdout or None, errors
+        return read_output(), errors
+    
     def import_pdf_as_svg(self, pdf_file):
         """Import PDF as SVG using Inkscape CLI to convert."""
+        svg_data = self.convert_pdf_to_svg(pdf_file)
+        if svg_data:
+            self.import_svg(svg_data)
+    
+    def convert_pdf_to_svg(self, pdf_file):
+        """Convert PDF to plain SVG bytes using Inkscape CLI."""
         try:
-            # Create temp SVG file
+            # Shell sessions export to a file next to the PDF
             temp_dir = os.path.dirname(pdf_file)
             svg_file = os.path.join(temp_dir, "diagram_converted.svg")
             
@@ -308,116 +3714,291 @@ class MermaidGenerator(inkex.EffectExtension):
                 pdf_file,
                 '--export-type=svg',
                 '--export-plain-svg',
-                '--export-filename=' + svg_file
             ]
             
             # Add poppler option if enabled (better PDF import with text preservation)
-            if self.options.pdf_poppler:
+            if self.use_pdf_poppler():
                 cmd.insert(1, '--pdf-poppler')
             
             # Add export area option for tight cropping
             if self.options.fit_to_content:
                 cmd.append('--export-area-drawing')
             
+            # Same conversion as actions for the persistent shell
+            actions = ['export-type:svg', 'export-plain-svg']
+            
             if not self.options.quiet_mode:
-                inkex.errormsg(f"Converting PDF to SVG with Inkscape: {' '.join(cmd)}")
+                inkex.errormsg("Converting PDF to SVG with Inkscape")
             
             # Execute Inkscape conversion
-            result = subprocess.run(cmd, 
-                                  capture_output=True, 
-                                  text=True, 
-                                  timeout=60,
-                                  shell=False)
+            svg_data, errors = self.run_inkscape_conversion(cmd, pdf_file, svg_file, actions)
             
-            if result.returncode != 0:
-                inkex.errormsg(f"Inkscape conversion error:\n{result.stderr}")
-                return
+            if not svg_data:
+                inkex.errormsg(f"Inkscape conversion error:\n{errors}")
+                return None
             
-            if not os.path.exists(svg_file):
-                inkex.errormsg("Inkscape conversion failed: SVG file not created")
-                return
+            return svg_data
             
-            # Get actual dimensions
-            actual_width, actual_height = self.get_actual_dimensions(svg_file)
-            if actual_width is None:
-                actual_width = self.options.width
-                actual_height = self.options.height
+        except Exception as e:
+            inkex.errormsg(f"Error converting PDF to SVG: {str(e)}")
+            return None
+    
+    def optimize_svg_tree(self, svg_tree):
+        """Run the optional optimization stage and report what it saved."""
+        if not self.options.optimize_svg:
+            return
+        from lxml import etree
+        with self.timed_stage('optimize') as stage:
+            stage['bytes_in'] = len(etree.tostring(svg_tree))
+            before, after = optimize_svg(svg_tree, max(0, self.options.svg_precision),
+                                         self.new_id('mermaid-s') + '-')
+            stage.update(elements_in=before, elements_out=after,
+                         bytes_out=len(etree.tostring(svg_tree)))
+        if not self.options.quiet_mode:
+            inkex.errormsg(f"Optimized SVG: {before} -> {after} elements, "
+                           f"{stage['bytes_in'] / 1024:.1f} -> {stage['bytes_out'] / 1024:.1f} KiB")
+    
+    def get_defs_index(self):
+        """Return ``{digest: element}`` of the definitions in the document's ``<defs>``.
+        
+        Built from the document once per run and then kept up to date by
+        share_svg_defs, so inserting many diagrams never rescans the tree.
+        """
+        if getattr(self, '_defs_index', None) is None:
+            definitions = {child.get('id'): child for child in self.svg.defs
+                           if _local_name(child) is not None and child.get('id')}
+            memo = {}
+            self._defs_index = {}
+            for element in definitions.values():
+                self._defs_index.setdefault(definition_digest(element, definitions, memo), element)
+        return self._defs_index
+    
+    def share_svg_defs(self, svg_tree):
+        """Move the diagram's definitions into the document's shared ``<defs>``.
+        
+        A definition identical to one already in the document (the same
+        arrow marker, gradient or Poppler glyph) is dropped and its
+        references are pointed at the existing copy. IDs must already be
+        unique to this diagram.
+        """
+        if not self.options.share_defs:
+            return
+        definitions = svg_definitions(svg_tree)
+        if not definitions:
+            return
+        with self.timed_stage('defs', definitions=len(definitions)) as stage:
+            index = self.get_defs_index()
+            doc_defs = self.svg.defs
+            memo = {}
+            replaced = {}
+            moved = []
+            for element in definitions.values():
+                digest = definition_digest(element, definitions, memo)
+                kept = index.get(digest)
+                if kept is None:
+                    index[digest] = element
+                    doc_defs.append(element)
+                    moved.append(element)
+                    continue
+                # Nested IDs line up because the structures are identical
+                pairs = zip((e for e in element.iter() if _local_name(e) is not None),
+                            (e for e in kept.iter() if _local_name(e) is not None))
+                for old, new in pairs:
+                    if old.get('id') and new.get('id'):
+                        replaced[old.get('id')] = new.get('id')
+                element.getparent().remove(element)
             
-            # Calculate auto-scale if needed
-            auto_scale = self.apply_auto_scale(actual_width, actual_height)
-            final_scale = self.options.scale_factor * auto_scale
+            if replaced:
+                rewrite_svg_references(svg_tree, replaced)
+                for element in moved:
+                    rewrite_svg_references(element, replaced)
+            # Drop the wrappers Poppler leaves behind once their content moved
+            for defs in list(svg_tree.iter('{%s}defs' % SVG_NS)):
+                if all(_local_name(e) in (None, 'defs', 'g') for e in defs.iter()):
+                    defs.getparent().remove(defs)
+            stage.update(shared=len(moved), reused=len(definitions) - len(moved))
+    
+    def import_svg(self, svg_data, position=None):
+        """Insert converted SVG bytes into the document.
+        
+        The bytes are parsed once and the size is read from the same tree,
+        so multi-MB Poppler output is never decoded or parsed twice.
+        """
+        try:
+            with self.timed_stage('parse', bytes_in=len(svg_data)):
+                from lxml import etree
+                svg_tree = etree.fromstring(svg_data, etree.XMLParser(huge_tree=True))
             
-            # Read the converted SVG
-            with open(svg_file, 'r', encoding='utf-8') as f:
-                svg_content = f.read()
+            with self.timed_stage('dimensions'):
+                width, height, viewbox = svg_root_size(svg_tree)
+            origin = (0, 0)
+            px_per_unit = 1.0
+            if width is None:
+                width, height = self.options.width, self.options.height
+            elif viewbox and viewbox[2] > 0:
+                # Poppler sizes the page in pt but draws in viewBox units
+                origin = (viewbox[0], viewbox[1])
+                px_per_unit = width / viewbox[2]
             
-            # Parse SVG
-            from lxml import etree
-            svg_tree = etree.fromstring(svg_content.encode('utf-8'))
+            self.optimize_svg_tree(svg_tree)
             
-            # Get position
-            x, y = self.calculate_position(actual_width * final_scale, actual_height * final_scale)
+            # Poppler numbers IDs from 1 in every file; keep them unique per diagram
+            with self.timed_stage('postprocess'):
+                prefix_svg_ids(svg_tree, self.new_id('mermaid-') + '-')
+            self.share_svg_defs(svg_tree)
             
-            # Create a group to hold the imported SVG
-            group = inkex.Group()
+            with self.timed_stage('insert', elements=len(svg_tree)):
+                group = self.insert_svg_tree(svg_tree, width, height, origin=origin,
+                                             position=position, px_per_unit=px_per_unit)
             
-            # Set ID if provided
-            if self.options.object_id:
-                group.set('id', self.options.object_id)
-            else:
-                group.set('id', self.svg.get_unique_id('mermaid-diagram-'))
+            return group
             
-            group.label = "Mermaid Diagram"
+        except Exception as e:
+            inkex.errormsg(f"Error importing PDF as SVG: {str(e)}")
+            import traceback
+            inkex.errormsg(traceback.format_exc())
+    
+    def insert_svg_tree(self, svg_tree, actual_width, actual_height, origin=(0, 0), style=None,
+                        position=None, px_per_unit=1.0):
+        """Move a parsed SVG root into a positioned group.
+        
+        ``actual_width``/``actual_height`` are the content size in px and
+        ``px_per_unit`` converts the source coordinates to px; both are
+        mapped to document units here. ``origin`` is the top-left corner of
+        the content in the source coordinates (non-zero when the drawing was
+        cropped in-process). ``position`` overrides the placement computed by
+        calculate_position.
+        """
+        # Calculate auto-scale if needed
+        auto_scale = self.apply_auto_scale(actual_width, actual_height)
+        final_scale = self.options.scale_factor * auto_scale
+        doc_scale = self.svg.unittouu('1px')
+        
+        # Get position
+        self.last_inserted_size = (actual_width * final_scale * doc_scale,
+                                   actual_height * final_scale * doc_scale)
+        if position is None:
+            x, y = self.calculate_position(*self.last_inserted_size)
+        else:
+            x, y = position
+        
+        # Create a group to hold the imported SVG
+        group = inkex.Group()
+        
+        # Set ID if provided
+        if self.options.object_id:
+            group.set('id', self.options.object_id)
+        else:
+            group.set('id', self.new_id('mermaid-diagram-'))
+        
+        group.label = "Mermaid Diagram"
+        
+        # Apply transform with scale and position
+        inner = []
+        content_scale = final_scale * px_per_unit * doc_scale
+        if content_scale != 1.0:
+            inner.append(f'scale({content_scale:.10g})')
+        if origin != (0, 0):
+            inner.append(f'translate({-origin[0]},{-origin[1]})')
+        # The placement within the diagram's own frame, kept for in-place updates
+        self.last_inner_transform = ' '.join(inner)
+        group.set('transform', ' '.join([f'translate({x},{y})'] + inner))
+        
+        # Add metadata
+        if self.options.add_title:
+            title = inkex.Title()
+            title.text = "Mermaid Diagram"
+            group.append(title)
+        
+        if self.options.add_desc:
+            desc = inkex.Desc()
+            desc.text = self.diagram_code[:200] + "..." if len(self.diagram_code) > 200 else self.diagram_code
+            group.append(desc)
+        
+        # Move the imported root in as a plain inner group. Moving it whole
+        # keeps its namespace declarations with it; moving children one by
+        # one makes lxml re-resolve namespaces on every node (~1 s for a
+        # 1000-node flowchart)
+        svg_tree.attrib.clear()
+        svg_tree.tag = inkex.addNS('g', 'svg')
+        if style:
+            svg_tree.set('style', style)
+        group.append(svg_tree)
+        
+        # Lock if requested
+        if self.options.lock_scale:
+            group.set(inkex.addNS('insensitive', 'sodipodi'), 'true')
+        
+        # Add to appropriate layer
+        layer = self.get_layer()
+        layer.append(group)
+        return group
+    
+    def import_native_svg(self, svg_data, position=None):
+        """Insert Mermaid's own SVG output without the PDF round trip.
+        
+        Does in-process what the PDF/Poppler path gives us for free: CSS
+        from the ``<style>`` block is resolved into ``style`` attributes,
+        HTML labels in ``<foreignObject>`` become SVG text, IDs are made
+        unique and the drawing is cropped to its bounding box.
+        """
+        try:
+            with self.timed_stage('parse', bytes_in=len(svg_data)):
+                svg_tree = inkex.load_svg(io.BytesIO(svg_data)).getroot()
             
-            # Apply transform with scale and position
-            if final_scale != 1.0:
-                group.set('transform', f'translate({x},{y}) scale({final_scale})')
-            else:
-                group.set('transform', f'translate({x},{y})')
+            with self.timed_stage('postprocess'):
+                root_style = inline_svg_styles(svg_tree)
+                foreign_objects_to_text(svg_tree)
+                prefix_svg_ids(svg_tree, self.new_id('mermaid-') + '-')
             
-            # Add metadata
-            if self.options.add_title:
-                title = inkex.Title()
-                title.text = "Mermaid Diagram"
-                group.append(title)
+            # Mermaid sets width="100%"; the viewBox carries the real size
+            origin = (0, 0)
+            width = height = None
+            viewbox = svg_tree.get('viewBox')
+            if viewbox:
+                parts = [float(v) for v in viewbox.replace(',', ' ').split()]
+                if len(parts) == 4:
+                    origin = (parts[0], parts[1])
+                    width, height = parts[2], parts[3]
             
-            if self.options.add_desc:
-                desc = inkex.Desc()
-                desc.text = self.diagram_code[:200] + "..." if len(self.diagram_code) > 200 else self.diagram_code
-                group.append(desc)
+            if self.options.fit_to_content:
+                with self.timed_stage('dimensions'):
+                    bbox = svg_content_bbox(svg_tree)
+                if bbox is not None and bbox.width > 0 and bbox.height > 0:
+                    origin = (bbox.left, bbox.top)
+                    width, height = bbox.width, bbox.height
             
-            # Add all elements from the imported SVG to the group
-            for element in svg_tree:
-                group.append(element)
+            if width is None:
+                width, height = self.options.width, self.options.height
             
-            # Copy viewBox if present
-            if 'viewBox' in svg_tree.attrib:
-                group.set('viewBox', svg_tree.attrib['viewBox'])
+            # Mermaid paints the background via CSS on the root; keep it as a rect
+            if self.options.background != "transparent":
+                rect = inkex.Rectangle()
+                rect.set('x', str(origin[0]))
+                rect.set('y', str(origin[1]))
+                rect.set('width', str(width))
+                rect.set('height', str(height))
+                rect.set('style', f'fill:{self.options.background};stroke:none')
+                svg_tree.insert(0, rect)
             
-            # Lock if requested
-            if self.options.lock_scale:
-                group.set(inkex.addNS('insensitive', 'sodipodi'), 'true')
+            self.optimize_svg_tree(svg_tree)
+            self.share_svg_defs(svg_tree)
             
-            # Add to appropriate layer
-            layer = self.get_layer()
-            layer.append(group)
+            with self.timed_stage('insert', elements=len(svg_tree)):
+                group = self.insert_svg_tree(svg_tree, width, height, origin=origin,
+                                             style=root_style, position=position)
             
-            # Clean up temp SVG
-            if not self.options.keep_temp_files:
-                try:
-                    os.remove(svg_file)
-                except:
-                    pass
+            return group
             
         except Exception as e:
-            inkex.errormsg(f"Error importing PDF as SVG: {str(e)}")
+            inkex.errormsg(f"Error importing native SVG: {str(e)}")
             import traceback
             inkex.errormsg(traceback.format_exc())
     
     def convert_pdf_to_png(self, pdf_file):
-        """Convert PDF to PNG using Inkscape CLI."""
+        """Convert PDF to PNG bytes using Inkscape CLI."""
         try:
-            # Create temp PNG file
+            # Shell sessions export to a file next to the PDF
             temp_dir = os.path.dirname(pdf_file)
             png_file = os.path.join(temp_dir, "diagram_converted.png")
             
@@ -430,68 +4011,185 @@ class MermaidGenerator(inkex.EffectExtension):
                 self.options.inkscape_path, 
                 pdf_file, 
                 '--export-type=png',
-                '--export-filename=' + png_file,
                 f'--export-dpi={actual_dpi}'
             ]
             
             # Add poppler option for better text rendering
-            if self.options.pdf_poppler:
+            if self.use_pdf_poppler():
                 cmd.insert(1, '--pdf-poppler')
             
             # Add export area option for tight cropping
             if self.options.fit_to_content:
                 cmd.append('--export-area-drawing')
             
+            # Same conversion as actions for the persistent shell
+            actions = ['export-type:png', f'export-dpi:{actual_dpi}']
+            
+            if self.options.tile_size > 0:
+                mosaic = self.convert_pdf_to_png_tiles(pdf_file, actual_dpi)
+                if mosaic:
+                    return mosaic
+            
             if not self.options.quiet_mode:
-                inkex.errormsg(f"Converting PDF to PNG: {' '.join(cmd)}")
+                inkex.errormsg(f"Converting PDF to PNG at {actual_dpi} DPI")
             
             # Execute Inkscape conversion
-            result = subprocess.run(cmd, 
-                                  capture_output=True, 
-                                  text=True, 
-                                  timeout=60,
-                                  shell=False)
+            png_data, errors = self.run_inkscape_conversion(cmd, pdf_file, png_file, actions)
             
-            if result.returncode != 0:
-                inkex.errormsg(f"Inkscape PNG conversion error:\n{result.stderr}")
-                return None
-            
-            if not os.path.exists(png_file):
-                inkex.errormsg("PNG conversion failed: PNG file not created")
+            if not png_data:
+                inkex.errormsg(f"Inkscape PNG conversion error:\n{errors}")
                 return None
             
-            return png_file
+            return png_data
             
         except Exception as e:
             inkex.errormsg(f"Error converting PDF to PNG: {str(e)}")
             return None
     
-    def import_image(self, image_file):
-        """Import PNG image into document."""
+    def query_export_area(self, pdf_file):
+        """Return the ``(x, y, width, height)`` in px that a whole-diagram export covers.
+        
+        That is the drawing's bounding box when fitting to content (asked
+        from Inkscape), else the PDF page.
+        """
+        if not self.options.fit_to_content:
+            with open(pdf_file, 'rb') as f:
+                size = pdf_page_size(f.read())
+            return (0.0, 0.0, size[0] * 96 / 72, size[1] * 96 / 72) if size else None
+        cmd = [self.options.inkscape_path] + self.inkscape_shell_args() + [
+            pdf_file, '--query-x', '--query-y', '--query-width', '--query-height']
+        try:
+            with self.convert_job(pdf_file, 'query') as job:
+                result = run_tool(cmd, timeout=self.options.convert_timeout, job=job)
+        except subprocess.TimeoutExpired:
+            return None
+        values = re.findall(r'-?\d+(?:\.\d+)?(?:e[-+]?\d+)?', result.stdout.decode('utf-8', 'replace'))
+        if result.returncode != 0 or len(values) < 4:
+            return None
+        return tuple(float(v) for v in values[:4])
+    
+    def convert_pdf_to_png_tiles(self, pdf_file, dpi):
+        """Rasterize the PDF as a grid of at most ``tile_size`` px tiles.
+        
+        Every tile is an export of the same PDF with its own export area,
+        so Inkscape's peak memory follows the tile size instead of the
+        diagram size, and tiles convert concurrently. Tile edges fall on
+        whole pixels of the full-size raster, so the tiles line up exactly.
+        Returns a mosaic artifact, or None when one tile would cover the
+        whole diagram (or the area is unknown) and a single export is used.
+        """
+        area = self.query_export_area(pdf_file)
+        if not area:
+            return None
+        x, y, width, height = area
+        px_per_unit = dpi / 96.0
+        full_width = max(1, round(width * px_per_unit))
+        full_height = max(1, round(height * px_per_unit))
+        tile_size = self.options.tile_size
+        if full_width <= tile_size and full_height <= tile_size:
+            return None
+        
+        tiles = tile_grid(full_width, full_height, tile_size)
+        if not self.options.quiet_mode:
+            inkex.errormsg(f"Converting PDF to PNG at {dpi} DPI in {len(tiles)} tiles "
+                           f"({full_width}x{full_height} px)")
+        base_cmd = [self.options.inkscape_path] + self.inkscape_shell_args() + [
+            pdf_file, '--export-type=png', f'--export-dpi={dpi}']
+        actions = ['export-type:png', f'export-dpi:{dpi}']
+        # Pool threads start without this thread's variant options
+        options, memo = vars(self.options), getattr(VARIANT_STATE, 'memo', None)
+        
+        def convert(index):
+            with self.variant_options(options, memo):
+                return convert_tile(index)
+        
+        def convert_tile(index):
+            x0, y0, x1, y1 = tiles[index]
+            tile_area = (f"{x + x0 / px_per_unit:.6f}:{y + y0 / px_per_unit:.6f}:"
+                         f"{x + x1 / px_per_unit:.6f}:{y + y1 / px_per_unit:.6f}")
+            output_file = os.path.join(os.path.dirname(pdf_file), f"diagram_tile_{index}.png")
+            data, errors = self.run_inkscape_conversion(base_cmd + [f'--export-area={tile_area}'],
+                                                        pdf_file, output_file, actions, area=tile_area)
+            if not data:
+                raise RuntimeError(f"Inkscape tile {index + 1}/{len(tiles)} failed:\n{errors}")
+            return data
+        
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.options.batch_jobs)) as pool:
+            results = list(pool.map(convert, range(len(tiles))))
+        self.annotate_stage(tiles=len(tiles))
+        return mosaic_svg(full_width, full_height,
+                          [(x0, y0, data) for (x0, y0, _, _), data in zip(tiles, results)])
+    
+    def import_mosaic(self, mosaic_data, position=None):
+        """Insert a tiled PNG artifact as a group of tile images."""
+        from lxml import etree
+        root = etree.fromstring(mosaic_data)
+        width, height = float(root.get('width')), float(root.get('height'))
+        auto_scale = self.apply_auto_scale(width, height)
+        
+        self.last_inserted_size = (width * auto_scale, height * auto_scale)
+        if position is None:
+            x, y = self.calculate_position(*self.last_inserted_size)
+        else:
+            x, y = position
+        self.last_inner_transform = f'scale({auto_scale:.10g})' if auto_scale != 1.0 else ''
+        
+        group = inkex.Group()
+        group.set('id', self.options.object_id or self.new_id('mermaid-diagram-'))
+        group.label = "Mermaid Diagram"
+        group.set('transform', f'translate({x},{y}) {self.last_inner_transform}'.strip())
+        href_attr = '{%s}href' % XLINK_NS
+        data_prefix = 'data:image/png;base64,'
+        for tile in root:
+            image = inkex.Image()
+            for name in ('x', 'y', 'width', 'height'):
+                image.set(name, tile.get(name))
+            href = tile.get(href_attr)
+            if not self.options.embed_image:
+                import base64
+                image.set(href_attr, self.linked_image_href(base64.b64decode(href[len(data_prefix):])))
+            else:
+                etree._Element.set(image, href_attr, href)
+            group.append(image)
+        
+        if self.options.lock_scale:
+            group.set(inkex.addNS('insensitive', 'sodipodi'), 'true')
+        self.get_layer().append(group)
+        return group
+    
+    def import_image(self, image_data, position=None, size=None):
+        """Import PNG image bytes into document.
+        
+        ``size`` is the display size before auto-scaling; by default the
+        PNG's pixel size.
+        """
         try:
-            import base64
             from inkex import Image
             
-            # Read image data
-            with open(image_file, 'rb') as f:
-                image_data = f.read()
-            
             if len(image_data) == 0:
                 inkex.errormsg("Generated image file is empty")
                 return
             
+            if png_size(image_data) is None and image_data.startswith(b'<svg'):
+                return self.import_mosaic(image_data, position)
+            
             # Try to get image dimensions
             img_width = self.options.width
             img_height = self.options.height
             
-            try:
-                from PIL import Image as PILImage
-                pil_image = PILImage.open(image_file)
-                img_width, img_height = pil_image.size
-                pil_image.close()
-            except:
-                # If PIL not available, use specified dimensions
-                pass
+            with self.timed_stage('dimensions'):
+                size = size or png_size(image_data)
+                if size:
+                    img_width, img_height = size
+                else:
+                    try:
+                        from PIL import Image as PILImage
+                        pil_image = PILImage.open(io.BytesIO(image_data))
+                        img_width, img_height = pil_image.size
+                        pil_image.close()
+                    except:
+                        # If PIL not available, use specified dimensions
+                        pass
             
             # Calculate auto-scale if needed (for PNG, already scaled by DPI)
             auto_scale = self.apply_auto_scale(img_width, img_height)
@@ -507,26 +4205,26 @@ class MermaidGenerator(inkex.EffectExtension):
             if self.options.object_id:
                 image.set('id', self.options.object_id)
             else:
-                image.set('id', self.svg.get_unique_id('mermaid-diagram-'))
+                image.set('id', self.new_id('mermaid-diagram-'))
             
             # Embed or link image based on option
             if self.options.embed_image:
-                # Embed image
-                encoded = base64.b64encode(image_data).decode('ascii')
-                image.set('{http://www.w3.org/1999/xlink}href', f'data:image/png;base64,{encoded}')
+                # Embed image; inkex's set() would str() the bytes, so go to lxml directly
+                from lxml import etree
+                etree._Element.set(image, '{http://www.w3.org/1999/xlink}href', png_data_uri(image_data))
             else:
-                # Link to external file
-                abs_path = os.path.abspath(image_file)
-                if os.name == 'nt':
-                    abs_path = 'file:///' + abs_path.replace('\\', '/')
-                else:
-                    abs_path = 'file://' + abs_path
-                image.set('{http://www.w3.org/1999/xlink}href', abs_path)
+                # Link to a file in the asset store; it must outlive the scratch space
+                image.set('{http://www.w3.org/1999/xlink}href', self.linked_image_href(image_data))
             
             # Set position
-            x, y = self.calculate_position(final_width, final_height)
+            self.last_inserted_size = (final_width, final_height)
+            if position is None:
+                x, y = self.calculate_position(final_width, final_height)
+            else:
+                x, y = position
             image.set('x', str(x))
             image.set('y', str(y))
+            self.last_inner_transform = ''
             
             # Use calculated dimensions
             image.set('width', str(final_width))
@@ -541,18 +4239,127 @@ class MermaidGenerator(inkex.EffectExtension):
             layer = self.get_layer()
             layer.append(image)
             
-            # Clean up temp PNG only if embedded
-            if self.options.embed_image and not self.options.keep_temp_files:
-                try:
-                    os.remove(image_file)
-                except:
-                    pass
+            return image
             
         except Exception as e:
             inkex.errormsg(f"Error importing image: {str(e)}")
             import traceback
             inkex.errormsg(traceback.format_exc())
     
+    def get_asset_dir(self):
+        """Directory for linked PNGs, or None when it cannot be placed.
+        
+        ``--asset_dir`` wins (relative to the document's folder); otherwise
+        ``<document name>_assets`` next to the saved document.
+        """
+        document = self.document_path()
+        folder = os.path.dirname(document) if document else None
+        if self.options.asset_dir:
+            path = os.path.expanduser(self.options.asset_dir)
+            if not os.path.isabs(path):
+                if folder is None:
+                    return None
+                path = os.path.join(folder, path)
+            return os.path.abspath(path)
+        if folder is None:
+            return None
+        return os.path.join(folder, os.path.splitext(os.path.basename(document))[0] + '_assets')
+    
+    def linked_image_href(self, image_data):
+        """Store a PNG in the asset directory and return the href linking to it.
+        
+        Links are relative to the document when the asset directory is
+        inside its folder, so the pair can be moved together. Unsaved
+        documents fall back to a shared folder in the temp directory.
+        """
+        asset_dir = self.get_asset_dir()
+        if asset_dir is None:
+            asset_dir = os.path.join(self.options.temp_dir if self.options.temp_dir and os.path.exists(self.options.temp_dir)
+                                     else tempfile.gettempdir(), 'inkscape-mermaid-linked')
+        path = store_asset(asset_dir, image_data)
+        
+        document = self.document_path()
+        if document:
+            try:
+                relative = os.path.relpath(path, os.path.dirname(document))
+            except ValueError:  # another drive on Windows
+                relative = None
+            if relative and not relative.startswith('..'):
+                return relative.replace(os.sep, '/')
+        if os.name == 'nt':
+            return 'file:///' + path.replace('\\', '/')
+        return 'file://' + path
+    
+    def resolve_image_href(self, href):
+        """Map a linked image href to a local file path, or None."""
+        from urllib.parse import unquote, urlparse
+        if href.startswith('file:'):
+            path = unquote(urlparse(href).path)
+            if os.name == 'nt' and re.match(r'/[A-Za-z]:', path):
+                path = path[1:]
+        else:
+            path = unquote(href)
+            if not os.path.isabs(path):
+                document = self.document_path()
+                if not document:
+                    return None
+                path = os.path.join(os.path.dirname(document), path)
+        return os.path.normpath(path)
+    
+    def convert_assets(self):
+        """Pack linked Mermaid PNGs into the document, or unpack embedded ones.
+        
+        ``pack`` embeds every image linked to a content-named Mermaid PNG,
+        giving a self-contained file for export. ``unpack`` moves the
+        embedded PNG of every registered diagram into the asset store,
+        keeping the working file small and fast to save.
+        """
+        from lxml import etree
+        import base64
+        action = self.options.asset_action
+        if action == "unpack" and self.get_asset_dir() is None:
+            inkex.errormsg("Save the document first (or set an absolute asset directory) to unpack images")
+            return
+        
+        href_attrs = ('{%s}href' % XLINK_NS, 'href')
+        data_prefix = 'data:image/png;base64,'
+        converted = missing = 0
+        with self.timed_stage('assets', action=action) as stage:
+            for image in self.svg.xpath('//svg:image'):
+                attr = next((a for a in href_attrs if image.get(a)), None)
+                if attr is None:
+                    continue
+                href = image.get(attr)
+                if action == "pack":
+                    if href.startswith('data:'):
+                        continue
+                    path = self.resolve_image_href(href)
+                    if path is None or not ASSET_NAME_RE.search(os.path.basename(path)):
+                        continue
+                    try:
+                        with open(path, 'rb') as f:
+                            data = f.read()
+                    except OSError:
+                        missing += 1
+                        continue
+                    etree._Element.set(image, attr, png_data_uri(data))
+                else:
+                    # Tiles of a mosaic carry the registry attributes on their group
+                    registered = image.get(mermaid_attr('source')) is not None or (
+                        image.getparent().get(mermaid_attr('source')) is not None)
+                    if not registered or not href.startswith(data_prefix):
+                        continue
+                    data = base64.b64decode(href[len(data_prefix):])
+                    image.set(attr, self.linked_image_href(data))
+                converted += 1
+            stage.update(converted=converted, missing=missing)
+        
+        if missing:
+            inkex.errormsg(f"{missing} linked images could not be read and were left linked")
+        if not self.options.quiet_mode:
+            verb = "Embedded" if action == "pack" else "Linked"
+            inkex.errormsg(f"{verb} {converted} images" + ("" if action == "pack" else f" in {self.get_asset_dir()}"))
+    
     def get_reference_bounds(self):
         """Get bounds for positioning reference (page or selection)."""
         if self.options.use_selection_bbox and self.svg.selection:
@@ -0,0 +1,1125 @@
+#!/usr/bin/env python3
+# MIT License
+
+# Copyright (c) 2026 Rachid, Youven ZEGHLACHE
+
+"""
+Built-in renderer for simple Mermaid diagrams.
+
+Covers a practical subset without Node or Chromium: flowcharts (common node
+shapes and link types), pie charts and simple sequence diagrams. Anything
+outside the subset raises UnsupportedDiagram so the caller can fall back to
+Mermaid CLI:
+
+    try:
+        svg_bytes = render_svg(code, theme='dark')
+    except UnsupportedDiagram:
+        ...  # render with mmdc
+
+The output is a self-contained SVG (inline styles, no CSS, no
+foreignObject) sized in CSS px like Mermaid's own output.
+"""
+import math
+import re
+from xml.sax.saxutils import escape
+
+RENDERER_VERSION = 'lite-1'
+
+FONT_FAMILY = "'trebuchet ms',verdana,arial,sans-serif"
+FONT_SIZE = 16
+LINE_HEIGHT = 24
+DIAGRAM_PADDING = 8
+
+THEMES = {
+    'default': {
+        'node_fill': '#ECECFF', 'node_border': '#9370DB', 'text': '#333333', 'line': '#333333',
+        'edge_label_bg': '#e8e8e8', 'actor_border': '#9370DB', 'note_fill': '#fff5ad',
+        'note_border': '#aaaa33', 'note_text': '#333333', 'pie_stroke': '#000000',
+        'pie': ('#ECECFF', '#ffffde', '#b9ff5e', '#b5b5ff', '#ffff5e', '#5eff5e',
+                '#9e9eff', '#fbfb8f', '#d9fab0', '#8c8cff', '#e9e9a2', '#c6ffc6'),
+    },
+    'base': {
+        'node_fill': '#fff4dd', 'node_border': '#9f7a4c', 'text': '#333333', 'line': '#333333',
+        'edge_label_bg': '#e8e8e8', 'actor_border': '#9f7a4c', 'note_fill': '#fff5ad',
+        'note_border': '#aaaa33', 'note_text': '#333333', 'pie_stroke': '#000000',
+        'pie': ('#fff4dd', '#ddffe8', '#dde4ff', '#ffdde0', '#ffe9b8', '#b8ffce',
+                '#b8c6ff', '#ffb8bf', '#ffeecf', '#cfffdd', '#cfd7ff', '#ffcfd3'),
+    },
+    'dark': {
+        'node_fill': '#1f2020', 'node_border': '#cccccc', 'text': '#cccccc', 'line': '#d3d3d3',
+        'edge_label_bg': '#585858', 'actor_border': '#cccccc', 'note_fill': '#fff5ad',
+        'note_border': '#aaaa33', 'note_text': '#333333', 'pie_stroke': '#000000',
+        'pie': ('#4b6f8f', '#8f6f4b', '#5f8f4b', '#8f4b6f', '#4b8f8a', '#7a4b8f',
+                '#8f8a4b', '#4b5a8f', '#8f5a4b', '#5a8f6f', '#6f4b8f', '#8f4b4b'),
+    },
+    'forest': {
+        'node_fill': '#cde498', 'node_border': '#13540c', 'text': '#000000', 'line': '#008000',
+        'edge_label_bg': '#e8e8e8', 'actor_border': '#13540c', 'note_fill': '#fff5ad',
+        'note_border': '#6eaa49', 'note_text': '#000000', 'pie_stroke': '#000000',
+        'pie': ('#cde498', '#cdffb2', '#a5d49a', '#93c374', '#7ab06b', '#6e9b5e',
+                '#b0d48c', '#8ec07c', '#5c8a50', '#4f7a41', '#d9efb0', '#c1df91'),
+    },
+    'neutral': {
+        'node_fill': '#eeeeee', 'node_border': '#999999', 'text': '#333333', 'line': '#666666',
+        'edge_label_bg': '#ffffff', 'actor_border': '#999999', 'note_fill': '#666666',
+        'note_border': '#999999', 'note_text': '#ffffff', 'pie_stroke': '#000000',
+        'pie': ('#eeeeee', '#dddddd', '#cccccc', '#bbbbbb', '#aaaaaa', '#999999',
+                '#e3e3e3', '#d1d1d1', '#bfbfbf', '#adadad', '#9b9b9b', '#898989'),
+    },
+}
+
+# Advance widths in em, close enough to Trebuchet MS for box sizing
+_NARROW_CHARS = frozenset("ijl|!.,:;'`")
+_SEMI_NARROW_CHARS = frozenset("frt()[]{}-/\\\"I ")
+_WIDE_CHARS = frozenset('mwMW@%')
+
+
+class UnsupportedDiagram(Exception):
+    """The source uses syntax outside the built-in renderer's subset."""
+
+
+def text_width(text, size=FONT_SIZE):
+    """Estimate the rendered width of one line of text in px."""
+    width = 0.0
+    for char in text:
+        if char in _NARROW_CHARS:
+            width += 0.27
+        elif char in _SEMI_NARROW_CHARS:
+            width += 0.36
+        elif char in _WIDE_CHARS:
+            width += 0.85
+        elif char.isupper():
+            width += 0.64
+        else:
+            width += 0.55
+    return width * size
+
+
+ENTITY_RE = re.compile(r'#(\w+);')
+NAMED_ENTITIES = {'quot': '"', 'amp': '&', 'lt': '<', 'gt': '>', 'nbsp': ' '}
+BR_RE = re.compile(r'<br\s*/?>', re.IGNORECASE)
+
+
+def label_lines(text):
+    """Split a label at ``<br>`` and decode Mermaid's ``#name;`` entities."""
+    text = text.strip()
+    if text.startswith('`'):
+        raise UnsupportedDiagram("markdown strings")
+    lines = BR_RE.split(text)
+    for line in lines:
+        if '<' in line and re.search(r'<\s*/?[a-zA-Z]', line):
+            raise UnsupportedDiagram("HTML in labels")
+
+    def entity(match):
+        name = match.group(1)
+        if name.isdigit():
+            return chr(int(name))
+        if name in NAMED_ENTITIES:
+            return NAMED_ENTITIES[name]
+        raise UnsupportedDiagram(f"entity #{name};")
+
+    return [ENTITY_RE.sub(entity, line).strip() for line in lines]
+
+
+def _strip_comments(code):
+    lines = []
+    for line in code.splitlines():
+        if line.lstrip().startswith('%%'):
+            if line.lstrip().startswith('%%{'):
+                raise UnsupportedDiagram("init directives")
+            continue
+        lines.append(line.rstrip())
+    return lines
+
+
+def _fmt(value):
+    return f"{value:.2f}".rstrip('0').rstrip('.')
+
+
+class SvgWriter:
+    """Collects SVG markup with inline styles."""
+
+    def __init__(self, theme, background):
+        self.theme = theme
+        self.background = background
+        self.defs = {}
+        self.parts = []
+
+    def add(self, markup):
+        self.parts.append(markup)
+
+    def text(self, x, y, lines, fill=None, size=FONT_SIZE, anchor='middle', weight=None):
+        """Add text vertically centred on ``y``, one tspan per line."""
+        fill = fill or self.theme['text']
+        line_height = LINE_HEIGHT * size / FONT_SIZE
+        top = y - line_height * (len(lines) - 1) / 2 + size * 0.35
+        style = f"font-family:{FONT_FAMILY};font-size:{size}px;fill:{fill};text-anchor:{anchor}"
+        if weight:
+            style += f";font-weight:{weight}"
+        spans = ''.join(
+            f'<tspan x="{_fmt(x)}" y="{_fmt(top + index * line_height)}">{escape(line)}</tspan>'
+            for index, line in enumerate(lines))
+        self.add(f'<text style="{style}">{spans}</text>')
+
+    def marker(self, name):
+        """Register an edge-end marker and return its ``url(#...)``."""
+        color = self.theme['line']
+        shapes = {
+            'arrow': ('9', f'<path d="M0,0 L10,5 L0,10 z" style="fill:{color};stroke:none"/>'),
+            'arrow_start': ('1', f'<path d="M10,0 L0,5 L10,10 z" style="fill:{color};stroke:none"/>'),
+            'circle': ('9', f'<circle cx="5" cy="5" r="4" style="fill:{color};stroke:none"/>'),
+            'circle_start': ('1', f'<circle cx="5" cy="5" r="4" style="fill:{color};stroke:none"/>'),
+            'cross': ('8', f'<path d="M1,1 L9,9 M9,1 L1,9" style="fill:none;stroke:{color};stroke-width:2"/>'),
+            'cross_start': ('2', f'<path d="M1,1 L9,9 M9,1 L1,9" style="fill:none;stroke:{color};stroke-width:2"/>'),
+            'open': ('9', f'<path d="M0,0 L10,5 L0,10" style="fill:none;stroke:{color};stroke-width:1.5"/>'),
+        }
+        ref_x, body = shapes[name]
+        marker_id = f'lite-{name}'
+        if marker_id not in self.defs:
+            self.defs[marker_id] = (
+                f'<marker id="{marker_id}" viewBox="0 0 10 10" refX="{ref_x}" refY="5" '
+                f'markerUnits="userSpaceOnUse" markerWidth="12" markerHeight="12" orient="auto">'
+                f'{body}</marker>')
+        return f'url(#{marker_id})'
+
+    def tostring(self, width, height):
+        width, height = math.ceil(width), math.ceil(height)
+        out = [f'<svg xmlns="http://www.w3.org/2000/svg" class="mermaid-lite" '
+               f'width="{width}" height="{height}" viewBox="0 0 {width} {height}">']
+        if self.defs:
+            out.append('<defs>' + ''.join(self.defs.values()) + '</defs>')
+        if self.background and self.background != 'transparent':
+            out.append(f'<rect x="0" y="0" width="{width}" height="{height}" '
+                       f'style="fill:{escape(self.background)};stroke:none"/>')
+        out.extend(self.parts)
+        out.append('</svg>')
+        return ''.join(out).encode('utf-8')
+
+
+# ---------------------------------------------------------------------------
+# Flowcharts
+
+FLOWCHART_HEADER_RE = re.compile(r'^(?:graph|flowchart)(?:\s+(TD|TB|BT|LR|RL))?\s*;?\s*$')
+NODE_ID_RE = re.compile(r'[^\W\d][\w]*(?:-\w+)*|\d[\w]*')
+FLOWCHART_KEYWORDS = ('subgraph', 'end', 'classDef', 'class', 'style', 'linkStyle', 'click',
+                      'direction', 'accTitle', 'accDescr', 'callback')
+LINK_RE = re.compile(
+    r'(?P<start><)?'
+    r'(?:(?P<solid>-{2,}(?=>|[ox](?!\w))|-{3,})'
+    r'|(?P<dotted>-\.+-)'
+    r'|(?P<thick>={2,}(?=>|[ox](?!\w))|={3,})'
+    r'|(?P<invisible>~{3,}))'
+    r'(?P<end>>|[ox](?!\w))?')
+LABELED_LINK_RE = re.compile(
+    r'(?P<start><)?(?P<open>--|-\.|==)(?![->.=])\s*(?P<text>"[^"]*"|[^"|]+?)\s*'
+    r'(?P<close>-{2,}|\.+-|={2,})(?P<end>>|[ox](?!\w))?')
+EDGE_TEXT_RE = re.compile(r'\s*\|(?P<text>[^|]*)\|')
+
+# (opener, closer, shape), longest openers first
+NODE_SHAPES = (
+    ('(((', ')))', 'doublecircle'),
+    ('([', '])', 'stadium'),
+    ('[[', ']]', 'subroutine'),
+    ('[(', ')]', 'cylinder'),
+    ('((', '))', 'circle'),
+    ('{{', '}}', 'hexagon'),
+    ('[/', '/]', 'lean_right'),
+    ('[/', '\\]', 'trapezoid'),
+    ('[\\', '\\]', 'lean_left'),
+    ('[\\', '/]', 'inv_trapezoid'),
+    ('>', ']', 'odd'),
+    ('[', ']', 'rect'),
+    ('(', ')', 'round'),
+    ('{', '}', 'diamond'),
+)
+
+NODE_PADDING = 15
+NODE_SPACING = 50
+RANK_SPACING = 50
+DUMMY_SPACING = 20
+SELF_LOOP_WIDTH = 25
+
+
+def statement_spans(line):
+    """Yield (start, end) for each ``;``-separated statement of a flowchart line.
+    
+    A ``;`` inside quotes, a node shape or a ``|link text|`` is text. The
+    syntax pre-check in mermaid_diagram splits statements the same way.
+    """
+    start, quoted, depth, piped = 0, False, 0, False
+    for index, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif char in '[({':
+            depth += 1
+        elif char in '])}':
+            depth = max(0, depth - 1)
+        elif char == '|' and not depth:
+            piped = not piped
+        elif char == ';' and not depth and not piped:
+            yield start, index
+            start = index + 1
+    yield start, len(line)
+
+
+def _split_statements(line):
+    parts = (line[start:end].strip() for start, end in statement_spans(line))
+    return [part for part in parts if part]
+
+
+class Flowchart:
+    def __init__(self, direction):
+        self.direction = direction
+        self.nodes = {}  # id -> {'shape', 'lines'}, in definition order
+        self.edges = []  # dicts with source, target, style, head, tail, lines
+
+    def node(self, node_id, shape=None, label=None):
+        node = self.nodes.get(node_id)
+        if node is None:
+            node = self.nodes[node_id] = {'shape': 'rect', 'lines': [node_id]}
+        if shape is not None:
+            node['shape'] = shape
+            node['lines'] = label_lines(label)
+        return node_id
+
+
+def _parse_node(text, pos, chart):
+    match = NODE_ID_RE.match(text, pos)
+    if not match:
+        raise UnsupportedDiagram(f"unexpected text: {text[pos:pos + 20]!r}")
+    node_id = match.group()
+    if node_id in FLOWCHART_KEYWORDS:
+        raise UnsupportedDiagram(f"'{node_id}' statements")
+    pos = match.end()
+    for opener in sorted({shape[0] for shape in NODE_SHAPES}, key=len, reverse=True):
+        if not text.startswith(opener, pos):
+            continue
+        candidates = [(closer, shape) for open_, closer, shape in NODE_SHAPES if open_ == opener]
+        start = pos + len(opener)
+        if text.startswith('"', start):
+            end_quote = text.find('"', start + 1)
+            if end_quote < 0:
+                raise UnsupportedDiagram("unterminated string")
+            label = text[start + 1:end_quote]
+            for closer, shape in candidates:
+                if text.startswith(closer, end_quote + 1):
+                    return chart.node(node_id, shape, label), end_quote + 1 + len(closer)
+            raise UnsupportedDiagram("unbalanced node shape")
+        best = None
+        for closer, shape in candidates:
+            index = text.find(closer, start)
+            if index >= 0 and (best is None or index < best[0]
+                               or (index == best[0] and len(closer) > len(best[1]))):
+                best = (index, closer, shape)
+        if best is None:
+            raise UnsupportedDiagram("unbalanced node shape")
+        index, closer, shape = best
+        return chart.node(node_id, shape, text[start:index]), index + len(closer)
+    return chart.node(node_id), pos
+
+
+def _parse_node_group(text, pos, chart):
+    ids = []
+    while True:
+        pos = _skip_space(text, pos)
+        node_id, pos = _parse_node(text, pos, chart)
+        ids.append(node_id)
+        after = _skip_space(text, pos)
+        if text.startswith('&', after):
+            pos = after + 1
+            continue
+        return ids, pos
+
+
+def _skip_space(text, pos):
+    while pos < len(text) and text[pos] in ' \t':
+        pos += 1
+    return pos
+
+
+def _parse_link(text, pos):
+    match = LINK_RE.match(text, pos)
+    lines = None
+    if match:
+        kind = next(name for name in ('solid', 'dotted', 'thick', 'invisible') if match.group(name))
+        pos = match.end()
+        label = EDGE_TEXT_RE.match(text, pos)
+        if label:
+            lines = label_lines(label.group('text').strip('"'))
+            pos = label.end()
+    else:
+        match = LABELED_LINK_RE.match(text, pos)
+        if not match:
+            raise UnsupportedDiagram(f"unrecognized link: {text[pos:pos + 20]!r}")
+        kinds = {'--': ('solid', '-'), '-.': ('dotted', '.'), '==': ('thick', '=')}
+        kind, close_char = kinds[match.group('open')]
+        if close_char not in match.group('close') or (close_char == '.' and not match.group('close').endswith('-')):
+            raise UnsupportedDiagram("mismatched link")
+        lines = label_lines(match.group('text').strip('"'))
+        pos = match.end()
+    ends = {None: None, '>': 'arrow', 'o': 'circle', 'x': 'cross'}
+    head = ends[match.group('end')]
+    tail = head if match.group('start') else None
+    if match.group('start') and head is None:
+        raise UnsupportedDiagram("unrecognized link")
+    return {'style': kind, 'head': head, 'tail': tail, 'lines': lines}, pos
+
+
+def parse_flowchart(lines):
+    match = FLOWCHART_HEADER_RE.match(lines[0].strip())
+    if not match:
+        raise UnsupportedDiagram("flowchart header")
+    chart = Flowchart(match.group(1) or 'TD')
+    for line in lines[1:]:
+        for statement in _split_statements(line):
+            if ':::' in statement or '@{' in statement or statement.startswith('%%'):
+                raise UnsupportedDiagram("classes and extended shapes")
+            group, pos = _parse_node_group(statement, 0, chart)
+            while True:
+                pos = _skip_space(statement, pos)
+                if pos >= len(statement):
+                    break
+                link, pos = _parse_link(statement, pos)
+                targets, pos = _parse_node_group(statement, pos, chart)
+                for source in group:
+                    for target in targets:
+                        chart.edges.append(dict(link, source=source, target=target))
+                group = targets
+    if not chart.nodes:
+        raise UnsupportedDiagram("empty flowchart")
+    return chart
+
+
+def _node_size(shape, lines):
+    text_w = max(text_width(line) for line in lines) if any(lines) else 0
+    text_h = LINE_HEIGHT * len(lines)
+    width, height = text_w + 2 * NODE_PADDING, text_h + 2 * NODE_PADDING
+    if shape == 'stadium':
+        width += height / 2
+    elif shape in ('circle', 'doublecircle'):
+        width = height = max(text_w, text_h) + NODE_PADDING * 2
+        if shape == 'doublecircle':
+            width = height = width + 10
+    elif shape == 'diamond':
+        width = height = text_w + text_h + 2 * NODE_PADDING
+    elif shape in ('hexagon', 'lean_right', 'lean_left', 'trapezoid', 'inv_trapezoid'):
+        width += height / 2
+    elif shape == 'odd':
+        width += height / 4
+    elif shape == 'cylinder':
+        height += 2 * min(width * 0.1, 12)
+    elif shape == 'subroutine':
+        width += 16
+    return width, height
+
+
+def _place_rank(desired, sizes, gaps):
+    """Least-squares positions for ordered nodes that must not overlap.
+
+    ``desired`` are wanted centres, ``sizes`` widths along the rank and
+    ``gaps[i]`` the spacing between node i and i+1. Pools adjacent
+    violators into blocks whose centre is the mean of their members'
+    wishes.
+    """
+    offsets = [0.0]
+    for index in range(1, len(desired)):
+        offsets.append(offsets[-1] + sizes[index - 1] / 2 + gaps[index - 1] + sizes[index] / 2)
+    blocks = []  # [first, last, sum of (desired - offset), count]
+    for index, want in enumerate(desired):
+        blocks.append([index, index, want - offsets[index], 1])
+        while len(blocks) > 1:
+            prev, last = blocks[-2], blocks[-1]
+            if prev[2] / prev[3] <= last[2] / last[3]:
+                break
+            blocks[-2:] = [[prev[0], last[1], prev[2] + last[2], prev[3] + last[3]]]
+    positions = []
+    for first, last, total, count in blocks:
+        base = total / count
+        positions.extend(base + offsets[index] for index in range(first, last + 1))
+    return positions
+
+
+def _count_crossings(upper, lower, links):
+    position = {node: index for index, node in enumerate(lower)}
+    pairs = []
+    for index, node in enumerate(upper):
+        for target in links.get(node, ()):
+            if target in position:
+                pairs.append((index, position[target]))
+    crossings = 0
+    for i in range(len(pairs)):
+        for j in range(i + 1, len(pairs)):
+            if (pairs[i][0] - pairs[j][0]) * (pairs[i][1] - pairs[j][1]) < 0:
+                crossings += 1
+    return crossings
+
+
+def layout_flowchart(chart):
+    """Layered layout: rank, order by barycentre, then place by least squares.
+
+    Returns node centres and sizes plus a point list per edge, in a frame
+    where ranks run down the y axis; the caller rotates it for LR/RL/BT.
+    """
+    vertical = chart.direction in ('TD', 'TB', 'BT')
+    loops = {edge['source'] for edge in chart.edges
+             if edge['source'] == edge['target'] and edge['style'] != 'invisible'}
+    sizes = {}
+    for node_id, node in chart.nodes.items():
+        width, height = _node_size(node['shape'], node['lines'])
+        if node_id in loops:
+            # Room for the loop drawn on the right-hand side
+            width += 2 * SELF_LOOP_WIDTH
+        # breadth runs along a rank, depth across ranks
+        sizes[node_id] = (width, height) if vertical else (height, width)
+
+    # Break cycles with a DFS in definition order
+    out_edges = {node_id: [] for node_id in chart.nodes}
+    for index, edge in enumerate(chart.edges):
+        if edge['source'] != edge['target']:
+            out_edges[edge['source']].append((edge['target'], index))
+    reversed_edges = set()
+    state = {}
+    for root in chart.nodes:
+        if root in state:
+            continue
+        stack = [(root, iter(out_edges[root]))]
+        state[root] = 'active'
+        while stack:
+            node_id, children = stack[-1]
+            for target, index in children:
+                if state.get(target) == 'active':
+                    reversed_edges.add(index)
+                elif target not in state:
+                    state[target] = 'active'
+                    stack.append((target, iter(out_edges[target])))
+                    break
+            else:
+                state[node_id] = 'done'
+                stack.pop()
+
+    dag = []  # (upper, lower, edge index)
+    for index, edge in enumerate(chart.edges):
+        if edge['source'] == edge['target']:
+            continue
+        if index in reversed_edges:
+            dag.append((edge['target'], edge['source'], index))
+        else:
+            dag.append((edge['source'], edge['target'], index))
+
+    # Longest-path ranking, then pull sources down next to their children
+    rank = {node_id: 0 for node_id in chart.nodes}
+    preds = {node_id: [] for node_id in chart.nodes}
+    succs = {node_id: [] for node_id in chart.nodes}
+    for upper, lower, _ in dag:
+        preds[lower].append(upper)
+        succs[upper].append(lower)
+    indegree = {node_id: len(preds[node_id]) for node_id in chart.nodes}
+    ready = [node_id for node_id in chart.nodes if indegree[node_id] == 0]
+    topo = []
+    while ready:
+        node_id = ready.pop(0)
+        topo.append(node_id)
+        for child in succs[node_id]:
+            rank[child] = max(rank[child], rank[node_id] + 1)
+            indegree[child] -= 1
+            if indegree[child] == 0:
+                ready.append(child)
+    for node_id in reversed(topo):
+        if not preds[node_id] and succs[node_id]:
+            rank[node_id] = min(rank[child] for child in succs[node_id]) - 1
+    lowest = min(rank.values())
+    for node_id in rank:
+        rank[node_id] -= lowest
+
+    # Dummy nodes give long edges a lane through intermediate ranks
+    layers = [[] for _ in range(max(rank.values()) + 1)]
+    for node_id in chart.nodes:
+        layers[rank[node_id]].append(node_id)
+    chains = {}
+    down = {}
+    for upper, lower, index in dag:
+        chain = [upper]
+        for level in range(rank[upper] + 1, rank[lower]):
+            dummy = ('dummy', index, level)
+            sizes[dummy] = (0.0, 0.0)
+            rank[dummy] = level
+            layers[level].append(dummy)
+            chain.append(dummy)
+        chain.append(lower)
+        chains[index] = chain
+        for a, b in zip(chain, chain[1:]):
+            down.setdefault(a, []).append(b)
+    up = {}
+    for a, targets in down.items():
+        for b in targets:
+            up.setdefault(b, []).append(a)
+
+    def crossings(order):
+        return sum(_count_crossings(order[level], order[level + 1], down) for level in range(len(order) - 1))
+
+    best = [list(layer) for layer in layers]
+    best_crossings = crossings(best)
+    order = [list(layer) for layer in best]
+    for sweep in range(8):
+        levels = range(1, len(order)) if sweep % 2 == 0 else range(len(order) - 2, -1, -1)
+        neighbours = up if sweep % 2 == 0 else down
+        for level in levels:
+            adjacent = order[level - 1] if sweep % 2 == 0 else order[level + 1]
+            position = {node: index for index, node in enumerate(adjacent)}
+            current = {node: index for index, node in enumerate(order[level])}
+
+            def barycentre(node):
+                linked = [position[n] for n in neighbours.get(node, ()) if n in position]
+                return sum(linked) / len(linked) if linked else current[node]
+
+            order[level].sort(key=lambda node: (barycentre(node), current[node]))
+        count = crossings(order)
+        if count < best_crossings:
+            best, best_crossings = [list(layer) for layer in order], count
+    order = best
+
+    # Rank positions, leaving room for edge labels between ranks
+    label_depth = 0.0
+    for edge in chart.edges:
+        if edge['lines']:
+            label_w = max(text_width(line) for line in edge['lines']) + 8
+            label_h = LINE_HEIGHT * len(edge['lines']) + 4
+            label_depth = max(label_depth, label_h if vertical else label_w)
+    rank_gap = RANK_SPACING + label_depth
+    depth_of = [max((sizes[node][1] for node in layer), default=0) for layer in order]
+    rank_centre = []
+    cursor = 0.0
+    for depth in depth_of:
+        rank_centre.append(cursor + depth / 2)
+        cursor += depth + rank_gap
+
+    def gaps(layer):
+        return [DUMMY_SPACING if isinstance(a, tuple) or isinstance(b, tuple) else NODE_SPACING
+                for a, b in zip(layer, layer[1:])]
+
+    x = {}
+    for layer in order:
+        placed = _place_rank([0.0] * len(layer), [sizes[node][0] for node in layer], gaps(layer))
+        x.update(zip(layer, placed))
+    for sweep in range(12):
+        levels = range(1, len(order)) if sweep % 2 == 0 else range(len(order) - 2, -1, -1)
+        neighbours = up if sweep % 2 == 0 else down
+        for level in levels:
+            layer = order[level]
+            desired = []
+            for node in layer:
+                linked = [x[n] for n in neighbours.get(node, ())]
+                desired.append(sum(linked) / len(linked) if linked else x[node])
+            x.update(zip(layer, _place_rank(desired, [sizes[node][0] for node in layer], gaps(layer))))
+
+    left = min(x[node] - sizes[node][0] / 2 for node in x)
+    centres = {node: (x[node] - left, rank_centre[rank[node]]) for node in x}
+
+    edge_points = {}
+    for index, chain in chains.items():
+        points = [centres[node] for node in chain]
+        if index in reversed_edges:
+            points.reverse()
+        edge_points[index] = points
+    return centres, sizes, edge_points, vertical
+
+
+def _clip(shape, centre, size, toward):
+    """Point where the segment from the node centre to ``toward`` leaves the shape."""
+    cx, cy = centre
+    dx, dy = toward[0] - cx, toward[1] - cy
+    if dx == 0 and dy == 0:
+        return centre
+    half_w, half_h = size[0] / 2, size[1] / 2
+    if shape in ('circle', 'doublecircle'):
+        scale = half_w / math.hypot(dx, dy)
+    elif shape == 'diamond':
+        scale = 1.0 / (abs(dx) / half_w + abs(dy) / half_h)
+    else:
+        scale = min(half_w / abs(dx) if dx else math.inf, half_h / abs(dy) if dy else math.inf)
+    return cx + dx * min(scale, 1.0), cy + dy * min(scale, 1.0)
+
+
+def _curve(points):
+    """Path through ``points``, smoothed with Catmull-Rom segments."""
+    d = [f"M{_fmt(points[0][0])},{_fmt(points[0][1])}"]
+    if len(points) == 2:
+        d.append(f"L{_fmt(points[1][0])},{_fmt(points[1][1])}")
+        return ' '.join(d)
+    for index in range(len(points) - 1):
+        p0 = points[max(index - 1, 0)]
+        p1, p2 = points[index], points[index + 1]
+        p3 = points[min(index + 2, len(points) - 1)]
+        c1 = (p1[0] + (p2[0] - p0[0]) / 6, p1[1] + (p2[1] - p0[1]) / 6)
+        c2 = (p2[0] - (p3[0] - p1[0]) / 6, p2[1] - (p3[1] - p1[1]) / 6)
+        d.append(f"C{_fmt(c1[0])},{_fmt(c1[1])} {_fmt(c2[0])},{_fmt(c2[1])} {_fmt(p2[0])},{_fmt(p2[1])}")
+    return ' '.join(d)
+
+
+def _midpoint(points):
+    lengths = [math.dist(a, b) for a, b in zip(points, points[1:])]
+    remaining = sum(lengths) / 2
+    for (a, b), length in zip(zip(points, points[1:]), lengths):
+        if remaining <= length and length > 0:
+            t = remaining / length
+            return a[0] + (b[0] - a[0]) * t, a[1] + (b[1] - a[1]) * t
+        remaining -= length
+    return points[-1]
+
+
+def _shape_markup(shape, cx, cy, width, height, style):
+    left, top = cx - width / 2, cy - height / 2
+    right, bottom = cx + width / 2, cy + height / 2
+
+    def polygon(points):
+        return '<polygon points="' + ' '.join(f"{_fmt(px)},{_fmt(py)}" for px, py in points) + f'" style="{style}"/>'
+
+    if shape == 'rect':
+        return f'<rect x="{_fmt(left)}" y="{_fmt(top)}" width="{_fmt(width)}" height="{_fmt(height)}" style="{style}"/>'
+    if shape == 'round':
+        return (f'<rect x="{_fmt(left)}" y="{_fmt(top)}" width="{_fmt(width)}" height="{_fmt(height)}" '
+                f'rx="5" ry="5" style="{style}"/>')
+    if shape == 'stadium':
+        radius = height / 2
+        return (f'<rect x="{_fmt(left)}" y="{_fmt(top)}" width="{_fmt(width)}" height="{_fmt(height)}" '
+                f'rx="{_fmt(radius)}" ry="{_fmt(radius)}" style="{style}"/>')
+    if shape == 'subroutine':
+        return (f'<rect x="{_fmt(left)}" y="{_fmt(top)}" width="{_fmt(width)}" height="{_fmt(height)}" style="{style}"/>'
+                f'<path d="M{_fmt(left + 8)},{_fmt(top)} V{_fmt(bottom)} M{_fmt(right - 8)},{_fmt(top)} V{_fmt(bottom)}" '
+                f'style="{style};fill:none"/>')
+    if shape == 'circle':
+        return f'<circle cx="{_fmt(cx)}" cy="{_fmt(cy)}" r="{_fmt(width / 2)}" style="{style}"/>'
+    if shape == 'doublecircle':
+        return (f'<circle cx="{_fmt(cx)}" cy="{_fmt(cy)}" r="{_fmt(width / 2)}" style="{style}"/>'
+                f'<circle cx="{_fmt(cx)}" cy="{_fmt(cy)}" r="{_fmt(width / 2 - 5)}" style="{style}"/>')
+    if shape == 'diamond':
+        return polygon([(cx, top), (right, cy), (cx, bottom), (left, cy)])
+    if shape == 'hexagon':
+        inset = height / 4
+        return polygon([(left + inset, top), (right - inset, top), (right, cy),
+                        (right - inset, bottom), (left + inset, bottom), (left, cy)])
+    if shape == 'odd':
+        notch = height / 4
+        return polygon([(left, top), (right, top), (right, bottom), (left, bottom), (left + notch, cy)])
+    inset = height / 4
+    if shape == 'lean_right':
+        return polygon([(left + inset, top), (right, top), (right - inset, bottom), (left, bottom)])
+    if shape == 'lean_left':
+        return polygon([(left, top), (right - inset, top), (right, bottom), (left + inset, bottom)])
+    if shape == 'trapezoid':
+        return polygon([(left + inset, top), (right - inset, top), (right, bottom), (left, bottom)])
+    if shape == 'inv_trapezoid':
+        return polygon([(left, top), (right, top), (right - inset, bottom), (left + inset, bottom)])
+    if shape == 'cylinder':
+        ry = min(width * 0.1, 12)
+        rx = width / 2
+        body_top, body_bottom = top + ry, bottom - ry
+        return (f'<path d="M{_fmt(left)},{_fmt(body_top)} A{_fmt(rx)},{_fmt(ry)} 0 0 0 {_fmt(right)},{_fmt(body_top)} '
+                f'A{_fmt(rx)},{_fmt(ry)} 0 0 0 {_fmt(left)},{_fmt(body_top)} V{_fmt(body_bottom)} '
+                f'A{_fmt(rx)},{_fmt(ry)} 0 0 0 {_fmt(right)},{_fmt(body_bottom)} V{_fmt(body_top)}" style="{style}"/>')
+    raise UnsupportedDiagram(f"shape {shape}")
+
+
+def render_flowchart(chart, writer):
+    centres, sizes, edge_points, vertical = layout_flowchart(chart)
+    theme = writer.theme
+
+    def to_svg(point):
+        """Rotate the layered frame into the chart's direction."""
+        along, across = point
+        if not vertical:
+            along, across = across, along
+        return along, across
+
+    extent_x = max(centres[node][0] + sizes[node][0] / 2 for node in centres)
+    extent_y = max(centres[node][1] + sizes[node][1] / 2 for node in centres)
+    width, height = (extent_x, extent_y) if vertical else (extent_y, extent_x)
+    flip_x = chart.direction == 'RL'
+    flip_y = chart.direction == 'BT'
+
+    def place(point):
+        px, py = to_svg(point)
+        if flip_x:
+            px = width - px
+        if flip_y:
+            py = height - py
+        return px + DIAGRAM_PADDING, py + DIAGRAM_PADDING
+
+    real_size = {}
+    for node_id, node in chart.nodes.items():
+        real_size[node_id] = _node_size(node['shape'], node['lines'])
+
+    line_style = f"fill:none;stroke:{theme['line']}"
+    edges, labels = [], []
+    for index, edge in enumerate(chart.edges):
+        if edge['style'] == 'invisible':
+            continue
+        source, target = edge['source'], edge['target']
+        if source == target:
+            cx, cy = place(centres[source])
+            half_w, half_h = real_size[source][0] / 2, real_size[source][1] / 2
+            reach = cx + half_w + SELF_LOOP_WIDTH
+            points = [(cx + half_w, cy - half_h / 2), (reach, cy - half_h / 2),
+                      (reach, cy + half_h / 2), (cx + half_w, cy + half_h / 2)]
+            d = (f"M{_fmt(points[0][0])},{_fmt(points[0][1])} C{_fmt(points[1][0])},{_fmt(points[1][1])} "
+                 f"{_fmt(points[2][0])},{_fmt(points[2][1])} {_fmt(points[3][0])},{_fmt(points[3][1])}")
+            label_at = (reach, cy)
+        else:
+            points = [place(point) for point in edge_points[index]]
+            points[0] = _clip(chart.nodes[source]['shape'], points[0], real_size[source], points[1])
+            points[-1] = _clip(chart.nodes[target]['shape'], points[-1], real_size[target], points[-2])
+            d = _curve(points)
+            label_at = _midpoint(points)
+        style = line_style
+        if edge['style'] == 'dotted':
+            style += ';stroke-width:2;stroke-dasharray:3'
+        elif edge['style'] == 'thick':
+            style += ';stroke-width:3.5'
+        else:
+            style += ';stroke-width:2'
+        attrs = ''
+        if edge['head']:
+            attrs += f' marker-end="{writer.marker(edge["head"])}"'
+        if edge['tail']:
+            attrs += f' marker-start="{writer.marker(edge["tail"] + "_start")}"'
+        edges.append(f'<path d="{d}" style="{style}"{attrs}/>')
+        if edge['lines']:
+            labels.append((label_at, edge['lines']))
+
+    writer.add('<g class="edgePaths">' + ''.join(edges) + '</g>')
+    writer.add('<g class="edgeLabels">')
+    for (lx, ly), lines in labels:
+        label_w = max(text_width(line) for line in lines) + 8
+        label_h = LINE_HEIGHT * len(lines) + 4
+        writer.add(f'<rect x="{_fmt(lx - label_w / 2)}" y="{_fmt(ly - label_h / 2)}" width="{_fmt(label_w)}" '
+                   f'height="{_fmt(label_h)}" style="fill:{theme["edge_label_bg"]};fill-opacity:0.8;stroke:none"/>')
+        writer.text(lx, ly, lines)
+    writer.add('</g>')
+
+    writer.add('<g class="nodes">')
+    node_style = f"fill:{theme['node_fill']};stroke:{theme['node_border']};stroke-width:1"
+    for node_id, node in chart.nodes.items():
+        cx, cy = place(centres[node_id])
+        node_w, node_h = real_size[node_id]
+        writer.add('<g class="node">')
+        writer.add(_shape_markup(node['shape'], cx, cy, node_w, node_h, node_style))
+        writer.text(cx, cy, node['lines'])
+        writer.add('</g>')
+    writer.add('</g>')
+    return width + 2 * DIAGRAM_PADDING, height + 2 * DIAGRAM_PADDING
+
+
+# ---------------------------------------------------------------------------
+# Pie charts
+
+PIE_HEADER_RE = re.compile(r'^pie(?P<show>\s+showData)?(?:\s+title\s+(?P<title>.*))?$')
+PIE_SLICE_RE = re.compile(r'^"(?P<label>[^"]*)"\s*:\s*(?P<value>\d+(?:\.\d+)?|\.\d+)$')
+PIE_RADIUS = 185
+PIE_MARGIN = 40
+LEGEND_BOX = 18
+LEGEND_SPACING = 4
+
+
+def parse_pie(lines):
+    match = PIE_HEADER_RE.match(lines[0].strip())
+    if not match:
+        raise UnsupportedDiagram("pie header")
+    pie = {'title': match.group('title'), 'show_data': bool(match.group('show')), 'slices': []}
+    for line in lines[1:]:
+        line = line.strip()
+        if not line:
+            continue
+        if line == 'showData':
+            pie['show_data'] = True
+        elif line.startswith('title '):
+            pie['title'] = line[6:].strip()
+        elif re.match(r'acc(Title|Descr)\s*:', line):
+            continue
+        else:
+            slice_match = PIE_SLICE_RE.match(line)
+            if not slice_match:
+                raise UnsupportedDiagram(f"pie statement: {line[:30]!r}")
+            pie['slices'].append((label_lines(slice_match.group('label'))[0], float(slice_match.group('value'))))
+    if not pie['slices']:
+        raise UnsupportedDiagram("empty pie chart")
+    if sum(value for _, value in pie['slices']) <= 0:
+        raise UnsupportedDiagram("pie chart without positive values")
+    return pie
+
+
+def render_pie(pie, writer):
+    theme = writer.theme
+    total = sum(value for _, value in pie['slices'])
+    title_h = LINE_HEIGHT + 16 if pie['title'] else 0
+    cx = cy = PIE_MARGIN + PIE_RADIUS
+    cy += title_h
+    colors = theme['pie']
+    stroke = f"stroke:{theme['pie_stroke']};stroke-width:2px;fill-opacity:0.7"
+
+    angle = -math.pi / 2
+    labels = []
+    for index, (label, value) in enumerate(pie['slices']):
+        color = colors[index % len(colors)]
+        sweep = 2 * math.pi * value / total
+        if sweep >= 2 * math.pi - 1e-9:
+            writer.add(f'<circle cx="{_fmt(cx)}" cy="{_fmt(cy)}" r="{PIE_RADIUS}" style="fill:{color};{stroke}"/>')
+        elif sweep > 0:
+            x1, y1 = cx + PIE_RADIUS * math.cos(angle), cy + PIE_RADIUS * math.sin(angle)
+            x2, y2 = cx + PIE_RADIUS * math.cos(angle + sweep), cy + PIE_RADIUS * math.sin(angle + sweep)
+            large = 1 if sweep > math.pi else 0
+            writer.add(f'<path d="M{_fmt(cx)},{_fmt(cy)} L{_fmt(x1)},{_fmt(y1)} '
+                       f'A{PIE_RADIUS},{PIE_RADIUS} 0 {large} 1 {_fmt(x2)},{_fmt(y2)} Z" '
+                       f'style="fill:{color};{stroke}"/>')
+        if sweep > 0:
+            middle = angle + sweep / 2
+            labels.append((cx + 0.75 * PIE_RADIUS * math.cos(middle),
+                           cy + 0.75 * PIE_RADIUS * math.sin(middle),
+                           f"{value / total * 100:.0f}%"))
+        angle += sweep
+    writer.add(f'<circle cx="{_fmt(cx)}" cy="{_fmt(cy)}" r="{PIE_RADIUS}" '
+               f'style="fill:none;stroke:{theme["pie_stroke"]};stroke-width:2px"/>')
+    for lx, ly, text in labels:
+        writer.text(lx, ly, [text], size=17)
+
+    legend_x = cx + PIE_RADIUS + PIE_MARGIN
+    rows = len(pie['slices'])
+    legend_top = cy - rows * (LEGEND_BOX + LEGEND_SPACING) / 2
+    legend_w = 0.0
+    for index, (label, value) in enumerate(pie['slices']):
+        color = colors[index % len(colors)]
+        y = legend_top + index * (LEGEND_BOX + LEGEND_SPACING)
+        text = f"{label} [{value:g}]" if pie['show_data'] else label
+        writer.add(f'<rect x="{_fmt(legend_x)}" y="{_fmt(y)}" width="{LEGEND_BOX}" height="{LEGEND_BOX}" '
+                   f'style="fill:{color};stroke:{color}"/>')
+        writer.text(legend_x + LEGEND_BOX + LEGEND_SPACING, y + LEGEND_BOX / 2, [text], size=17, anchor='start')
+        legend_w = max(legend_w, text_width(text, 17))
+    width = legend_x + LEGEND_BOX + LEGEND_SPACING + legend_w + PIE_MARGIN
+    if pie['title']:
+        width = max(width, text_width(pie['title'], 25) + 2 * PIE_MARGIN)
+        writer.text(cx, PIE_MARGIN / 2 + title_h / 2, [pie['title']], size=25)
+    return width, cy + PIE_RADIUS + PIE_MARGIN
+
+
+# ---------------------------------------------------------------------------
+# Sequence diagrams
+
+PARTICIPANT_RE = re.compile(r'^(?P<kind>participant|actor)\s+(?P<id>[^\s]+?)(?:\s+as\s+(?P<label>.+))?$')
+MESSAGE_RE = re.compile(r'^(?P<source>[^\s:>+-][^:>+-]*?)\s*(?P<arrow>-->>|->>|-->|->|--x|-x|--\)|-\))'
+                        r'\s*(?P<activation>[+-])?\s*(?P<target>[^:+-][^:]*?)\s*:(?P<text>.*)$')
+NOTE_RE = re.compile(r'^note\s+(?P<where>left of|right of|over)\s+(?P<actors>[^:]+?)\s*:(?P<text>.*)$',
+                     re.IGNORECASE)
+SEQUENCE_KEYWORDS = ('autonumber', 'loop', 'alt', 'else', 'opt', 'par', 'and', 'rect', 'critical',
+                     'break', 'end', 'activate', 'deactivate', 'box', 'create', 'destroy', 'title',
+                     'link', 'links', 'properties', 'details', 'option')
+
+ACTOR_WIDTH = 150
+ACTOR_HEIGHT = 65
+ACTOR_MARGIN = 50
+MESSAGE_GAP = 40
+NOTE_MARGIN = 10
+SELF_LOOP = 30
+
+
+def parse_sequence(lines):
+    if lines[0].strip() != 'sequenceDiagram':
+        raise UnsupportedDiagram("sequence header")
+    actors = {}
+    events = []
+
+    def actor(actor_id, kind='participant', label=None):
+        if actor_id not in actors:
+            actors[actor_id] = {'kind': kind, 'lines': label_lines(label or actor_id)}
+        return actor_id
+
+    for line in lines[1:]:
+        line = line.strip()
+        if not line:
+            continue
+        keyword = line.split(None, 1)[0]
+        if keyword in SEQUENCE_KEYWORDS or keyword.startswith('acc'):
+            raise UnsupportedDiagram(f"'{keyword}' in sequence diagrams")
+        match = PARTICIPANT_RE.match(line)
+        if match:
+            if match.group('id') in actors:
+                raise UnsupportedDiagram("participant declared after use")
+            actor(match.group('id'), match.group('kind'), match.group('label'))
+            continue
+        match = NOTE_RE.match(line)
+        if match:
+            ids = [actor(name.strip()) for name in match.group('actors').split(',')]
+            if len(ids) > 2 or (len(ids) == 2 and match.group('where').lower() != 'over'):
+                raise UnsupportedDiagram("note placement")
+            events.append({'type': 'note', 'where': match.group('where').lower(), 'actors': ids,
+                           'lines': label_lines(match.group('text'))})
+            continue
+        match = MESSAGE_RE.match(line)
+        if match:
+            if match.group('activation'):
+                raise UnsupportedDiagram("activations")
+            events.append({'type': 'message', 'source': actor(match.group('source')),
+                           'target': actor(match.group('target')), 'arrow': match.group('arrow'),
+                           'lines': label_lines(match.group('text'))})
+            continue
+        raise UnsupportedDiagram(f"sequence statement: {line[:30]!r}")
+    if not actors:
+        raise UnsupportedDiagram("empty sequence diagram")
+    return {'actors': actors, 'events': events}
+
+
+def render_sequence(diagram, writer):
+    theme = writer.theme
+    actors = diagram['actors']
+    order = list(actors)
+    index_of = {actor_id: index for index, actor_id in enumerate(order)}
+    widths = [max(ACTOR_WIDTH, max(text_width(line) for line in actors[a]['lines']) + 20) for a in order]
+
+    # Widen the gap between neighbours so message labels fit
+    gaps = [ACTOR_MARGIN] * max(len(order) - 1, 0)
+    for event in diagram['events']:
+        if event['type'] != 'message' or event['source'] == event['target']:
+            continue
+        left, right = sorted((index_of[event['source']], index_of[event['target']]))
+        needed = max(text_width(line) for line in event['lines']) + ACTOR_MARGIN
+        span = sum(widths[left:right + 1]) - widths[left] / 2 - widths[right] / 2 + sum(gaps[left:right])
+        if span < needed:
+            gaps[right - 1] += needed - span
+    centres = []
+    x = ACTOR_MARGIN
+    for index, width in enumerate(widths):
+        centres.append(x + width / 2)
+        x += width + (gaps[index] if index < len(gaps) else 0)
+    total_width = x + ACTOR_MARGIN
+
+    def draw_actor(actor_id, top):
+        cx = centres[index_of[actor_id]]
+        width = widths[index_of[actor_id]]
+        info = actors[actor_id]
+        if info['kind'] == 'actor':
+            stroke = f"fill:none;stroke:{theme['actor_border']};stroke-width:2"
+            writer.add(f'<circle cx="{_fmt(cx)}" cy="{_fmt(top + 10)}" r="10" '
+                       f'style="fill:{theme["node_fill"]};stroke:{theme["actor_border"]};stroke-width:2"/>')
+            writer.add(f'<path d="M{_fmt(cx)},{_fmt(top + 20)} V{_fmt(top + 40)} M{_fmt(cx - 15)},{_fmt(top + 27)} '
+                       f'H{_fmt(cx + 15)} M{_fmt(cx)},{_fmt(top + 40)} L{_fmt(cx - 13)},{_fmt(top + 55)} '
+                       f'M{_fmt(cx)},{_fmt(top + 40)} L{_fmt(cx + 13)},{_fmt(top + 55)}" style="{stroke}"/>')
+            writer.text(cx, top + ACTOR_HEIGHT + 2, info['lines'])
+        else:
+            writer.add(f'<rect x="{_fmt(cx - width / 2)}" y="{_fmt(top)}" width="{_fmt(width)}" '
+                       f'height="{ACTOR_HEIGHT}" rx="3" ry="3" '
+                       f'style="fill:{theme["node_fill"]};stroke:{theme["actor_border"]};stroke-width:1"/>')
+            writer.text(cx, top + ACTOR_HEIGHT / 2, info['lines'])
+
+    top = DIAGRAM_PADDING
+    has_figures = any(info['kind'] == 'actor' for info in actors.values())
+    header = ACTOR_HEIGHT + (LINE_HEIGHT if has_figures else 0)
+    cursor = top + header + 10
+    body = []
+
+    for event in diagram['events']:
+        label_h = LINE_HEIGHT * len(event['lines'])
+        if event['type'] == 'note':
+            ids = [index_of[a] for a in event['actors']]
+            text_w = max(text_width(line) for line in event['lines']) + 20
+            if event['where'] == 'over':
+                left = min(centres[i] for i in ids) - (25 if len(ids) > 1 else 0)
+                right = max(centres[i] for i in ids) + (25 if len(ids) > 1 else 0)
+                note_w = max(right - left, text_w, ACTOR_WIDTH if len(ids) == 1 else 0)
+                note_x = (left + right) / 2 - note_w / 2
+            elif event['where'] == 'left of':
+                note_w = max(text_w, ACTOR_WIDTH)
+                note_x = centres[ids[0]] - note_w - 25
+            else:
+                note_w = max(text_w, ACTOR_WIDTH)
+                note_x = centres[ids[0]] + 25
+            note_h = label_h + 2 * NOTE_MARGIN
+            cursor += NOTE_MARGIN
+            body.append(('note', note_x, cursor, note_w, note_h, event['lines']))
+            cursor += note_h + NOTE_MARGIN
+            continue
+        source_x = centres[index_of[event['source']]]
+        target_x = centres[index_of[event['target']]]
+        cursor += label_h
+        line_y = cursor + 8
+        body.append(('message', source_x, target_x, line_y, event['arrow'], event['lines']))
+        cursor = line_y + (SELF_LOOP if source_x == target_x else 0) + MESSAGE_GAP - LINE_HEIGHT
+    bottom_top = cursor + 20
+
+    line_style = f"fill:none;stroke:{theme['line']};stroke-width:0.5"
+    for actor_id in order:
+        cx = centres[index_of[actor_id]]
+        writer.add(f'<path d="M{_fmt(cx)},{_fmt(top + ACTOR_HEIGHT)} V{_fmt(bottom_top)}" '
+                   f'style="{line_style};stroke-dasharray:3"/>')
+        draw_actor(actor_id, top)
+        draw_actor(actor_id, bottom_top)
+
+    for item in body:
+        if item[0] == 'note':
+            _, note_x, note_y, note_w, note_h, lines = item
+            writer.add(f'<rect x="{_fmt(note_x)}" y="{_fmt(note_y)}" width="{_fmt(note_w)}" height="{_fmt(note_h)}" '
+                       f'style="fill:{theme["note_fill"]};stroke:{theme["note_border"]};stroke-width:1"/>')
+            writer.text(note_x + note_w / 2, note_y + note_h / 2, lines, fill=theme['note_text'])
+            total_width = max(total_width, note_x + note_w + ACTOR_MARGIN)
+            continue
+        _, source_x, target_x, line_y, arrow, lines = item
+        style = f"fill:none;stroke:{theme['line']};stroke-width:1.5"
+        if arrow.startswith('--'):
+            style += ';stroke-dasharray:3,3'
+        head = {'>>': 'arrow', 'x': 'cross', ')': 'open'}.get(arrow.lstrip('-'))
+        marker = f' marker-end="{writer.marker(head)}"' if head else ''
+        if source_x == target_x:
+            d = (f"M{_fmt(source_x)},{_fmt(line_y)} C{_fmt(source_x + 60)},{_fmt(line_y - 10)} "
+                 f"{_fmt(source_x + 60)},{_fmt(line_y + SELF_LOOP)} {_fmt(source_x)},{_fmt(line_y + SELF_LOOP)}")
+            writer.text(source_x + 40, line_y - 8 - LINE_HEIGHT * (len(lines) - 1) / 2 - 4, lines, anchor='start')
+            total_width = max(total_width, source_x + 60 + max(text_width(line) for line in lines) + ACTOR_MARGIN)
+        else:
+            d = f"M{_fmt(source_x)},{_fmt(line_y)} H{_fmt(target_x)}"
+            writer.text((source_x + target_x) / 2, line_y - 8 - LINE_HEIGHT * (len(lines) - 1) / 2 - 4, lines)
+        writer.add(f'<path d="{d}" style="{style}"{marker}/>')
+    return total_width, bottom_top + header + DIAGRAM_PADDING
+
+
+# ---------------------------------------------------------------------------
+
+def parse_diagram(code):
+    """Parse ``code`` into (kind, model); raises UnsupportedDiagram."""
+    if code.lstrip().startswith('---'):
+        raise UnsupportedDiagram("front matter")
+    lines = [line for line in _strip_comments(code) if line.strip()]
+    if not lines:
+        raise UnsupportedDiagram("empty diagram")
+    keyword = lines[0].split(None, 1)[0]
+    if keyword in ('graph', 'flowchart'):
+        return 'flowchart', parse_flowchart(lines)
+    if keyword == 'pie':
+        return 'pie', parse_pie(lines)
+    if keyword == 'sequenceDiagram':
+        return 'sequence', parse_sequence(lines)
+    raise UnsupportedDiagram(f"diagram type '{keyword}'")
+
+
+def supports(code, theme='default'):
+    """True when ``code`` is within the subset rendered in-process."""
+    if theme not in THEMES:
+        return False
+    try:
+        parse_diagram(code)
+    except UnsupportedDiagram:
+        return False
+    return True
+
+
+def render_svg(code, theme='default', background='white'):
+    """Render ``code`` to SVG bytes; raises UnsupportedDiagram."""
+    if theme not in THEMES:
+        raise UnsupportedDiagram(f"theme '{theme}'")
+    kind, model = parse_diagram(code)
+    writer = SvgWriter(THEMES[theme], background)
+    renderers = {'flowchart': render_flowchart, 'pie': render_pie, 'sequence': render_sequence}
+    width, height = renderers[kind](model, writer)
+    return writer.tostring(width, height)
+
+
+def is_lite_svg(data):
+    """True for SVG bytes produced by render_svg."""
+    return data[:200].find(b'class="mermaid-lite"') >= 0
@@ -0,0 +1,205 @@
+#!/usr/bin/env node
+// MIT License
+
+// Copyright (c) 2026 Rachid, Youven ZEGHLACHE
+
+/*
+ * Long-lived Mermaid render worker for the Inkscape extension.
+ *
+ * Keeps one headless Chromium warm and accepts newline-delimited JSON jobs
+ * over a Unix socket, so each diagram only pays for the render itself
+ * instead of Node startup + mermaid bundle load + browser launch.
+ *
+ * Request:  {"id": 1, "code": "...", "output": "/tmp/x.pdf", "format": "pdf",
+ *            "theme": "default", "backgroundColor": "white", "width": 800,
+ *            "height": 600, "scale": 1, "configFile": "", "cssFile": "",
+ *            "timeout": 30000, "pdfFit": true}
+ * Response: {"id": 1, "ok": true, "ms": 812} or {"id": 1, "ok": false, "error": "..."}
+ *
+ * Usage: node mermaid_render_worker.mjs --socket PATH --cli-dir DIR
+ *            [--idle-timeout SECONDS] [--max-jobs N]
+ */
+
+import fs from 'node:fs/promises';
+import { existsSync, unlinkSync } from 'node:fs';
+import net from 'node:net';
+import path from 'node:path';
+import { createRequire } from 'node:module';
+import { pathToFileURL } from 'node:url';
+
+function parseArgs(argv) {
+  const args = { idleTimeout: 300, maxJobs: 100 };
+  for (let i = 0; i < argv.length; i++) {
+    const value = argv[i + 1];
+    switch (argv[i]) {
+      case '--socket': args.socket = value; i++; break;
+      case '--cli-dir': args.cliDir = value; i++; break;
+      case '--idle-timeout': args.idleTimeout = Number(value); i++; break;
+      case '--max-jobs': args.maxJobs = Number(value); i++; break;
+      default: break;
+    }
+  }
+  if (!args.socket || !args.cliDir) {
+    console.error('usage: mermaid_render_worker.mjs --socket PATH --cli-dir DIR');
+    process.exit(2);
+  }
+  return args;
+}
+
+const args = parseArgs(process.argv.slice(2));
+
+// Load mermaid-cli and puppeteer from the same installation mmdc uses
+const cliRequire = createRequire(path.join(args.cliDir, 'package.json'));
+const { renderMermaid } = await import(pathToFileURL(path.join(args.cliDir, 'src', 'index.js')).href);
+const puppeteerModule = await import(pathToFileURL(cliRequire.resolve('puppeteer')).href);
+const puppeteer = puppeteerModule.default ?? puppeteerModule;
+
+let browser = null;
+let jobsOnBrowser = 0;
+let idleTimer = null;
+let queue = Promise.resolve();
+
+async function getBrowser() {
+  if (browser && jobsOnBrowser >= args.maxJobs) {
+    // Recycle to bound Chromium memory growth
+    await closeBrowser();
+  }
+  if (!browser) {
+    browser = await puppeteer.launch({ headless: 'new' });
+    jobsOnBrowser = 0;
+  }
+  return browser;
+}
+
+async function closeBrowser() {
+  const old = browser;
+  browser = null;
+  if (old) {
+    try {
+      await old.close();
+    } catch {
+      // Browser already gone
+    }
+  }
+}
+
+async function readOptional(file) {
+  if (!file) return undefined;
+  return fs.readFile(file, 'utf8');
+}
+
+async function render(job) {
+  const started = Date.now();
+  let mermaidConfig = { theme: job.theme || 'default' };
+  const configText = await readOptional(job.configFile);
+  if (configText) {
+    mermaidConfig = Object.assign(mermaidConfig, JSON.parse(configText));
+  }
+  const myCSS = await readOptional(job.cssFile);
+
+  const b = await getBrowser();
+  jobsOnBrowser++;
+  const { data } = await renderMermaid(b, job.code, job.format || 'pdf', {
+    viewport: {
+      width: job.width || 800,
+      height: job.height || 600,
+      deviceScaleFactor: job.scale || 1,
+    },
+    backgroundColor: job.backgroundColor || 'white',
+    mermaidConfig,
+    myCSS,
+    pdfFit: Boolean(job.pdfFit),
+  });
+  await fs.writeFile(job.output, data);
+  return Date.now() - started;
+}
+
+function withTimeout(promise, ms) {
+  let timer;
+  const timeout = new Promise((_, reject) => {
+    timer = setTimeout(() => reject(new Error(`render timeout (${ms} ms)`)), ms);
+  });
+  return Promise.race([promise, timeout]).finally(() => clearTimeout(timer));
+}
+
+function resetIdleTimer() {
+  if (idleTimer) clearTimeout(idleTimer);
+  if (args.idleTimeout > 0) {
+    idleTimer = setTimeout(shutdown, args.idleTimeout * 1000);
+  }
+}
+
+async function shutdown() {
+  server.close();
+  await closeBrowser();
+  try {
+    unlinkSync(args.socket);
+  } catch {
+    // Already removed
+  }
+  process.exit(0);
+}
+
+function handleJob(job, reply) {
+  // Jobs share one browser, so run them strictly one after another
+  queue = queue.then(async () => {
+    resetIdleTimer();
+    try {
+      const ms = await withTimeout(render(job), job.timeout || 30000);
+      reply({ id: job.id, ok: true, ms });
+    } catch (err) {
+      // A timed-out page may leave the browser wedged; start clean next time
+      await closeBrowser();
+      reply({ id: job.id, ok: false, error: String(err && err.message ? err.message : err) });
+    }
+    resetIdleTimer();
+  });
+}
+
+const server = net.createServer((socket) => {
+  let buffer = '';
+  socket.setEncoding('utf8');
+  socket.on('data', (chunk) => {
+    buffer += chunk;
+    let newline;
+    while ((newline = buffer.indexOf('\n')) >= 0) {
+      const line = buffer.slice(0, newline).trim();
+      buffer = buffer.slice(newline + 1);
+      if (!line) continue;
+      let job;
+      try {
+        job = JSON.parse(line);
+      } catch (err) {
+        socket.write(JSON.stringify({ ok: false, error: `bad request: ${err.message}` }) + '\n');
+        continue;
+      }
+      if (job.cmd === 'ping') {
+        socket.write(JSON.stringify({ id: job.id, ok: true, pid: process.pid }) + '\n');
+        continue;
+      }
+      if (job.cmd === 'shutdown') {
+        socket.end(JSON.stringify({ id: job.id, ok: true }) + '\n');
+        shutdown();
+        return;
+      }
+      handleJob(job, (response) => {
+        if (!socket.destroyed) socket.write(JSON.stringify(response) + '\n');
+      });
+    }
+  });
+  socket.on('error', () => {});
+});
+
+if (existsSync(args.socket)) {
+  // Stale socket from a crashed worker; the client only starts us when connect failed
+  unlinkSync(args.socket);
+}
+
+process.on('SIGTERM', shutdown);
+process.on('SIGINT', shutdown);
+
+server.listen(args.socket, () => {
+  resetIdleTimer();
+  // Warm the browser before the first job arrives
+  queue = queue.then(() => getBrowser()).catch(() => closeBrowser());
+});
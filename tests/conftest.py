@@ -0,0 +1,56 @@
+"""
+Shared fixtures: the extension modules on sys.path, the benchmark stub
+tools (mmdc, inkscape, render_server) on PATH, and a per-test cache
+directory, so no real Mermaid CLI, Inkscape or render service is needed.
+"""
+import os
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STUBS = os.path.join(ROOT, 'benchmarks', 'stubs')
+sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(autouse=True)
+def stub_tools(tmp_path, monkeypatch):
+    monkeypatch.setenv('PATH', STUBS + os.pathsep + os.environ.get('PATH', ''))
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def render_server():
+    """Start the stub render service with the given flags; returns its URL."""
+    processes = []
+
+    def start(*flags):
+        port = free_port()
+        process = subprocess.Popen([sys.executable, os.path.join(STUBS, 'render_server'),
+                                    '--port', str(port), *flags])
+        processes.append(process)
+        url = f'http://127.0.0.1:{port}'
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                urllib.request.urlopen(f'{url}/stats', timeout=1).close()
+                return f'{url}/mermaid'
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    yield start
+    for process in processes:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,43 @@
+"""Build manifest signatures and incremental rebuilds of mermaid_build."""
+import json
+
+import mermaid_build
+from mermaid_build import MANIFEST_NAME, make_generator, output_signature, parse_args
+
+CODE = "flowchart LR\n    A --> B"
+
+
+def signature(*argv):
+    return output_signature(make_generator(parse_args(['diagram.mmd', *argv])), CODE)
+
+
+def test_output_signature_follows_scaling():
+    base = signature()
+    assert signature('--max-width', '300') != base
+    assert signature('--max-height', '300') != base
+    assert signature('--max-width', '300') != signature('--max-width', '400')
+
+
+def test_output_signature_follows_render_options():
+    assert signature('--theme', 'dark') != signature()
+
+
+def test_output_signature_ignores_run_settings():
+    assert signature('-j', '1', '--timeout', '5') == signature()
+
+
+def test_build_skips_unchanged_and_rebuilds_on_scaling(tmp_path):
+    source = tmp_path / 'diagram.mmd'
+    source.write_text(CODE)
+    out = tmp_path / 'out'
+    argv = [str(source), '-o', str(out), '-f', 'svg_native']
+    assert mermaid_build.main(argv) == 0
+    manifest = json.loads((out / MANIFEST_NAME).read_text())
+    first = (out / 'diagram.svg').stat().st_mtime_ns
+
+    assert mermaid_build.main(argv) == 0
+    assert json.loads((out / MANIFEST_NAME).read_text()) == manifest
+    assert (out / 'diagram.svg').stat().st_mtime_ns == first
+
+    assert mermaid_build.main(argv + ['--max-width', '50']) == 0
+    assert json.loads((out / MANIFEST_NAME).read_text()) != manifest
@@ -0,0 +1,83 @@
+"""Render cache storage and the render signature it is keyed on."""
+import os
+
+import mermaid_diagram
+from mermaid_build import make_generator, parse_args
+from mermaid_diagram import RenderCache
+
+CODE = "flowchart LR\n    A --> B"
+
+
+def generator(*argv):
+    return make_generator(parse_args(['diagram.mmd', *argv]))
+
+
+def test_cache_hit_miss_and_flush(tmp_path):
+    cache = RenderCache(str(tmp_path), 1024 * 1024)
+    assert cache.get('k', 'svg') is None
+    cache.put('k', 'svg', b'<svg/>')
+    assert cache.get('k', 'svg') == b'<svg/>'
+    assert cache.stats() == {'hits': 1, 'misses': 1}
+    assert not os.path.exists(os.path.join(str(tmp_path), RenderCache.STATS_FILE))
+    cache.flush()
+    cache.get('k', 'svg')
+    cache.flush()
+    assert RenderCache(str(tmp_path), 1024).load_stats() == {'hits': 2, 'misses': 1}
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = RenderCache(str(tmp_path), 250)
+    for index, key in enumerate(('a', 'b')):
+        path = cache.put(key, 'svg', b'x' * 100)
+        os.utime(path, (index, index))
+    os.utime(cache.path_for('a', 'svg'), (10, 10))  # used after b
+    cache.put('c', 'svg', b'x' * 100)
+    assert not os.path.exists(cache.path_for('b', 'svg'))
+    assert cache.get('a', 'svg') and cache.get('c', 'svg')
+
+
+def test_signature_is_stable():
+    assert generator().render_signature(CODE) == generator().render_signature(CODE)
+
+
+def test_signature_follows_source_and_render_options():
+    base = generator().render_signature(CODE)
+    assert generator().render_signature(CODE + ";") != base
+    for argv in (['--theme', 'dark'], ['-f', 'png'], ['--quality', '3'], ['--no-fit'],
+                 ['--background', 'transparent']):
+        assert generator(*argv).render_signature(CODE) != base, argv
+
+
+def test_signature_ignores_placement_options():
+    base = generator().render_signature(CODE)
+    assert generator('--max-width', '300').render_signature(CODE) == base
+
+
+def test_signature_follows_config_file_contents(tmp_path):
+    config = tmp_path / 'config.json'
+    config.write_text('{"theme": "dark"}')
+    first = generator('--config-file', str(config)).render_signature(CODE)
+    config.write_text('{"theme": "forest"}')
+    assert generator('--config-file', str(config)).render_signature(CODE) != first
+
+
+def test_signature_separates_worker_and_mmdc(monkeypatch):
+    monkeypatch.setattr(mermaid_diagram.RenderWorkerClient, 'supported', staticmethod(lambda: True))
+    assert generator('--use-worker').render_signature(CODE) != generator().render_signature(CODE)
+
+
+def test_native_signature_skips_inkscape():
+    native = generator('-f', 'svg_native')
+
+    def probe():
+        raise AssertionError("svg_native does not use Inkscape")
+
+    native.get_inkscape_version = probe
+    native.render_signature(CODE)
+
+
+def test_signature_names_the_render_service():
+    local = generator('-f', 'png').render_signature(CODE)
+    first = generator('-f', 'png', '--render-url', 'http://127.0.0.1:1/a').render_signature(CODE)
+    second = generator('-f', 'png', '--render-url', 'http://127.0.0.1:1/b').render_signature(CODE)
+    assert len({local, first, second}) == 3
@@ -0,0 +1,100 @@
+"""HttpRenderClient status handling and HttpBackend fallback, against the stub service."""
+import json
+import urllib.request
+
+import pytest
+
+from conftest import free_port
+from mermaid_build import make_generator, parse_args
+from mermaid_diagram import HttpRenderClient, RenderServiceError, RenderServiceUnavailable
+
+PAYLOAD = {'diagram_source': "flowchart LR\n    A --> B", 'diagram_type': 'mermaid',
+           'output_format': 'svg', 'diagram_options': {}}
+BAD = dict(PAYLOAD, diagram_source="error here")
+
+
+def stats(url):
+    with urllib.request.urlopen(url.rsplit('/', 1)[0] + '/stats') as response:
+        return json.load(response)
+
+
+def client(url, retries=3):
+    return HttpRenderClient(url, 5, retries=retries, max_backoff=0.05)
+
+
+def test_renders_compressed_on_one_connection(render_server):
+    url = render_server()
+    before = stats(url)
+    c = client(url)
+    assert c.render(PAYLOAD).startswith(b'<svg')
+    assert c.render(dict(PAYLOAD, output_format='png')).startswith(b'\x89PNG')
+    c.close()
+    after = stats(url)
+    # One connection for both renders, one for this GET /stats
+    assert after['connections'] - before['connections'] == 2
+    assert (after['requests'], after['gzip']) == (2, 2)
+
+
+def test_retries_transient_errors(render_server):
+    url = render_server('--fail-every', '2')
+    c = client(url)
+    for _ in range(3):
+        assert c.render(PAYLOAD).startswith(b'<svg')
+    # Requests 2 and 4 fail and are retried
+    assert (stats(url)['requests'], stats(url)['failed']) == (5, 2)
+
+
+def test_gives_up_after_retries(render_server):
+    url = render_server('--fail-every', '1')
+    with pytest.raises(RenderServiceUnavailable):
+        client(url, retries=2).render(PAYLOAD)
+    assert stats(url)['requests'] == 3
+
+
+def test_downgrades_on_415(render_server):
+    url = render_server('--no-gzip')
+    c = client(url)
+    assert c.render(PAYLOAD).startswith(b'<svg')
+    assert not c.compress
+    c.render(PAYLOAD)
+    assert stats(url)['requests'] == 3
+
+
+def test_retries_plain_when_service_ignores_gzip(render_server):
+    url = render_server('--ignore-gzip')
+    c = client(url)
+    assert c.render(PAYLOAD).startswith(b'<svg')
+    assert not c.compress
+
+
+def test_reports_diagram_errors(render_server):
+    url = render_server()
+    c = client(url)
+    with pytest.raises(RenderServiceError) as error:
+        c.render(BAD)
+    assert error.value.status == 400
+    assert not isinstance(error.value, RenderServiceUnavailable)
+    assert 'Parse error' in str(error.value)
+    # Both bodies failed the same way, so compression stays on
+    assert c.compress
+
+
+def test_unreachable_service():
+    with pytest.raises(RenderServiceUnavailable):
+        client(f'http://127.0.0.1:{free_port()}/mermaid', retries=1).render(PAYLOAD)
+
+
+def test_backend_falls_back_to_mmdc_when_down(tmp_path):
+    args = parse_args(['diagram.mmd', '--render-url', f'http://127.0.0.1:{free_port()}/mermaid',
+                       '--render-retries', '0'])
+    backend = make_generator(args).get_render_backend()
+    assert backend.name == 'http'
+    assert backend.render(PAYLOAD['diagram_source'], 'svg', str(tmp_path), 1.0).startswith(b'<svg')
+    assert backend.down
+
+
+def test_backend_renders_pdf_locally(render_server, tmp_path):
+    url = render_server()
+    backend = make_generator(parse_args(['diagram.mmd', '--render-url', url])).get_render_backend()
+    assert backend.render(PAYLOAD['diagram_source'], 'pdf', str(tmp_path), 1.0).startswith(b'%PDF')
+    assert stats(url)['requests'] == 0